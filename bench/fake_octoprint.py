@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+'''
+An in-process stand-in for the OctoPrint REST API, for benchmarking
+
+It answers the parts of the API used by OctoSalt from canned data, after an
+optional ``latency``, and counts the requests and the bytes which go over the
+wire either way. ``size`` sets the number of entries in each listing (files,
+users, printer and slicing profiles), to scale the payloads up or down.
+
+The push API is served as a plain websocket at ``/sockjs/websocket``, as
+OctoPrint does. Each socket is sent a ``connected`` and a ``history``
+message, then a ``current`` message every ``push_interval`` seconds, with an
+``event`` after every tenth. The push API is counted apart from the REST API,
+as it runs in the background of whatever else is being measured.
+
+.. code-block:: python
+
+    server = FakeOctoPrint(latency=0.005, size=100)
+    url = server.start()
+    ...
+    print(server.counters())
+    server.stop()
+'''
+
+# Import python libs
+from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
+import base64
+import gzip
+import hashlib
+import http.server
+import json
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class FakeOctoPrint(object):
+    '''
+    A threaded HTTP server which serves canned OctoPrint API responses
+    '''
+    def __init__(self, latency=0.0, size=50, push_interval=0.5, host='127.0.0.1', port=0):
+        self.latency = float(latency)
+        self.size = int(size)
+        self.push_interval = float(push_interval)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'push_messages': 0, 'push_bytes': 0}
+        self.data = _payloads(self.size)
+        self._server = _Server((host, port), _Handler)
+        self._server.octoprint = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self._server.server_address[:2])
+
+    def start(self):
+        '''
+        Serve requests on a background thread, returning the base URL
+        '''
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-octoprint')
+        self._thread.daemon = True
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        '''
+        Stop serving requests, and close the push sockets
+        '''
+        self.stopping.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def counters(self):
+        '''
+        Return a copy of the request and byte counters
+        '''
+        with self.lock:
+            return dict(self.stats)
+
+    def count(self, bytes_in=0, bytes_out=0, requests=0, push_messages=0, push_bytes=0):
+        with self.lock:
+            self.stats['requests'] += requests
+            self.stats['bytes_in'] += bytes_in
+            self.stats['bytes_out'] += bytes_out
+            self.stats['push_messages'] += push_messages
+            self.stats['push_bytes'] += push_bytes
+
+    def push_message(self, number):
+        '''
+        Return the push API messages sent at a tick of a socket: a
+        ``current`` message with the printer's state and temperatures, and
+        every tenth tick, an event
+        '''
+        printer = self.data['/api/printer']
+        job = self.data['/api/job']
+        now = time.time()
+        temps = dict((heater, {'actual': value['actual'], 'target': value['target']})
+                     for heater, value in printer['temperature'].items())
+        temps['time'] = int(now)
+        current = {
+            'state': printer['state'],
+            'job': job['job'],
+            'progress': job['progress'],
+            'currentZ': None,
+            'offsets': {},
+            'serverTime': now,
+            'temps': [temps],
+            'logs': ['Recv: ok T:{0} /0.0 B:{1} /0.0'.format(
+                temps['tool0']['actual'], temps['bed']['actual'])],
+            'messages': [],
+            'busyFiles': [],
+        }
+        if number == 0:
+            return [
+                {'connected': {'version': '1.3.10', 'display_version': '1.3.10',
+                               'branch': 'master', 'plugin_hash': 'bench', 'config_hash': 'bench'}},
+                {'history': current},
+            ]
+        ret = [{'current': current}]
+        if number % 10 == 0:
+            ret.append({'event': {'type': 'ZChange', 'payload': {'new': 0.2, 'old': None}}})
+        return ret
+
+
+def _payloads(size):
+    '''
+    Build the canned API data, with ``size`` entries in each listing
+    '''
+    folders = []
+    for number in range(max(1, size // 10)):
+        name = 'folder{0:03d}'.format(number)
+        folders.append({
+            'name': name,
+            'display': name,
+            'path': name,
+            'type': 'folder',
+            'typePath': ['folder'],
+            'origin': 'local',
+            'children': [],
+            'refs': {'resource': '/api/files/local/{0}'.format(name)},
+        })
+    files = []
+    for number in range(size):
+        name = 'part{0:04d}.gcode'.format(number)
+        folder = folders[number % len(folders)]
+        path = '{0}/{1}'.format(folder['path'], name)
+        folder['children'].append({
+            'name': name,
+            'display': name,
+            'path': path,
+            'type': 'machinecode',
+            'typePath': ['machinecode', 'gcode'],
+            'origin': 'local',
+            'hash': hashlib.sha1(path.encode('utf-8')).hexdigest(),
+            'size': 1048576 + number,
+            'date': 1500000000 + number,
+            'gcodeAnalysis': {
+                'estimatedPrintTime': 3600.0 + number,
+                'filament': {'tool0': {'length': 1234.5, 'volume': 2.9}},
+                'printingArea': {
+                    'minX': 10.0, 'maxX': 100.0, 'minY': 10.0, 'maxY': 100.0, 'minZ': 0.2, 'maxZ': 40.0,
+                },
+            },
+            'refs': {
+                'resource': '/api/files/local/{0}'.format(path),
+                'download': '/downloads/files/local/{0}'.format(path),
+            },
+        })
+    files.extend(folders)
+
+    profiles = {}
+    for number in range(max(1, size // 10)):
+        ident = '_default' if number == 0 else 'printer{0:03d}'.format(number)
+        profiles[ident] = {
+            'id': ident,
+            'name': ident,
+            'model': 'Bench Printer',
+            'color': 'default',
+            'current': number == 0,
+            'default': number == 0,
+            'resource': '/api/printerprofiles/{0}'.format(ident),
+            'volume': {'formFactor': 'rectangular', 'origin': 'lowerleft', 'width': 250, 'depth': 210, 'height': 200},
+            'heatedBed': True,
+            'heatedChamber': False,
+            'axes': dict((axis, {'speed': 6000, 'inverted': False}) for axis in 'xyze'),
+            'extruder': {'count': 1, 'offsets': [[0.0, 0.0]], 'nozzleDiameter': 0.4},
+        }
+
+    slicing = {}
+    for number in range(max(1, size // 10)):
+        name = 'profile{0:03d}'.format(number)
+        slicing[name] = {
+            'key': name,
+            'displayName': name,
+            'description': 'Bench profile',
+            'default': number == 0,
+            'resource': '/api/slicing/cura/profiles/{0}'.format(name),
+        }
+
+    users = [
+        {
+            'name': 'user{0:03d}'.format(number),
+            'active': True,
+            'user': True,
+            'admin': number == 0,
+            'apikey': None,
+            'settings': {},
+        }
+        for number in range(size)
+    ]
+
+    return {
+        '/api/version': {'api': '0.1', 'server': '1.3.10', 'text': 'OctoPrint 1.3.10'},
+        '/api/connection': {
+            'current': {'state': 'Operational', 'port': '/dev/ttyACM0', 'baudrate': 115200, 'printerProfile': '_default'},
+            'options': {'ports': ['/dev/ttyACM0'], 'baudrates': [115200, 250000], 'printerProfiles': []},
+        },
+        '/api/printer': {
+            'state': {
+                'text': 'Operational',
+                'flags': {
+                    'operational': True, 'paused': False, 'printing': False, 'pausing': False,
+                    'cancelling': False, 'sdReady': True, 'error': False, 'ready': True,
+                    'closedOrError': False,
+                },
+            },
+            'temperature': {
+                'tool0': {'actual': 21.3, 'target': 0.0, 'offset': 0},
+                'bed': {'actual': 20.1, 'target': 0.0, 'offset': 0},
+            },
+            'sd': {'ready': True},
+        },
+        '/api/job': {
+            'job': {
+                'file': {'name': None, 'origin': None, 'size': None, 'date': None},
+                'estimatedPrintTime': None,
+                'filament': {'length': None, 'volume': None},
+            },
+            'progress': {'completion': None, 'filepos': None, 'printTime': None, 'printTimeLeft': None},
+            'state': 'Operational',
+        },
+        '/api/files': {'files': files, 'free': 10000000000, 'total': 20000000000},
+        '/api/printerprofiles': {'profiles': profiles},
+        '/api/slicing': {
+            'cura': {
+                'key': 'cura', 'displayName': 'CuraEngine', 'default': True, 'configured': True,
+                'profiles': slicing,
+            },
+        },
+        '/api/users': {'users': users},
+    }
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    '''
+    Route each request to canned data, counting what goes over the wire
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        # As OctoPrint's own server does; otherwise the headers and body of a
+        # response, sent separately, wait on the client's delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    @property
+    def octoprint(self):
+        return self.server.octoprint
+
+    def _body(self):
+        '''
+        Read the request body, whether it has a length or is chunked
+        '''
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if not size:
+                    break
+                body.append(chunk)
+            return b''.join(body)
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, code, obj=None):
+        '''
+        Send a response, compressed if the client accepts it as OctoPrint's
+        own server does, and count it
+        '''
+        body = b'' if obj is None else json.dumps(obj).encode('utf-8')
+        headers = {}
+        if self.command == 'GET' and obj is not None:
+            etag = hashlib.md5(body).hexdigest()
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                code, body = 304, b''
+        if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 1)
+            headers['Content-Encoding'] = 'gzip'
+        if body:
+            headers['Content-Type'] = 'application/json'
+        headers['Content-Length'] = str(len(body))
+
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        head = sum(len(name) + len(value) + 4 for name, value in headers.items()) + 40
+        self.octoprint.count(bytes_out=head + len(body))
+
+    def _handle(self):
+        body = self._body()
+        head = len(self.requestline) + len(str(self.headers)) + 2
+        self.octoprint.count(bytes_in=head + len(body), requests=1)
+        if self.octoprint.latency:
+            time.sleep(self.octoprint.latency)
+        path = self.path.split('?')[0].rstrip('/')
+        try:
+            data = json.loads(body.decode('utf-8')) if body and self.headers.get(
+                'Content-Type', '').startswith('application/json') else {}
+        except ValueError:
+            return self._send(400, {'error': 'Malformed JSON body'})
+        getattr(self, '_{0}'.format(self.command.lower()))(path, data)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def _get(self, path, data):
+        if path == '/sockjs/websocket' and self.headers.get('Upgrade', '').lower() == 'websocket':
+            return self._websocket()
+        canned = self.octoprint.data
+        if path in canned:
+            return self._send(200, canned[path])
+        parts = path.split('/')
+        if path.startswith('/api/files/'):
+            item = _find(canned['/api/files']['files'], '/'.join(parts[4:]))
+            if parts[3] == 'local' and (item is not None or len(parts) == 4):
+                return self._send(200, item or {'files': canned['/api/files']['files']})
+        if path.startswith('/api/slicing/') and len(parts) == 6:
+            slicer = canned['/api/slicing'].get(parts[3])
+            if slicer and parts[5] in slicer['profiles']:
+                profile = dict(slicer['profiles'][parts[5]])
+                profile['data'] = {'layer_height': 0.2, 'wall_thickness': 0.8}
+                return self._send(200, profile)
+        if path.startswith('/api/users/'):
+            for user in canned['/api/users']['users']:
+                if user['name'] == parts[3]:
+                    return self._send(200, user)
+        return self._send(404, {'error': 'Not found'})
+
+    def _post(self, path, data):
+        parts = path.split('/')
+        if path.startswith('/api/files/'):
+            if len(parts) == 4:
+                # An upload; the name of the file is not worth parsing out
+                return self._send(201, {
+                    'done': True,
+                    'files': {parts[3]: {'name': 'upload.gcode', 'origin': parts[3]}},
+                })
+            if data.get('command') in ('copy', 'move'):
+                return self._send(201, {'origin': parts[3], 'path': data.get('destination')})
+            return self._send(204)
+        if path == '/api/login':
+            return self._send(200, {'name': '_api', 'active': True, 'session': 'bench'})
+        if path == '/api/users':
+            return self._send(200, {'users': []})
+        if path.startswith('/api/printerprofiles'):
+            return self._send(200, {'profile': data.get('profile', {})})
+        return self._send(204)
+
+    def _put(self, path, data):
+        return self._send(201, data)
+
+    def _patch(self, path, data):
+        return self._send(200, data)
+
+    def _delete(self, path, data):
+        if path.startswith('/api/users/'):
+            return self._send(200, {'users': []})
+        return self._send(204)
+
+
+    def _websocket(self):
+        '''
+        Accept a push API socket, and send it messages until it is closed or
+        the server stops. Messages from the client, such as its ``auth``
+        message, are read and ignored.
+        '''
+        accept = base64.b64encode(hashlib.sha1(
+            (self.headers['Sec-WebSocket-Key'] + WEBSOCKET_GUID).encode('utf-8')).digest())
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept.decode('utf-8'))
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        number = 0
+        tick = time.time()
+        try:
+            while not self.octoprint.stopping.is_set():
+                readable = select.select([self.connection], [], [], max(0, tick - time.time()))[0]
+                if readable:
+                    opcode = _read_frame(self.connection)
+                    if opcode is None or opcode == 0x8:
+                        self.wfile.write(_frame(b'', 0x8))
+                        return
+                    continue
+                for message in self.octoprint.push_message(number):
+                    frame = _frame(json.dumps(message).encode('utf-8'))
+                    self.wfile.write(frame)
+                    self.octoprint.count(push_messages=1, push_bytes=len(frame))
+                number += 1
+                tick += self.octoprint.push_interval
+        except (socket.error, ValueError):
+            # The proxy aborts its socket when it stops
+            return
+
+
+def _frame(payload, opcode=0x1):
+    '''
+    Build an unmasked websocket frame, as sent by a server
+    '''
+    length = len(payload)
+    if length < 126:
+        head = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        head = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        head = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return head + payload
+
+
+def _read_frame(sock):
+    '''
+    Read a websocket frame sent by a client, returning its opcode, or None
+    if the socket was closed. The socket is read directly, as ``select``
+    can't see what a buffered file has already read from it.
+    '''
+    head = _recv(sock, 2)
+    if head is None:
+        return None
+    length = head[1] & 0x7f
+    if length == 126:
+        length = struct.unpack('!H', _recv(sock, 2) or b'\0\0')[0]
+    elif length == 127:
+        length = struct.unpack('!Q', _recv(sock, 8) or b'\0' * 8)[0]
+    if head[1] & 0x80:
+        length += 4
+    if length and _recv(sock, length) is None:
+        return None
+    return head[0] & 0x0f
+
+
+def _recv(sock, size):
+    '''
+    Read exactly ``size`` bytes from a socket, or None if it was closed
+    '''
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _find(items, path):
+    '''
+    Find a file or folder in a recursive file listing by its path
+    '''
+    for item in items:
+        if item['path'] == path:
+            return item
+        if path.startswith(item['path'] + '/'):
+            return _find(item.get('children', []), path)
+    return None
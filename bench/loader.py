@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+'''
+A minimal stand-in for Salt's loader, for benchmarking
+
+It loads the OctoPrint proxy, execution modules, states, beacons and utils
+from the ``salt/`` directory of this repository, and gives each of them the
+dunder dictionaries which Salt's loader would: ``__opts__``, ``__pillar__``,
+``__grains__``, ``__context__``, ``__salt__``, ``__proxy__`` and
+``__utils__``. As with Salt's loader, ``salt/_utils`` can be imported from
+while the modules load. Salt itself must be installed, as the modules import
+from it.
+'''
+
+# Import python libs
+from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
+import glob
+import importlib.util
+import os
+import sys
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'salt')
+
+
+class Loader(object):
+    '''
+    Load the OctoSalt modules with the given minion options. The functions
+    are found in ``salt``, ``proxy``, ``states``, ``beacons`` and ``utils``,
+    by their names as seen by Salt, e.g. ``salt['octo_file.upload']``.
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.context = {}
+        self.salt = {}
+        self.proxy = {}
+        self.states = {}
+        self.beacons = {}
+        self.utils = {}
+        self.unavailable = {}
+
+        sys.path.insert(0, os.path.join(ROOT, '_utils'))
+        try:
+            self._load_all()
+        finally:
+            sys.path.remove(os.path.join(ROOT, '_utils'))
+
+    def _load_all(self):
+        '''
+        Load the utils, then the proxy and the modules which use them
+        '''
+        for path in sorted(glob.glob(os.path.join(ROOT, '_utils', '*.py'))):
+            name = os.path.basename(path)[:-3]
+            self._register(self._load(path, name), name, self.utils)
+
+        self.proxy_module = self._load(os.path.join(ROOT, '_proxy', 'octoprint.py'), 'octoprint')
+        self._register(self.proxy_module, 'octoprint', self.proxy)
+        for kind, functions in (('_modules', self.salt), ('_states', self.states), ('_beacons', self.beacons)):
+            for path in sorted(glob.glob(os.path.join(ROOT, kind, '*.py'))):
+                module = self._load(path, os.path.basename(path)[:-3])
+                name = getattr(module, '__virtualname__', os.path.basename(path)[:-3])
+                virtual = module.__virtual__() if hasattr(module, '__virtual__') else True
+                if isinstance(virtual, tuple) or virtual is False:
+                    self.unavailable['{0}.{1}'.format(kind.strip('_'), name)] = virtual
+                    continue
+                self._register(module, name, functions)
+
+    def _load(self, path, name):
+        '''
+        Import a module from a file, under a name of its own, and pack the
+        dunder dictionaries into it
+        '''
+        spec = importlib.util.spec_from_file_location(
+            'octosalt_bench.{0}.{1}'.format(os.path.basename(os.path.dirname(path)).strip('_'), name),
+            path,
+        )
+        module = importlib.util.module_from_spec(spec)
+        module.__opts__ = self.opts
+        module.__pillar__ = self.opts['pillar']
+        module.__grains__ = {}
+        module.__context__ = self.context
+        module.__salt__ = self.salt
+        module.__proxy__ = self.proxy
+        module.__utils__ = self.utils
+        spec.loader.exec_module(module)
+        return module
+
+    @staticmethod
+    def _register(module, name, functions):
+        '''
+        Add the public functions of a module, under their aliases
+        '''
+        aliases = getattr(module, '__func_alias__', {})
+        for attr, value in vars(module).items():
+            if attr.startswith('_') or not isinstance(value, types.FunctionType):
+                continue
+            if value.__module__ != module.__name__:
+                continue
+            functions['{0}.{1}'.format(name, aliases.get(attr, attr))] = value
+
+    def start(self):
+        '''
+        Initialize the proxy, as the proxy minion does when it starts
+        '''
+        self.proxy_module.init(self.opts)
+
+    def stop(self):
+        '''
+        Shut the proxy down, closing its connections and background threads
+        '''
+        self.proxy_module.shutdown(self.opts)
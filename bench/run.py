@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark the OctoSalt modules against a fake OctoPrint server
+
+Every function of the execution modules, states and beacons is called through
+a stand-in for Salt's loader, against the in-process server from
+``fake_octoprint.py``. For each function, the latency percentiles of its
+calls, the HTTP requests and bytes each call cost, and the peak memory
+allocated by one call are reported. Salt must be installed; NumPy is needed
+for the ``octo_gcode`` functions, and websocket-client for the push API.
+
+.. code-block:: bash
+
+    python bench/run.py
+    python bench/run.py --latency 0.02 --size 500 --printers 10 'octo_file.*'
+    python bench/run.py --json before.json
+    python bench/run.py --baseline before.json
+
+With ``--baseline``, the results are compared with those saved by an earlier
+run with ``--json``, and the exit status is 1 if any function has become
+slower by more than ``--threshold`` percent, or now sends more requests.
+
+Peak memory is measured with ``tracemalloc``, which sees the whole process,
+so it includes what the fake server allocates to answer the call.
+'''
+
+# Import python libs
+from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
+import argparse
+import collections
+import fnmatch
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_octoprint  # pylint: disable=wrong-import-position
+import loader  # pylint: disable=wrong-import-position
+
+# Functions which can't be run against the fake server, and why
+SKIP = {}
+
+PRINTER_PROFILE = {
+    'id': '_default',
+    'name': '_default',
+    'model': 'Bench Printer',
+    'color': 'default',
+    'heatedBed': True,
+}
+
+
+def scenarios(env):
+    '''
+    Return the calls to benchmark, by name, as a function and its arguments.
+    Modules are named as on the command line, states and beacons are
+    prefixed with ``state:`` and ``beacon:``.
+    '''
+    gcode = env['gcode']
+    printer = env['printer']
+    ret = collections.OrderedDict()
+
+    def add(name, *args, **kwargs):
+        ret[name] = (args, kwargs)
+
+    add('octoprint.status')
+    add('octoprint.status[max_age=0]', max_age=0)
+    add('octoprint.version')
+    add('octoprint.connection')
+    add('octoprint.connect', port='/dev/ttyACM0', baudrate=115200)
+    add('octoprint.disconnect')
+    add('octoprint.start')
+    add('octoprint.stop')
+    add('octoprint.restart')
+    add('octoprint.pause')
+    add('octoprint.resume')
+    add('octoprint.job_status')
+    add('octoprint.printers')
+    add('octoprint.ping')
+    add('octoprint.breaker')
+    add('octoprint.cache_stats')
+    add('octoprint.cache_clear', '/api/version')
+    add('octoprint.metrics')
+    add('octoprint.farm_status')
+    add('octoprint.send_commands', gcode, batch_size=500)
+    add('octoprint.wait_for_state', 'Operational')
+    add('octoprint.wait_for_temperature', 'tool0', target=21, tolerance=5)
+    add('octoprint.telemetry')
+    add('octoprint.telemetry[start=-1d]', start='-1d', resolution=300)
+
+    add('octo_file.list')
+    add('octo_file.stat', 'local/folder000/part0000.gcode')
+    add('octo_file.exists', 'local/folder000/part0000.gcode')
+    add('octo_file.remove', 'local/bench/bench.gcode')
+    add('octo_file.readdir', 'local/folder000')
+    add('octo_file.upload', gcode, 'local/bench/bench.gcode', dedup=False)
+    add('octo_file.upload[dedup]', gcode, 'local/bench/bench.gcode')
+    add('octo_file.upload_many', [gcode], 'local/bench', dedup=False)
+    add('octo_file.distribute', gcode, 'local/bench/bench.gcode', dedup=False)
+    add('octo_file.remove_many', ['local/folder000/part0000.gcode'])
+    add('octo_file.readdir_many', ['local/folder000', 'local/folder001'])
+    add('octo_file.local_hash', gcode)
+
+    add('octo_gcode.analyze', gcode)
+    add('octo_gcode.minify', gcode, dest=os.path.join(env['tmp'], 'minified.gcode'))
+
+    add('octo_printer.list')
+    add('octo_printer.add_profile', {'profile': dict(PRINTER_PROFILE, id='bench', name='bench')})
+    add('octo_printer.update_profile', '_default', {'profile': {'name': 'Bench'}})
+    add('octo_printer.delete_profile', 'bench')
+
+    add('octo_queue.add', gcode, volume='50,50,20')
+    add('octo_queue.list')
+    add('octo_queue.remove', status='done')
+    add('octo_queue.cleared', printer)
+    add('octo_queue.dispatch', test=True)
+
+    add('octo_slicer.list')
+    add('octo_slicer.get_profile', 'cura', 'profile000')
+    add('octo_slicer.save_profile', 'cura', 'bench', {'displayName': 'bench', 'data': {'layer_height': 0.2}})
+    add('octo_slicer.delete_profile', 'cura', 'bench')
+
+    add('user.list_users')
+    add('user.add', 'bench', 'secret')
+    add('user.delete', 'bench')
+    add('user.getent')
+    add('user.info', 'user000')
+
+    add('state:octoprint.wait_for_state', 'Operational', printer=printer)
+    add('state:octoprint.wait_for_temperature', 'bed', target=20, printer=printer)
+    add('state:octo_file.present', 'local/bench/present.gcode', gcode, printer=printer)
+    add('state:octo_printer.profile', '_default', profile=PRINTER_PROFILE, printer=printer)
+    add('state:octo_slicer.profile', 'profile000', 'cura',
+        profile={'displayName': 'profile000', 'data': {'layer_height': 0.2}}, printer=printer)
+
+    add('beacon:octoprint.beacon', [{'interval': 5}])
+    add('beacon:octoprint.validate', [{'interval': 5}])
+    add('beacon:octoprint_job.beacon', [{'interval': 5}])
+    add('beacon:octoprint_job.validate', [{'interval': 5}])
+    add('beacon:octoprint_push.validate', [{'interval': 5}])
+
+    # The first call opens the push socket, whose messages then arrive in
+    # the background, so these come last
+    add('octoprint.push_messages', printer=printer)
+    add('beacon:octoprint_push.beacon', [{'interval': 5}])
+    return ret
+
+
+def _function(salt, name):
+    '''
+    Return the loaded function for a scenario name
+    '''
+    name = name.split('[')[0]
+    if name.startswith('state:'):
+        return salt.states[name[len('state:'):]]
+    if name.startswith('beacon:'):
+        return salt.beacons[name[len('beacon:'):]]
+    return salt.salt[name]
+
+
+def _percentile(times, percent):
+    '''
+    Return a percentile of a sorted list by the nearest rank
+    '''
+    if not times:
+        return None
+    rank = max(0, min(len(times) - 1, int(round(percent / 100.0 * len(times) + 0.5)) - 1))
+    return times[rank]
+
+
+def _gcode(path, lines):
+    '''
+    Write a synthetic G-code file of about the given number of lines
+    '''
+    with open(path, 'w') as fh_:
+        fh_.write('; generated for benchmarking\nG21\nG90\nM82\nM104 S210\nM140 S60\nG28\n')
+        layer, e_pos = 0, 0.0
+        for number in range(lines):
+            if number % 500 == 0:
+                layer += 1
+                fh_.write(';LAYER:{0}\nG1 Z{1:.3f} F7800\n'.format(layer, layer * 0.2))
+            e_pos += 0.03
+            fh_.write('G1 X{0:.3f} Y{1:.3f} E{2:.5f} F1800\n'.format(
+                50 + (number * 7 % 100) / 2.0, 50 + (number * 13 % 100) / 2.0, e_pos))
+        fh_.write('M104 S0\nM140 S0\nM84\n')
+
+
+def run(args):
+    '''
+    Run the benchmark, returning the results by scenario name
+    '''
+    server = fake_octoprint.FakeOctoPrint(
+        latency=args.latency,
+        size=args.size,
+        push_interval=args.push_interval,
+    )
+    url = server.start()
+    tmp = tempfile.mkdtemp(prefix='octosalt-bench-')
+
+    # The background poller would otherwise send requests in the middle of
+    # whichever function happens to be running
+    pillar = {'proxy': {
+        'proxytype': 'octoprint',
+        'url': url,
+        'apikey': 'BENCH',
+        'poll_interval': 3600,
+        'poll_interval_printing': 3600,
+        'poll_interval_waiting': 3600,
+        'telemetry': True,
+    }}
+    if args.printers > 1:
+        pillar['proxy']['printers'] = dict(
+            ('bench{0:02d}'.format(number), {'url': url, 'apikey': 'BENCH'})
+            for number in range(args.printers)
+        )
+    opts = {
+        'id': 'octobench',
+        'test': False,
+        'cachedir': os.path.join(tmp, 'cache'),
+        'pillar': pillar,
+    }
+    salt = loader.Loader(opts)
+    salt.start()
+
+    env = {
+        'tmp': tmp,
+        'gcode': os.path.join(tmp, 'bench.gcode'),
+        'printer': 'bench00' if args.printers > 1 else None,
+    }
+    _gcode(env['gcode'], args.gcode_lines)
+
+    calls = scenarios(env)
+    known = set(name.split('[')[0] for name in calls) | set(SKIP)
+    found = set(salt.salt)
+    found.update('state:{0}'.format(name) for name in salt.states)
+    found.update('beacon:{0}'.format(name) for name in salt.beacons)
+
+    results = collections.OrderedDict()
+    try:
+        for name, (call_args, call_kwargs) in calls.items():
+            if args.patterns and not any(fnmatch.fnmatch(name, pattern) for pattern in args.patterns):
+                continue
+            try:
+                func = _function(salt, name)
+            except KeyError:
+                results[name] = {'error': 'not loaded'}
+                continue
+            results[name] = _measure(server, func, call_args, call_kwargs, args.iterations)
+    finally:
+        salt.stop()
+        server.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    for name in sorted(found - known):
+        results[name] = {'error': 'no benchmark scenario'}
+    for name in sorted(SKIP):
+        if not args.patterns or any(fnmatch.fnmatch(name, pattern) for pattern in args.patterns):
+            results[name] = {'skipped': SKIP[name]}
+    for name, reason in salt.unavailable.items():
+        results[name] = {'error': 'not loaded: {0}'.format(reason)}
+    return results
+
+
+def _measure(server, func, args, kwargs, iterations):
+    '''
+    Call a function once, then repeatedly, returning the timings of the
+    repeated calls, the HTTP requests and bytes per call, and the peak memory
+    allocated by one call
+    '''
+    # The first call fills the proxy's caches, and is reported on its own
+    start = time.perf_counter()
+    before = server.counters()
+    try:
+        func(*args, **kwargs)
+    except Exception as exc:  # pylint: disable=broad-except
+        return {'error': '{0}: {1}'.format(type(exc).__name__, exc)}
+    first = time.perf_counter() - start
+    first_requests = server.counters()['requests'] - before['requests']
+
+    times = []
+    error = None
+    before = server.counters()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        try:
+            func(*args, **kwargs)
+        except Exception as exc:  # pylint: disable=broad-except
+            error = '{0}: {1}'.format(type(exc).__name__, exc)
+            break
+        times.append(time.perf_counter() - start)
+    after = server.counters()
+    calls = len(times) or 1
+
+    peak = None
+    if error is None:
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+        except Exception:  # pylint: disable=broad-except
+            pass
+        finally:
+            tracemalloc.stop()
+
+    times.sort()
+    ret = {
+        'calls': len(times),
+        'first_ms': _ms(first),
+        'first_requests': first_requests,
+        'p50_ms': _ms(_percentile(times, 50)),
+        'p90_ms': _ms(_percentile(times, 90)),
+        'p99_ms': _ms(_percentile(times, 99)),
+        'max_ms': _ms(times[-1] if times else None),
+        'requests_per_call': round((after['requests'] - before['requests']) / float(calls), 2),
+        'bytes_out_per_call': int((after['bytes_in'] - before['bytes_in']) / calls),
+        'bytes_in_per_call': int((after['bytes_out'] - before['bytes_out']) / calls),
+        'peak_kib': None if peak is None else round(peak / 1024.0, 1),
+    }
+    if error is not None:
+        ret['error'] = error
+    return ret
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+COLUMNS = (
+    ('first_ms', 'first ms'),
+    ('first_requests', 'first req'),
+    ('p50_ms', 'p50 ms'),
+    ('p90_ms', 'p90 ms'),
+    ('p99_ms', 'p99 ms'),
+    ('max_ms', 'max ms'),
+    ('requests_per_call', 'req/call'),
+    ('bytes_out_per_call', 'sent B'),
+    ('bytes_in_per_call', 'recv B'),
+    ('peak_kib', 'peak KiB'),
+)
+
+
+def report(results, out=sys.stdout):
+    '''
+    Print the results as a table
+    '''
+    width = max([len(name) for name in results] + [8])
+    out.write('{0:<{1}}'.format('function', width))
+    for _, title in COLUMNS:
+        out.write(' {0:>10}'.format(title))
+    out.write('\n')
+    for name, result in results.items():
+        out.write('{0:<{1}}'.format(name, width))
+        if 'skipped' in result or 'calls' not in result:
+            out.write(' skipped: {0}\n'.format(result['skipped']) if 'skipped' in result
+                      else ' error: {0}\n'.format(result['error']))
+            continue
+        for key, _ in COLUMNS:
+            value = result[key]
+            out.write(' {0:>10}'.format('-' if value is None else value))
+        if 'error' in result:
+            out.write('  error: {0}'.format(result['error']))
+        out.write('\n')
+    out.write('peak RSS: {0} KiB\n'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def compare(results, baseline, threshold, out=sys.stdout):
+    '''
+    Print the functions which have regressed since the baseline, returning
+    how many there are
+    '''
+    regressions = 0
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old or old.get('p50_ms') is None or result.get('p50_ms') is None:
+            continue
+        slower = result['p50_ms'] - old['p50_ms']
+        reasons = []
+        # Sub-millisecond noise is not worth failing over
+        if slower > 0.1 and slower > old['p50_ms'] * threshold / 100.0:
+            reasons.append('p50 {0} ms -> {1} ms'.format(old['p50_ms'], result['p50_ms']))
+        # Writes wake the proxy's poller, whose requests land in or out of
+        # the measured calls, so only a whole extra request counts
+        if result['requests_per_call'] >= old['requests_per_call'] + 0.5:
+            reasons.append('requests/call {0} -> {1}'.format(
+                old['requests_per_call'], result['requests_per_call']))
+        if reasons:
+            regressions += 1
+            out.write('REGRESSION {0}: {1}\n'.format(name, '; '.join(reasons)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the OctoSalt modules against a fake OctoPrint')
+    parser.add_argument('patterns', nargs='*', help='only run the functions which match these globs')
+    parser.add_argument('--iterations', type=int, default=50, help='calls per function (default: 50)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the server waits before answering')
+    parser.add_argument('--size', type=int, default=50, help='entries in each listing the server returns')
+    parser.add_argument('--printers', type=int, default=1, help='printers on the proxy; more than 1 is a farm')
+    parser.add_argument('--push-interval', type=float, default=0.01,
+                        help='seconds between the push messages the server sends (default: 0.01)')
+    parser.add_argument('--gcode-lines', type=int, default=20000, help='lines in the G-code file used')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--baseline', help='compare with the results written by an earlier --json run')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='percent a p50 may grow before it counts as a regression (default: 20)')
+    args = parser.parse_args(argv)
+
+    settings = {
+        'latency': args.latency,
+        'size': args.size,
+        'printers': args.printers,
+        'gcode_lines': args.gcode_lines,
+        'push_interval': args.push_interval,
+    }
+    results = run(args)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as fh_:
+            json.dump({'settings': settings, 'results': results}, fh_, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fh_:
+            baseline = json.load(fh_)
+        if baseline['settings'] != settings:
+            sys.stdout.write('WARNING: the baseline was run with {0}\n'.format(baseline['settings']))
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,62 @@
 # -*- coding: utf-8 -*-
 '''
 Beacon for OctoPrint
+
+Fires the job status from ``/api/job``. Only the fields which have changed
+since the last event are sent, so an idle printer stays quiet.
+
+.. code-block:: yaml
+
+    beacons:
+      octoprint_job:
+        - interval: 5
+        - min_interval: 30
+        - thresholds:
+            progress.completion: 1
+        - flatten: True
+
+interval
+    How often, in seconds, to check the job status
+
+min_interval
+    The minimum number of seconds between two events. Changes which happen
+    in the meantime are sent with the next event. Defaults to ``0``.
+
+thresholds
+    Minimum change needed before a numeric field counts as changed, by
+    dotted field name. Shell-style wildcards may be used. Defaults to
+    ``progress.completion: 1``, ``progress.printTime: 60`` and
+    ``progress.printTimeLeft: 60``.
+
+flatten
+    Send changed fields as a flat dictionary of dotted field names, instead
+    of the nested structure used by OctoPrint. Defaults to ``False``.
+
+delta
+    Set to ``False`` to send the full job status on every interval
+
+max_age
+    How old, in seconds, the job status may be. By default, the job status
+    last fetched by the proxy's background poller is used.
 '''
 
 # Import python libs
 from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
-import json
 import logging
 
 # Import salt libs
-import salt.utils.http
+import salt.loader
 
 __virtualname__ = 'octoprint_job'
 
 log = logging.getLogger(__name__)
 
+DEFAULT_THRESHOLDS = {
+    'progress.completion': 1,
+    'progress.printTime': 60,
+    'progress.printTimeLeft': 60,
+}
+
 
 def __virtual__():
     '''
@@ -25,24 +67,37 @@ def __virtual__():
     return (False, 'The OctoPrint modules cannot be loaded: proxy is not configured.')
 
 
+def _utils():
+    '''
+    Return the utility modules. Salt does not pack ``__utils__`` into
+    beacons, so they are loaded once and kept in the context.
+    '''
+    utils = globals().get('__utils__')
+    if utils is None:
+        if 'octosalt.utils' not in __context__:
+            __context__['octosalt.utils'] = salt.loader.utils(__opts__, context=__context__)
+        utils = __context__['octosalt.utils']
+    return utils
+
+
 def validate(config):
     '''
     Validate configuration
     '''
-    return True, 'Valid beacon configuration'
+    return _utils()['octosalt.beacon_validate'](config, __virtualname__)
 
 
 def beacon(config):
     '''
-    Return printer status
-    '''
-    url = '{0}/api/job'.format(__opts__['pillar']['proxy']['url'])
-    data = salt.utils.http.query(
-        url,
-        'GET',
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
-    return [data]
+    Return the job status fields which have changed. On a farm proxy, an
+    event is sent for each printer, tagged with the name of the printer.
+    '''
+    return _utils()['octosalt.beacon_events'](
+        config,
+        __virtualname__,
+        DEFAULT_THRESHOLDS,
+        __salt__['octoprint.job_status'],
+        __salt__['octoprint.printers'](),
+        'printers' in __opts__['pillar']['proxy'],
+        __context__,
+    )
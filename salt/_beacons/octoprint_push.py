@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''
+Beacon for OctoPrint's push API
+
+Instead of polling the REST API, this beacon uses the push connection held
+by the proxy, which OctoPrint sends status updates and events over as soon
+as they happen. Messages are queued by the proxy between intervals and fired
+on the next one, tagged with their type, e.g.
+``salt/beacon/octominion/octoprint_push/current`` or
+``salt/beacon/octominion/octoprint_push/event/PrinterStateChanged``. On a
+farm proxy, the name of the printer comes first, e.g.
+``salt/beacon/octofarm/octoprint_push/prusa01/current``.
+
+Requires the ``websocket-client`` library on the proxy host.
+
+.. code-block:: yaml
+
+    beacons:
+      octoprint_push:
+        - interval: 1
+        - types:
+            - current
+            - event
+        - coalesce: True
+
+types
+    Message types to fire. Defaults to ``current`` and ``event``; other
+    types sent by OctoPrint include ``connected``, ``history``,
+    ``slicingProgress`` and ``plugin``.
+
+coalesce
+    Only fire the latest ``current`` message of each interval, since each
+    one replaces the last. Defaults to ``True``.
+'''
+
+# Import python libs
+from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
+import logging
+
+# Import salt libs
+import salt.loader
+
+__virtualname__ = 'octoprint_push'
+
+log = logging.getLogger(__name__)
+
+
+def __virtual__():
+    '''
+    Only load the module if proxy configuration is present
+    '''
+    if __opts__['pillar'].get('proxy', {}).get('proxytype', '') == 'octoprint':
+        return True
+    return (False, 'The OctoPrint modules cannot be loaded: proxy is not configured.')
+
+
+def _utils():
+    '''
+    Return the utility modules. Salt does not pack ``__utils__`` into
+    beacons, so they are loaded once and kept in the context.
+    '''
+    utils = globals().get('__utils__')
+    if utils is None:
+        if 'octosalt.utils' not in __context__:
+            __context__['octosalt.utils'] = salt.loader.utils(__opts__, context=__context__)
+        utils = __context__['octosalt.utils']
+    return utils
+
+
+def validate(config):
+    '''
+    Validate configuration
+    '''
+    types = _utils()['octosalt.beacon_config'](config).get('types', [])
+    if not isinstance(types, list):
+        return False, 'Types for the octoprint_push beacon must be a list'
+    return True, 'Valid beacon configuration'
+
+
+def beacon(config):
+    '''
+    Return the messages pushed by OctoPrint since the last interval. On a
+    farm proxy, each tag is prefixed with the name of the printer.
+    '''
+    _conf = _utils()['octosalt.beacon_config'](config)
+    types = _conf.get('types', ['current', 'event'])
+    coalesce = _conf.get('coalesce', True)
+    farm = 'printers' in __opts__['pillar']['proxy']
+
+    ret = []
+    for printer in __salt__['octoprint.printers']():
+        events = []
+        current = None
+        for message in __salt__['octoprint.push_messages'](printer=printer):
+            for kind, data in message.items():
+                if kind not in types:
+                    continue
+                if kind == 'event':
+                    events.append({
+                        'tag': 'event/{0}'.format(data.get('type')),
+                        'data': data.get('payload') or {},
+                    })
+                elif kind == 'current' and coalesce:
+                    current = data
+                else:
+                    events.append({'tag': kind, 'data': data})
+        if current is not None:
+            events.append({'tag': 'current', 'data': current})
+        if farm:
+            for event in events:
+                event['tag'] = '{0}/{1}'.format(printer, event['tag'])
+        ret.extend(events)
+    return ret
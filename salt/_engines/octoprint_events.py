@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+'''
+Engine which forwards OctoPrint events to the Salt event bus
+
+OctoPrint can run a command for each of its events. Using ``salt-call`` as
+that command starts a full Salt process on the printer for every event. This
+engine instead listens on the hosting minion for events sent with a cheap
+command such as ``curl``, and forwards them to the master in batches, using
+the same ``octoprint/<type>/<event>`` tags as ``salt-call`` would.
+
+The ``events-engine.yaml`` file included with OctoSalt contains OctoPrint
+event subscriptions which post to this engine.
+
+.. code-block:: yaml
+
+    engines:
+      - octoprint_events:
+          host: 0.0.0.0
+          port: 8765
+          udp_port: 8765
+          unix_socket: /var/run/salt/octoprint_events.sock
+          batch_interval: 1
+          batch_size: 100
+
+host
+    The address to listen on. Defaults to ``0.0.0.0``.
+
+port
+    The TCP port to accept HTTP POSTs on, to ``/octoprint/<type>/<event>``,
+    with the event data as a JSON body. Defaults to ``8765``. Set to ``None``
+    to disable.
+
+udp_port
+    An optional UDP port to accept datagrams on, each containing the tag and
+    the JSON event data separated by a space.
+
+unix_socket
+    An optional path to a Unix datagram socket, which accepts the same
+    datagrams as ``udp_port``.
+
+batch_interval
+    How long, in seconds, to collect events before forwarding them.
+    Defaults to ``1``.
+
+batch_size
+    The largest number of events to forward at once. Defaults to ``100``.
+
+.. warning:: Unauthenticated endpoint
+
+    Anything which can reach the listener can fire ``octoprint/`` events.
+    Bind it to an address which only the printers can reach.
+'''
+
+# Import python libs
+from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
+import http.server
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+# Import salt libs
+import salt.utils.event
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'octoprint_events'
+
+
+def __virtual__():
+    return __virtualname__
+
+
+class _EventQueue(object):
+    '''
+    Collects events from the listeners until they are forwarded
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def put(self, tag, data):
+        '''
+        Queue an event, if its tag is in the ``octoprint/`` namespace
+        '''
+        tag = tag.strip('/')
+        if not tag.startswith('octoprint/') or len(tag.split('/')) != 3:
+            log.warning('Ignoring OctoPrint event with invalid tag: %s', tag)
+            return False
+        with self.lock:
+            self.events.append({'tag': tag, 'data': data})
+        return True
+
+    def take(self, size):
+        '''
+        Remove and return up to ``size`` events
+        '''
+        with self.lock:
+            ret = self.events[:size]
+            del self.events[:size]
+        return ret
+
+
+def _decode(body, source):
+    '''
+    Decode the data posted for an event. OctoPrint fills in the placeholders
+    of the command before running it, so the data is not always valid JSON.
+    '''
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = {'status': body}
+    if not isinstance(data, dict):
+        data = {'status': data}
+    data.setdefault('source', source)
+    return data
+
+
+def _http_server(queue, host, port):
+    '''
+    Return an HTTP server which queues the events POSTed to it
+    '''
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):  # pylint: disable=invalid-name
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode('utf-8', 'replace')
+            tag = self.path.split('?')[0]
+            if queue.put(tag, _decode(body, self.client_address[0])):
+                self.send_response(204)
+            else:
+                self.send_response(400)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            log.debug('octoprint_events: ' + format, *args)
+
+    server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+    server.daemon_threads = True
+    server.allow_reuse_address = True
+    server.server_bind()
+    server.server_activate()
+    return server
+
+
+def _datagram_server(queue, sock):
+    '''
+    Queue the events sent as datagrams to a socket
+    '''
+    while True:
+        datagram, address = sock.recvfrom(65535)
+        tag, _, body = datagram.decode('utf-8', 'replace').partition(' ')
+        source = address[0] if isinstance(address, tuple) else 'local'
+        queue.put(tag, _decode(body, source))
+
+
+def _start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args, name='octoprint-events')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _fire_batch(events):
+    '''
+    Forward a batch of events to the master in a single request
+    '''
+    if __opts__.get('__role') == 'master':
+        with salt.utils.event.get_master_event(__opts__, __opts__['sock_dir'], listen=False) as bus:
+            for event in events:
+                bus.fire_event(event['data'], event['tag'])
+        return
+    with salt.utils.event.get_event('minion', opts=__opts__, listen=False) as bus:
+        bus.fire_event(
+            {'data': None, 'tag': None, 'events': events, 'pretag': None},
+            'fire_master',
+        )
+
+
+def start(host='0.0.0.0',
+          port=8765,
+          udp_port=None,
+          unix_socket=None,
+          batch_interval=1,
+          batch_size=100):
+    '''
+    Listen for OctoPrint events and forward them to the master
+    '''
+    queue = _EventQueue()
+
+    if port:
+        server = _http_server(queue, host, int(port))
+        _start_thread(server.serve_forever)
+        log.info('Listening for OctoPrint events on http://%s:%s', host, port)
+
+    if udp_port:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, int(udp_port)))
+        _start_thread(_datagram_server, queue, sock)
+        log.info('Listening for OctoPrint events on udp://%s:%s', host, udp_port)
+
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(unix_socket)
+        _start_thread(_datagram_server, queue, sock)
+        log.info('Listening for OctoPrint events on %s', unix_socket)
+
+    while True:
+        time.sleep(float(batch_interval))
+        events = queue.take(int(batch_size))
+        while events:
+            log.debug('Forwarding %s OctoPrint events', len(events))
+            try:
+                _fire_batch(events)
+            except Exception as exc:  # pylint: disable=broad-except
+                log.error('Unable to forward OctoPrint events: %s', exc)
+            events = queue.take(int(batch_size))
@@ -1,15 +1,23 @@
 # -*- coding: utf-8 -*-
 '''
 Support for OctoPrint
+
+On a proxy which manages a farm of printers, every function accepts a
+``printer`` argument. See the documentation of the octoprint proxy.
 '''
 
 # Import python libs
 from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
-import json
 import logging
+import os
+import time
 
 # Import salt libs
-import salt.utils.http
+import salt.utils.files
+from salt.exceptions import CommandExecutionError
+
+# Import OctoSalt libs
+from octosalt import fanout as _fanout, response as _response  # pylint: disable=import-error
 
 log = logging.getLogger(__name__)
 
@@ -23,29 +31,29 @@ def __virtual__():
     return (False, 'The OctoPrint modules cannot be loaded: proxy is not configured.')
 
 
-def status():
+@_fanout
+def status(max_age=None, printer=None):
     '''
-    Return OctoPrint status
+    Return OctoPrint status. The status is kept up to date in the background
+    by the proxy; ``max_age`` sets how old, in seconds, it may be before the
+    printer is queried directly.
 
     CLI Example:
 
     .. code-block:: bash
 
         salt octominion octoprint.status
+        salt octominion octoprint.status max_age=0
     '''
-    url = '{0}/api/printer'.format(__opts__['pillar']['proxy']['url'])
-    return salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
+    ret = __proxy__['octoprint.snapshot']('/api/printer', printer, max_age)
+    return _response(ret)
 
 
-def version():
+@_fanout
+def version(max_age=None, printer=None):
     '''
-    Return OctoPrint version
+    Return OctoPrint version. The version is cached by the proxy; ``max_age``
+    sets how old, in seconds, a cached version may be.
 
     CLI Example:
 
@@ -53,53 +61,52 @@ def version():
 
         salt octominion octoprint.status
     '''
-    url = '{0}/api/version'.format(__opts__['pillar']['proxy']['url'])
-    return salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
+    ret = __proxy__['octoprint.query']('/api/version', printer=printer, max_age=max_age)
+    return _response(ret)
 
 
-def connection():
+@_fanout
+def connection(max_age=None, printer=None):
     '''
-    Return OctoPrint connection information
+    Return OctoPrint connection information. The connection information is
+    kept up to date in the background by the proxy; ``max_age`` sets how old,
+    in seconds, it may be before the printer is queried directly.
 
     CLI Example:
 
     .. code-block:: bash
 
         salt octominion octoprint.connection
+        salt octominion octoprint.connection max_age=0
     '''
-    url = '{0}/api/connection'.format(__opts__['pillar']['proxy']['url'])
-    return salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
+    ret = __proxy__['octoprint.snapshot']('/api/connection', printer, max_age)
+    return _response(ret)
 
 
+@_fanout
 def connect(
         port=None,
         baudrate=None,
         printerprofile=None,
         save=False,
         autoconnect=None,
+        wait=False,
+        timeout=60,
+        printer=None,
     ):
     '''
-    Connect OctoPrint to the printer
+    Connect OctoPrint to the printer. With ``wait``, wait up to ``timeout``
+    seconds for the connection to be made, and return the outcome as
+    ``octoprint.wait_for_state`` does.
 
     CLI Example:
 
     .. code-block:: bash
 
         salt octominion octoprint.connection
+        salt octominion octoprint.connect wait=True
     '''
-    url = '{0}/api/connection'.format(__opts__['pillar']['proxy']['url'])
+    since = time.time()
     data = {
         'command': 'connect',
         'save': save,
@@ -117,18 +124,20 @@ def connect(
     if autoconnect:
         data['autoconnect'] = autoconnect
 
-    return salt.utils.http.query(
-        url,
+    ret = __proxy__['octoprint.query'](
+        '/api/connection',
         'POST',
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        data=json.dumps(data),
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
+        data=data,
+        printer=printer,
+    )
+    data = _response(ret, (200, 204))
+    if not wait:
+        return data
+    return _wait_state(['Operational', 'Error', 'Offline after error'], timeout, since, printer, 'Operational')
 
 
-def disconnect():
+@_fanout
+def disconnect(printer=None):
     '''
     Disconnect OctoPrint from printer
 
@@ -138,68 +147,65 @@ def disconnect():
 
         salt octominion octoprint.disconnect
     '''
-    url = '{0}/api/connection'.format(__opts__['pillar']['proxy']['url'])
     data = {'command': 'disconnect'}
-    return salt.utils.http.query(
-        url,
+    ret = __proxy__['octoprint.query'](
+        '/api/connection',
         'POST',
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        data=json.dumps(data),
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
+        data=data,
+        printer=printer,
+    )
+    return _response(ret, (200, 204))
 
 
-def start():
+@_fanout
+def start(wait=False, timeout=86400, printer=None):
     '''
-    Start the loaded print
+    Start the loaded print. With ``wait``, wait up to ``timeout`` seconds
+    (by default, a day) for the print to end, and return its outcome as
+    ``octoprint.wait_for_state`` does, with the final job status in ``job``.
+    ``result`` is True if the print was completed.
 
     CLI Example:
 
     .. code-block:: bash
 
         salt octominion octoprint.start
+        salt octominion octoprint.start wait=True timeout=172800
     '''
-    url = '{0}/api/job'.format(__opts__['pillar']['proxy']['url'])
-    data = salt.utils.http.query(
-        url,
-        'POST',
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey'],
-                     'Content-type': 'application/json'},
-        opts=__opts__,
-        data=json.dumps({'command': 'start'}),
-        status=True,
-    )
-    if int(data.get('status', 0)) == 204 or int(data.get('status', 0)) == 200:
-        return True
-    return False
-
-
-def stop():
+    before = None
+    if wait:
+        # Tells a print which is over before it is ever seen printing apart
+        # from the previous print, which the printer still reports
+        before = __proxy__['octoprint.snapshot']('/api/job', printer, 0).get('dict') or {}
+    since = time.time()
+    accepted = _job_command({'command': 'start'}, printer)
+    if not accepted or not wait:
+        return accepted
+    return _wait_job(since, timeout, printer, before=before)
+
+
+@_fanout
+def stop(wait=False, timeout=60, printer=None):
     '''
-    Stop the current print
+    Stop the current print. With ``wait``, wait up to ``timeout`` seconds
+    for the print to end, as ``octoprint.start`` does.
 
     CLI Example:
 
     .. code-block:: bash
 
         salt octominion octoprint.stop
+        salt octominion octoprint.stop wait=True
     '''
-    url = '{0}/api/job'.format(__opts__['pillar']['proxy']['url'])
-    data = salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        data={'command': 'stop'},
-        status=True,
-    )
-    if int(data.get('status', 0)) == 204 or int(data.get('status', 0)) == 200:
-        return True
-    return False
+    since = time.time()
+    accepted = _job_command({'command': 'cancel'}, printer)
+    if not accepted or not wait:
+        return accepted
+    return _wait_job(since, timeout, printer, started=True)
 
 
-def restart():
+@_fanout
+def restart(printer=None):
     '''
     Restart the current, paused print, from the beginning
 
@@ -209,68 +215,55 @@ def restart():
 
         salt octominion octoprint.stop
     '''
-    url = '{0}/api/job'.format(__opts__['pillar']['proxy']['url'])
-    data = salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        data={'command': 'stop'},
-        status=True,
-    )
-    if int(data.get('status', 0)) == 204 or int(data.get('status', 0)) == 200:
-        return True
-    return False
+    return _job_command({'command': 'restart'}, printer)
 
 
-def pause():
+@_fanout
+def pause(wait=False, timeout=60, printer=None):
     '''
-    Pause the current print
+    Pause the current print. With ``wait``, wait up to ``timeout`` seconds
+    for the print to be paused, as ``octoprint.wait_for_state`` does.
 
     CLI Example:
 
     .. code-block:: bash
 
         salt octominion octoprint.pause
+        salt octominion octoprint.pause wait=True
     '''
-    url = '{0}/api/job'.format(__opts__['pillar']['proxy']['url'])
-    data = salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        data={'command': 'pause', 'action': 'pause'},
-        status=True,
-    )
-    if int(data.get('status', 0)) == 204 or int(data.get('status', 0)) == 200:
-        return True
-    return False
+    since = time.time()
+    accepted = _job_command({'command': 'pause', 'action': 'pause'}, printer)
+    if not accepted or not wait:
+        return accepted
+    return _wait_state(['Paused', 'Operational', 'Offline', 'Error'], timeout, since, printer, 'Paused')
 
 
-def resume():
+@_fanout
+def resume(wait=False, timeout=60, printer=None):
     '''
-    Resume the paused print
+    Resume the paused print. With ``wait``, wait up to ``timeout`` seconds
+    for the print to carry on, as ``octoprint.wait_for_state`` does.
 
     CLI Example:
 
     .. code-block:: bash
 
         salt octominion octoprint.resume
+        salt octominion octoprint.resume wait=True
     '''
-    url = '{0}/api/job'.format(__opts__['pillar']['proxy']['url'])
-    data = salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        data={'command': 'pause', 'action': 'resume'},
-        status=True,
-    )
-    if int(data.get('status', 0)) == 204 or int(data.get('status', 0)) == 200:
-        return True
-    return False
+    since = time.time()
+    accepted = _job_command({'command': 'pause', 'action': 'resume'}, printer)
+    if not accepted or not wait:
+        return accepted
+    return _wait_state(['Printing', 'Operational', 'Offline', 'Error'], timeout, since, printer, 'Printing')
 
 
-def job_status():
+@_fanout
+def job_status(max_age=None, printer=None):
     '''
-    Return OctoPrint job status
+    Return OctoPrint job status. The job status is kept up to date in the
+    background by the proxy; ``max_age`` sets how old, in seconds, it may be
+    before the printer is queried directly.
 
     CLI Example:
 
@@ -278,11 +271,530 @@ def job_status():
 
         salt octominion octoprint.status
     '''
-    url = '{0}/api/job'.format(__opts__['pillar']['proxy']['url'])
-    return salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
+    ret = __proxy__['octoprint.snapshot']('/api/job', printer, max_age)
+    return _response(ret)
+
+
+@_fanout
+def send_commands(commands, batch_size=100, rate=None, timeout=None, printer=None):
+    '''
+    Send G-code commands to the printer. ``commands`` is a list of commands,
+    or the path of a file of G-code, local or ``salt://``. Comments and blank
+    lines are left out, and the commands are sent ``batch_size`` at a time,
+    one request per batch; a file is read as it is sent, so it may be of any
+    length.
+
+    rate
+        The most commands to send per second. OctoPrint queues the commands
+        it is sent for the printer, so long routines should be paced to
+        roughly the rate at which the printer works through them.
+
+    timeout
+        Seconds to wait for OctoPrint to accept each batch. Defaults to the
+        ``timeout`` setting of the proxy.
+
+    The return value holds the number of commands and batches sent, the
+    elapsed time, and the commands sent per second. If OctoPrint refuses a
+    batch, for instance because the printer is not connected, no more are
+    sent, ``result`` is False, and ``error`` says why.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octoprint.send_commands '[G28, M420 S1]'
+        salt octominion octoprint.send_commands salt://gcode/level.gcode rate=20
+        salt octofarm octoprint.send_commands /srv/gcode/purge.gcode printer='prusa*'
+    '''
+    if isinstance(commands, str):
+        path = commands
+        if path.startswith('salt://'):
+            path = __salt__['cp.cache_file'](commands)
+            if not path:
+                raise CommandExecutionError('Unable to fetch {0}'.format(commands))
+        elif not os.path.isfile(path):
+            raise CommandExecutionError('{0} does not exist'.format(path))
+        try:
+            with salt.utils.files.fopen(path, 'r', encoding='utf-8', errors='surrogateescape') as fh_:
+                return _send_commands(fh_, batch_size, rate, timeout, printer)
+        except (IOError, OSError) as exc:
+            raise CommandExecutionError('Unable to read {0}: {1}'.format(path, exc))
+    return _send_commands(commands, batch_size, rate, timeout, printer)
+
+
+@_fanout
+def wait_for_state(state, timeout=300, printer=None):
+    '''
+    Wait up to ``timeout`` seconds for the printer to be in ``state``, such
+    as ``Operational``, ``Printing`` or ``Paused``, or in any of a list of
+    states. States are matched by the start of the state text reported by
+    OctoPrint, ignoring case, so ``printing`` also matches ``Printing from
+    SD`` and ``error`` matches any error.
+
+    The wait is woken by updates of the status kept by the proxy, rather
+    than polling the printer on its own; see the octoprint proxy. The return
+    value holds the ``result``, the last known ``state`` and the ``seconds``
+    waited, and an ``error`` if the wait timed out.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octoprint.wait_for_state Operational
+        salt octofarm octoprint.wait_for_state '[Paused, Error]' timeout=60 printer=prusa01
+    '''
+    return _wait_state(state, timeout, None, printer)
+
+
+@_fanout
+def wait_for_temperature(heater='tool0', target=None, tolerance=2, timeout=900, printer=None):
+    '''
+    Wait up to ``timeout`` seconds for a heater, such as ``tool0`` or
+    ``bed``, to come within ``tolerance`` degrees of ``target``. The target
+    defaults to the heater's target temperature, as set on the printer, and
+    may be below the current temperature, to wait for the heater to cool
+    down.
+
+    As with ``octoprint.wait_for_state``, the wait is woken by updates of the
+    status kept by the proxy. The return value holds the ``result``, the
+    ``actual`` and ``target`` temperature, and the ``seconds`` waited.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octoprint.wait_for_temperature
+        salt octominion octoprint.wait_for_temperature bed
+        salt octominion octoprint.wait_for_temperature bed target=35 timeout=1800
+    '''
+    tolerance = float(tolerance)
+    last = {'actual': None, 'target': None, 'heating': None}
+
+    def _reached(data):
+        status = data['/api/printer']
+        if status is None or 'temperature' not in status:
+            return None
+        if heater not in status['temperature']:
+            raise CommandExecutionError('The printer has no heater named {0}'.format(heater))
+        actual = status['temperature'][heater].get('actual')
+        goal = status['temperature'][heater].get('target') if target is None else float(target)
+        last.update(actual=actual, target=goal)
+        if not goal or actual is None:
+            # The target may not have been seen to be set yet
+            return None
+        if last['heating'] is None:
+            last['heating'] = actual < goal
+        if last['heating']:
+            return actual >= goal - tolerance
+        return actual <= goal + tolerance
+
+    began = time.time()
+    done = __proxy__['octoprint.snapshot_wait'](['/api/printer'], _reached, printer, timeout)
+    ret = {
+        'result': bool(done),
+        'heater': heater,
+        'actual': last['actual'],
+        'target': last['target'],
+        'seconds': round(time.time() - began, 3),
+    }
+    if not done and not last['target']:
+        ret['error'] = 'No target temperature was set for {0}'.format(heater)
+    elif not done:
+        ret['error'] = 'Timed out after {0} seconds waiting for {1} to reach {2}'.format(
+            timeout, heater, last['target'])
+    return ret
+
+
+def printers(printer=None):
+    '''
+    Return the names of the printers managed by this proxy. On a farm proxy,
+    ``printer`` may be a glob or a list of names to match.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octofarm octoprint.printers
+        salt octofarm octoprint.printers 'prusa*'
+    '''
+    return __proxy__['octoprint.printers'](printer)
+
+
+@_fanout
+def ping(printer=None):
+    '''
+    Return whether OctoPrint answers. A printer whose breaker is open is not
+    contacted until it is due to be checked again; see ``octoprint.breaker``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octoprint.ping
+    '''
+    return __proxy__['octoprint.probe'](printer)
+
+
+@_fanout
+def breaker(printer=None):
+    '''
+    Return the state of the proxy's circuit breaker for the printer. While
+    it is ``open``, the printer is considered down and calls to it fail at
+    once, until it is ``half-open`` and a single call checks whether the
+    printer is back.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octofarm octoprint.breaker
+    '''
+    return __proxy__['octoprint.breaker'](printer)
+
+
+@_fanout
+def cache_stats(printer=None):
+    '''
+    Return the number of API responses cached by the proxy, and the hits,
+    misses and invalidations of each cached API resource. ``single_flight``
+    counts the ``GET`` requests sent to the printer, and the identical
+    requests which were collapsed into them while they were in flight.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octoprint.cache_stats
+    '''
+    return __proxy__['octoprint.cache_stats'](printer)
+
+
+@_fanout
+def cache_clear(resource=None, printer=None):
+    '''
+    Drop the API responses cached by the proxy, for a single resource such as
+    ``/api/files``, or for all of them
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octoprint.cache_clear
+        salt octominion octoprint.cache_clear /api/files
+    '''
+    return __proxy__['octoprint.cache_clear'](printer, resource)
+
+
+@_fanout
+def metrics(printer=None):
+    '''
+    Return the requests the proxy has sent to OctoPrint, by method and API
+    resource: how many were sent, failed and got each HTTP status, the bytes
+    sent and received, and a histogram of the time they took in seconds,
+    with the ``p50``, ``p90`` and ``p99`` estimated from it.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octoprint.metrics
+        salt octofarm octoprint.metrics printer='prusa*'
+    '''
+    return __proxy__['octoprint.metrics'](printer)
+
+
+@_fanout
+def telemetry(start=None, end=None, resolution=None, channels=None, printer=None):
+    '''
+    Return the temperature, target temperature and job progress history of
+    the printer, as kept by the proxy when its ``telemetry`` setting is
+    enabled. See the octoprint proxy.
+
+    start
+        The start of the period, by default an hour before ``end``. Either
+        a Unix timestamp, or a time relative to now such as ``-90`` or
+        ``-15m``, in seconds, minutes (``m``), hours (``h``) or days
+        (``d``).
+
+    end
+        The end of the period, in the same form. Defaults to now.
+
+    resolution
+        The interval, in seconds, over which the samples are averaged.
+        Defaults to the finest resolution which is kept for ``start``.
+
+    channels
+        A list of channels to return, such as ``tool0.actual``,
+        ``bed.target``, ``progress`` or ``z``. Defaults to all of them.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octoprint.telemetry
+        salt octominion octoprint.telemetry start=-7d resolution=3600 channels='[bed.actual, bed.target]'
+    '''
+    now = time.time()
+    if channels is not None and not isinstance(channels, (list, tuple)):
+        channels = [item.strip() for item in str(channels).split(',') if item.strip()]
+    return __proxy__['octoprint.telemetry'](
+        printer,
+        start=_timestamp(start, now),
+        end=_timestamp(end, now),
+        resolution=resolution,
+        channels=channels,
+    )
+
+
+FARM_ENDPOINTS = {
+    'status': '/api/printer',
+    'job': '/api/job',
+    'connection': '/api/connection',
+    'version': '/api/version',
+}
+
+
+def farm_status(printer=None, include='status,job,connection', timeout=5, concurrency=32):
+    '''
+    Return the status of every printer on a farm proxy at once. Printers are
+    queried concurrently, up to ``concurrency`` at a time, and each has
+    ``timeout`` seconds to answer. Printers which do not answer in time are
+    reported with an ``error``, without holding up the others.
+
+    ``include`` is a comma-separated list (or a list) of ``status``, ``job``,
+    ``connection`` and ``version``. The ``latency`` of each printer is
+    returned in seconds, along with a summary of the whole query.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octofarm octoprint.farm_status
+        salt octofarm octoprint.farm_status 'prusa*' include=job timeout=2
+    '''
+    if not isinstance(include, (list, tuple)):
+        include = [item.strip() for item in str(include).split(',') if item.strip()]
+    unknown = [item for item in include if item not in FARM_ENDPOINTS]
+    if unknown:
+        raise CommandExecutionError(
+            'Unknown farm_status items: {0}. Valid items are: {1}'.format(
+                ', '.join(unknown), ', '.join(sorted(FARM_ENDPOINTS))
+            )
+        )
+
+    began = time.time()
+    results = __proxy__['octoprint.farm_query'](
+        [FARM_ENDPOINTS[item] for item in include],
+        printer,
+        timeout=timeout,
+        concurrency=concurrency,
+    )
+
+    ret = {}
+    for name, result in results.items():
+        if 'error' in result:
+            ret[name] = result
+            continue
+        ret[name] = dict((item, result[FARM_ENDPOINTS[item]]) for item in include)
+        ret[name]['latency'] = result['latency']
+
+    latencies = sorted(result['latency'] for result in ret.values())
+    failed = sorted(name for name, result in ret.items() if 'error' in result)
+    return {
+        'printers': ret,
+        'summary': {
+            'count': len(ret),
+            'failed': failed,
+            'seconds': round(time.time() - began, 3),
+            'latency_max': latencies[-1] if latencies else None,
+            'latency_median': latencies[len(latencies) // 2] if latencies else None,
+        },
+    }
+
+
+@_fanout
+def push_messages(printer=None):
+    '''
+    Return the messages received from OctoPrint's push API since the last
+    call, starting the push connection if needed. Each message is a dict
+    with a single key, such as ``current``, ``history`` or ``event``.
+
+    Messages are only returned once, so calling this while the
+    ``octoprint_push`` beacon is running will take them from the beacon.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octoprint.push_messages
+    '''
+    if not __proxy__['octoprint.push_start'](printer):
+        return []
+    return __proxy__['octoprint.push_messages'](printer)
+
+
+def _job_command(data, printer):
+    '''
+    Issue a job command, returning True if OctoPrint accepted it
+    '''
+    ret = __proxy__['octoprint.query'](
+        '/api/job',
+        'POST',
+        data=data,
+        decode=False,
+        printer=printer,
+    )
+    return int(ret.get('status', 0)) in (200, 204)
+
+
+def _send_commands(lines, batch_size, rate, timeout, printer):
+    '''
+    Send lines of G-code to the printer in batches, pacing them to ``rate``
+    commands per second
+    '''
+    batch_size = max(1, int(batch_size))
+    kwargs = {} if timeout is None else {'timeout': timeout}
+    ret = {'result': True, 'commands': 0, 'batches': 0, 'request_seconds': 0.0}
+    start = time.time()
+
+    def _batches():
+        batch = []
+        for line in lines:
+            line = line.split(';', 1)[0].strip()
+            if not line:
+                continue
+            batch.append(line)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    for batch in _batches():
+        if rate:
+            wait = start + ret['commands'] / float(rate) - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        sent = time.time()
+        response = __proxy__['octoprint.query'](
+            '/api/printer/command',
+            'POST',
+            data={'commands': batch},
+            decode=False,
+            printer=printer,
+            **kwargs
+        )
+        ret['request_seconds'] += time.time() - sent
+        if int(response.get('status', 0)) not in (200, 204):
+            ret['result'] = False
+            ret['error'] = response.get('error') or 'OctoPrint refused the commands: {0} {1}'.format(
+                response.get('status'), response.get('body', '').strip())
+            break
+        ret['commands'] += len(batch)
+        ret['batches'] += 1
+
+    ret['seconds'] = round(time.time() - start, 3)
+    ret['request_seconds'] = round(ret['request_seconds'], 3)
+    ret['commands_per_sec'] = round(ret['commands'] / ret['seconds'], 1) if ret['seconds'] else None
+    return ret
+
+
+# The states of a printer in the middle of a print
+JOB_STATES = ('printing', 'pausing', 'paused', 'resuming', 'cancelling', 'finishing', 'starting', 'sending file')
+
+
+def _wait_state(states, timeout, since, printer, success=None):
+    '''
+    Wait for the job status of the printer to show one of ``states``. The
+    result is True if it shows ``success``, or any of ``states`` if that is
+    not given.
+    '''
+    if not isinstance(states, (list, tuple)):
+        states = [item.strip() for item in str(states).split(',') if item.strip()]
+    wanted = [state.lower() for state in states]
+    last = {'state': None}
+
+    def _reached(data):
+        job = data['/api/job']
+        if job is None:
+            return None
+        last['state'] = job.get('state') or ''
+        return any(last['state'].lower().startswith(state) for state in wanted)
+
+    began = time.time()
+    done = __proxy__['octoprint.snapshot_wait'](['/api/job'], _reached, printer, timeout, since)
+    ret = {
+        'result': bool(done),
+        'state': last['state'],
+        'seconds': round(time.time() - began, 3),
+    }
+    if not done:
+        ret['error'] = 'Timed out after {0} seconds waiting for the printer to be {1}'.format(
+            timeout, ' or '.join(states))
+    elif success is not None:
+        ret['result'] = last['state'].lower().startswith(success.lower())
+    return ret
+
+
+def _wait_job(since, timeout, printer, started=False, before=None):
+    '''
+    Wait for the print on the printer to end, once it has been seen to start
+    unless it is known to have ``started``. The result is True if the print
+    was completed or, for a print known to have started, once it has ended.
+
+    A print which is already over when the job status is next fetched is
+    never seen to start. It counts as completed if the status shows it at
+    100%, with a file or progress which differs from the job status
+    ``before`` it was started.
+    '''
+    last = {'state': None, 'job': None, 'started': started}
+    before = before or {}
+
+    def _ended(data):
+        job = data['/api/job']
+        if job is None:
+            return None
+        last.update(state=job.get('state') or '', job=job)
+        if any(last['state'].lower().startswith(state) for state in JOB_STATES):
+            last['started'] = True
+            return None
+        if last['started']:
+            return True
+        if (job.get('progress') or {}).get('completion') == 100 \
+                and (job.get('job'), job.get('progress')) != (before.get('job'), before.get('progress')):
+            last['started'] = True
+            return True
+        return None
+
+    began = time.time()
+    done = __proxy__['octoprint.snapshot_wait'](['/api/job'], _ended, printer, timeout, since)
+    completion = ((last['job'] or {}).get('progress') or {}).get('completion')
+    ret = {
+        'result': bool(done) and (started or completion == 100),
+        'state': last['state'],
+        'job': last['job'],
+        'seconds': round(time.time() - began, 3),
+    }
+    if not done:
+        ret['error'] = 'Timed out after {0} seconds waiting for the print to end'.format(timeout)
+    return ret
+
+
+# The units of relative times, in seconds
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def _timestamp(value, now):
+    '''
+    Return a Unix timestamp for an absolute or relative time, as taken by
+    ``telemetry``
+    '''
+    if value is None:
+        return None
+    text = str(value).strip().lower()
+    scale = TIME_UNITS.get(text[-1:])
+    try:
+        value = float(text[:-1] if scale else text) * (scale or 1)
+    except ValueError:
+        raise CommandExecutionError('Invalid time: {0}'.format(value))
+    return now + value if value <= 0 or scale else value
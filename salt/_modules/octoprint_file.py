@@ -5,14 +5,30 @@ Support for Octoprint
 
 # Import python libs
 from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
+import collections
+import concurrent.futures
+import fnmatch
+import glob
+import hashlib
+import io
 import json
+import functools
 import logging
-
-# Import 3rd party libs
-import requests
+import mmap
+import os
+import tempfile
+import threading
+import time
+import uuid
 
 # Import salt libs
-import salt.utils.http
+import salt.utils.args
+import salt.utils.atomicfile
+import salt.utils.files
+from salt.exceptions import CommandExecutionError
+
+# Import OctoSalt libs
+from octosalt import fanout as _fanout, response as _response  # pylint: disable=import-error
 
 log = logging.getLogger(__name__)
 
@@ -21,6 +37,22 @@ __func_alias__ = {
     'list_': 'list'
 }
 
+# Guards the local hash cache, which uploads running in threads share
+HASH_CACHE_LOCK = threading.Lock()
+
+
+def _after_fork():
+    '''
+    Give a forked job its own hash cache lock, as a thread of the parent may
+    have held it at the time of the fork
+    '''
+    global HASH_CACHE_LOCK
+    HASH_CACHE_LOCK = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
 
 def __virtual__():
     '''
@@ -31,9 +63,11 @@ def __virtual__():
     return (False, 'The octoprint modules cannot be loaded: proxy is not configured.')
 
 
-def list_():
+@_fanout
+def list_(max_age=None, printer=None):
     '''
-    List all files, and all data (verbose).
+    List all files, and all data (verbose). The list is cached by the proxy;
+    ``max_age`` sets how old, in seconds, a cached list may be.
 
     CLI Examples:
 
@@ -41,18 +75,103 @@ def list_():
 
         salt octominion octo_file.list
     '''
-    url = '{0}/api/files'.format(__opts__['pillar']['proxy']['url'])
+    ret = __proxy__['octoprint.query']('/api/files', printer=printer, max_age=max_age)
+    return _response(ret)
+
+
+@_fanout
+def stat(path, printer=None):
+    '''
+    Return the data OctoPrint holds for a file or folder, searching all
+    subfolders. The path must include one of the following as the location:
+
+        * ``local``: Uses OctoPrint's ``uploads`` folder
+        * ``sdcard``: Uses the printer's SD card
+
+    An empty dict is returned if the path does not exist.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octo_file.stat local/vases/vase.gcode
+    '''
+    return _index(printer)['paths'].get(path.strip('/'), {})
+
+
+@_fanout
+def exists(path, printer=None):
+    '''
+    Return True if a file or folder exists on the printer. The path must
+    include one of the following as the location:
+
+        * ``local``: Uses OctoPrint's ``uploads`` folder
+        * ``sdcard``: Uses the printer's SD card
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octo_file.exists local/vases/vase.gcode
+    '''
+    return path.strip('/') in _index(printer)['paths']
 
-    return salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
 
+def _index(printer):
+    '''
+    Return an index of every file and folder on the printer, by
+    ``location/path`` and by content hash.
 
-def remove(path):
+    The index is rebuilt from a recursive file listing, which is only
+    downloaded again when OctoPrint reports that it has changed since the
+    last request.
+    '''
+    key = 'octo_file.index.{0}'.format(printer)
+    index = __context__.get(key, {})
+    headers = {}
+    if index.get('etag'):
+        headers['If-None-Match'] = index['etag']
+    if index.get('last_modified'):
+        headers['If-Modified-Since'] = index['last_modified']
+
+    data = __proxy__['octoprint.query'](
+        '/api/files',
+        params={'recursive': 'true'},
+        header_dict=headers,
+        printer=printer,
+    )
+    status = int(data.get('status', 0))
+    etag = data.get('headers', {}).get('ETag')
+    # The listing is unchanged, or is the cached response the index came from
+    if index and (status == 304 or etag and etag == index.get('etag')):
+        return index
+    if 'dict' not in data:
+        # Keep serving the last known index if the printer can't be reached
+        return index or {'paths': {}, 'hashes': {}}
+
+    index = {
+        'etag': data['headers'].get('ETag'),
+        'last_modified': data['headers'].get('Last-Modified'),
+        'paths': {},
+        'hashes': {},
+    }
+    items = list(data['dict'].get('files', []))
+    while items:
+        item = items.pop()
+        children = item.get('children')
+        if children:
+            items.extend(children)
+            item = dict((key, value) for key, value in item.items() if key != 'children')
+        path = '{0}/{1}'.format(item.get('origin', 'local'), item['path'])
+        index['paths'][path] = item
+        if item.get('hash'):
+            index['hashes'].setdefault(item['hash'], []).append(path)
+    __context__[key] = index
+    return index
+
+
+@_fanout
+def remove(path, printer=None):
     '''
     Delete a file. The path must include one of the following as the location:
 
@@ -66,18 +185,23 @@ def remove(path):
         salt octominion file.remove <location/path>
         salt octominion file.remove local/vase.gcode
     '''
-    url = '{0}/api/files/{1}'.format(__opts__['pillar']['proxy']['url'], path)
-
-    salt.utils.http.query(
-        url,
+    data = __proxy__['octoprint.query'](
+        '/api/files/{0}'.format(path),
         'DELETE',
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
+        decode=False,
+        printer=printer,
     )
+    if 'error' in data:
+        raise CommandExecutionError(data['error'])
+    if int(data['status']) != 204:
+        raise CommandExecutionError(
+            'Unable to delete {0}: OctoPrint answered HTTP {1}'.format(path, data['status'])
+        )
     return True
 
 
-def readdir(path):
+@_fanout
+def readdir(path, printer=None):
     '''
     Return a list containing the contents of a directory. The path must include
     one of the following as the location:
@@ -93,17 +217,9 @@ def readdir(path):
         salt octominion file.readdir local
         salt octominion file.readdir local/vases
     '''
-    url = '{0}/api/files/{1}'.format(__opts__['pillar']['proxy']['url'], path)
-
-    data = salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
+    data = __proxy__['octoprint.query']('/api/files/{0}'.format(path), printer=printer)
 
-    return _format_dir(data, path)
+    return _format_dir(_response(data), path)
 
 
 def _format_dir(data, path):
@@ -129,7 +245,17 @@ def _format_dir(data, path):
     return sorted(ret)
 
 
-def upload(localfile, remotepath):
+@_fanout
+def upload(localfile,
+           remotepath,
+           select=False,
+           print=False,
+           blocksize=65536,
+           timeout=None,
+           analyze=False,
+           minify=False,
+           dedup=True,
+           printer=None):
     '''
     Uploads a file. The path remote must include one of the following as the
     location:
@@ -137,25 +263,678 @@ def upload(localfile, remotepath):
         * ``local``: Uses OctoPrint's ``uploads`` folder
         * ``sdcard``: Uses the printer's SD card
 
+    The file is streamed to the printer ``blocksize`` bytes at a time, so
+    memory use on the proxy host does not grow with the size of the file.
+    The return value is OctoPrint's response, with a ``transfer`` key holding
+    the number of bytes sent, the elapsed time and the throughput.
+
+    select
+        Select the file for printing once it has been uploaded
+
+    print
+        Start printing the file once it has been uploaded
+
+    timeout
+        Seconds to wait for the printer to connect or respond. Defaults to
+        the ``timeout`` setting of the proxy.
+
+    analyze
+        Analyze a G-code file with ``octo_gcode.analyze`` before uploading
+        it, and return the results in ``analysis``. Requires NumPy.
+
+    minify
+        Upload a copy of a G-code file made smaller by ``octo_gcode.minify``,
+        and return the savings in ``minify``. This is worthwhile for files
+        sent to the ``sdcard``, which are copied over the printer's serial
+        line. Set to a dict to pass options to ``octo_gcode.minify``, e.g.
+        ``{'decimals': 2}``.
+
+    dedup
+        Before sending a file to the ``local`` location, look its hash up in
+        the files already on the printer. If the same content is already at
+        ``remotepath``, nothing is sent; if it is under another path, it is
+        copied there by OctoPrint instead. The action taken is returned in
+        ``dedup``. Set to ``move`` to move the existing file rather than copy
+        it, or to ``False`` to always send the file. Files on the ``sdcard``
+        have no hash, and are always sent.
+
     CLI Examples:
 
     .. code-block:: bash
 
         salt octominion file.upload <remotepath> <location/remotepath>
         salt octominion file.upload /path/to/local/file.gco local/file.gco
+        salt octominion file.upload /path/to/local/file.gco local/file.gco print=True
+        salt octominion file.upload /path/to/local/file.gco local/file.gco analyze=True
+        salt octominion file.upload /path/to/local/file.gco sdcard/file.gco minify=True
+        salt octominion file.upload /path/to/local/file.gco local/file.gco dedup=False
+    '''
+    gcode = not localfile.lower().endswith('.stl')
+    analysis = None
+    if analyze and gcode:
+        analysis = __salt__['octo_gcode.analyze'](localfile)
+
+    minified = None
+    source = localfile
+    if minify and gcode:
+        source, minified = _minify(localfile, minify)
+
+    location, folder, filename = _remote(remotepath, localfile)
+    try:
+        ret = None
+        if dedup and location == 'local':
+            ret = _dedup(
+                _source_hash(source, localfile),
+                '/'.join(filter(None, (folder, filename))),
+                dedup, select, print, printer,
+            )
+        if ret is None:
+            with salt.utils.files.fopen(source, 'rb') as fh_:
+                ret = _send(fh_, location, folder, filename, select, print, blocksize, timeout, printer)
+    finally:
+        if source != localfile:
+            os.remove(source)
+
+    if analysis is not None:
+        ret['analysis'] = analysis
+    if minified is not None:
+        ret['minify'] = minified
+    return ret
+
+
+def _minify(localfile, minify):
+    '''
+    Minify a G-code file into the cache directory, returning the path of the
+    copy, which the caller must remove, and the report of ``octo_gcode.minify``
+    '''
+    cachedir = os.path.join(__opts__['cachedir'], 'octoprint')
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    fd_, source = tempfile.mkstemp(dir=cachedir, suffix=os.path.splitext(localfile)[1])
+    os.close(fd_)
+    try:
+        options = minify if isinstance(minify, dict) else {}
+        minified = __salt__['octo_gcode.minify'](localfile, dest=source, **options)
+    except Exception:
+        os.remove(source)
+        raise
+    del minified['path']
+    return source, minified
+
+
+def _remote(remotepath, localfile):
+    '''
+    Split a ``location/path`` to upload to into its location, folder and
+    filename, which defaults to the name of the local file
     '''
     location = remotepath.split('/')[0]
-    url = '{0}/api/files/{1}'.format(__opts__['pillar']['proxy']['url'], location)
-    filename = localfile.split('/')[-1]
-    if localfile.endswith('.stl'):
+    remotename = '/'.join(remotepath.split('/')[1:])
+    if remotename:
+        folder, _, filename = remotename.rpartition('/')
+    else:
+        folder, filename = '', os.path.basename(localfile)
+    return location, folder, filename
+
+
+def _send(fh_, location, folder, filename, select, print_, blocksize, timeout, printer, buckets=()):
+    '''
+    Stream an open file to the printer, returning OctoPrint's response with
+    the ``transfer`` statistics
+    '''
+    if filename.lower().endswith('.stl'):
         mimetype = 'model/stl'
-    mimetype = 'text/plain'
-
-    ret = requests.post(
-        url,
-        headers={'X-Api-Key': __opts__['pillar']['proxy']['apikey'],},
-        files=[
-            ('file', (filename, open(localfile, 'rb'), mimetype)),
-        ],
-    ).text
-    return json.loads(ret)
+    else:
+        mimetype = 'text/plain'
+
+    fields = []
+    if folder:
+        fields.append(('path', folder))
+    if select:
+        fields.append(('select', 'true'))
+    if print_:
+        fields.append(('print', 'true'))
+
+    body = _MultipartStream(fh_, filename, mimetype, fields, blocksize, buckets)
+    start = time.time()
+    data = __proxy__['octoprint.query'](
+        '/api/files/{0}'.format(location),
+        'POST',
+        data=body,
+        header_dict={'Content-Type': body.content_type},
+        timeout=timeout,
+        printer=printer,
+    )
+    elapsed = time.time() - start
+
+    ret = data.get('dict', {})
+    if 'error' in data:
+        ret['error'] = data['error']
+    elif int(data['status']) not in (200, 201):
+        ret['error'] = 'OctoPrint answered HTTP {0}'.format(data['status'])
+    ret['transfer'] = {
+        'bytes': body.bytes_read,
+        'seconds': round(elapsed, 3),
+        'bytes_per_sec': int(body.bytes_read / elapsed) if elapsed else 0,
+    }
+    return ret
+
+
+def _dedup(digest, remotename, method, select, print_, printer):
+    '''
+    Put a file in place on the printer from content with the same hash which
+    is already there, returning the result in the form of ``upload``, or None
+    if the file must be sent
+    '''
+    start = time.time()
+    index = _index(printer)
+    target = 'local/{0}'.format(remotename)
+    paths = [
+        path for path in index['hashes'].get(digest, [])
+        if path.startswith('local/')
+    ]
+    if not paths:
+        return None
+
+    if target in paths:
+        ret = {'done': True, 'files': {'local': dict(index['paths'][target])}}
+        ret['dedup'] = {'action': 'exists', 'source': target}
+    elif target in index['paths']:
+        # Different content is in the way, and is to be overwritten
+        return None
+    else:
+        command = 'move' if method == 'move' else 'copy'
+        data = __proxy__['octoprint.query'](
+            '/api/files/{0}'.format(paths[0]),
+            'POST',
+            data={'command': command, 'destination': remotename},
+            printer=printer,
+        )
+        if int(data.get('status', 0)) not in (200, 201):
+            log.debug(
+                'Unable to %s %s to %s, sending the file instead: %s',
+                command, paths[0], target, data.get('error', data.get('status')),
+            )
+            return None
+        files = data.get('dict') or {}
+        ret = {'done': True, 'files': {'local': files}}
+        ret['dedup'] = {'action': command, 'source': paths[0]}
+
+    if select or print_:
+        data = __proxy__['octoprint.query'](
+            '/api/files/{0}'.format(target),
+            'POST',
+            data={'command': 'select', 'print': bool(print_)},
+            decode=False,
+            printer=printer,
+        )
+        if int(data.get('status', 0)) not in (200, 204):
+            ret['error'] = data.get('error', 'Unable to select {0}'.format(target))
+
+    elapsed = time.time() - start
+    ret['transfer'] = {'bytes': 0, 'seconds': round(elapsed, 3), 'bytes_per_sec': 0}
+    return ret
+
+
+class _MultipartStream(object):
+    '''
+    A file-like ``multipart/form-data`` body for a single file upload.
+
+    The form fields and the part headers are small and are built up front; the
+    file itself is read from ``fh_`` no more than ``blocksize`` bytes at a
+    time as the HTTP library asks for it. Each block is first taken from every
+    ``_TokenBucket`` in ``buckets``, which limit the rate it is sent at.
+    '''
+    def __init__(self, fh_, filename, mimetype, fields=(), blocksize=65536, buckets=()):
+        boundary = uuid.uuid4().hex
+        self.buckets = buckets
+        self.content_type = 'multipart/form-data; boundary={0}'.format(boundary)
+        self.blocksize = int(blocksize)
+        self.bytes_read = 0
+
+        head = []
+        for name, value in fields:
+            head.append(
+                '--{0}\r\n'
+                'Content-Disposition: form-data; name="{1}"\r\n\r\n'
+                '{2}\r\n'.format(boundary, name, value)
+            )
+        head.append(
+            '--{0}\r\n'
+            'Content-Disposition: form-data; name="file"; filename="{1}"\r\n'
+            'Content-Type: {2}\r\n\r\n'.format(boundary, filename, mimetype)
+        )
+        head = ''.join(head).encode('utf-8')
+        tail = '\r\n--{0}--\r\n'.format(boundary).encode('utf-8')
+
+        fh_.seek(0, os.SEEK_END)
+        self._length = len(head) + fh_.tell() + len(tail)
+        fh_.seek(0)
+        self._parts = [io.BytesIO(head), fh_, io.BytesIO(tail)]
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.blocksize:
+            size = self.blocksize
+        while self._parts:
+            chunk = self._parts[0].read(size)
+            if chunk:
+                for bucket in self.buckets:
+                    bucket.take(len(chunk))
+                self.bytes_read += len(chunk)
+                return chunk
+            self._parts.pop(0)
+        return b''
+
+
+@_fanout
+def upload_many(localfiles, remotepath, workers=None, printer=None, **kwargs):
+    '''
+    Upload several files into one folder on the printer at once. The remote
+    path must include one of the following as the location:
+
+        * ``local``: Uses OctoPrint's ``uploads`` folder
+        * ``sdcard``: Uses the printer's SD card
+
+    ``localfiles`` may be a list of paths or a glob. Up to ``workers`` files
+    (default: the ``pool_size`` of the proxy) are uploaded in parallel. Any
+    other keyword arguments are passed to ``octo_file.upload``.
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt octominion octo_file.upload_many '/srv/parts/*.gcode' local/parts
+        salt octominion octo_file.upload_many '[/srv/a.gcode, /srv/b.gcode]' local
+    '''
+    kwargs = salt.utils.args.clean_kwargs(**kwargs)
+    if not isinstance(localfiles, (list, tuple)):
+        localfiles = sorted(glob.glob(localfiles))
+    remotepath = remotepath.rstrip('/')
+
+    def _upload(localfile):
+        return upload(
+            localfile,
+            '{0}/{1}'.format(remotepath, os.path.basename(localfile)),
+            printer=printer,
+            **kwargs
+        )
+    return _run_many(_upload, localfiles, workers)
+
+
+def distribute(localfile,
+               remotepath,
+               concurrency=8,
+               bandwidth=None,
+               host_bandwidth=None,
+               select=False,
+               print=False,
+               blocksize=65536,
+               timeout=None,
+               minify=False,
+               dedup=True,
+               printer=None):
+    '''
+    Upload one file to many printers on a farm proxy at once. The remote path
+    must include one of the following as the location:
+
+        * ``local``: Uses OctoPrint's ``uploads`` folder
+        * ``sdcard``: Uses the printer's SD card
+
+    The file is mapped into memory once and shared by every upload, which run
+    up to ``concurrency`` at a time. ``bandwidth`` caps the combined rate of
+    all uploads, and ``host_bandwidth`` the rate of each one, in bytes per
+    second. ``select``, ``print``, ``blocksize``, ``timeout``, ``minify`` and
+    ``dedup`` are as for ``octo_file.upload``; a file is minified only once.
+
+    The result of each printer is returned along with the overall timing.
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt octofarm octo_file.distribute /srv/parts/vase.gcode local/vases/vase.gcode
+        salt octofarm octo_file.distribute /srv/parts/vase.gcode local/vase.gcode 'prusa*' bandwidth=2000000
+    '''
+    targets = __proxy__['octoprint.printers'](printer)
+    buckets = []
+    if bandwidth:
+        buckets.append(_TokenBucket(bandwidth))
+
+    minified = None
+    source = localfile
+    if minify and not localfile.lower().endswith('.stl'):
+        source, minified = _minify(localfile, minify)
+
+    location, folder, filename = _remote(remotepath, localfile)
+    try:
+        # Hashed once for every printer, and before the uploads start, so the
+        # hash cache is not updated from many threads
+        digest = None
+        if dedup and location == 'local':
+            digest = _source_hash(source, localfile)
+
+        with salt.utils.files.fopen(source, 'rb') as fh_:
+            if os.fstat(fh_.fileno()).st_size:
+                buffer = mmap.mmap(fh_.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buffer = b''
+
+            def _distribute(name):
+                ret = None
+                if digest is not None:
+                    ret = _dedup(
+                        digest,
+                        '/'.join(filter(None, (folder, filename))),
+                        dedup, select, print, name,
+                    )
+                if ret is None:
+                    limits = list(buckets)
+                    if host_bandwidth:
+                        limits.append(_TokenBucket(host_bandwidth))
+                    ret = _send(
+                        _BufferReader(buffer), location, folder, filename,
+                        select, print, blocksize, timeout, name, limits,
+                    )
+                return ret
+
+            try:
+                ret = _run_many(_distribute, targets, concurrency)
+            finally:
+                if buffer:
+                    buffer.close()
+    finally:
+        if source != localfile:
+            os.remove(source)
+
+    sent = sum(
+        result['transfer']['bytes'] for result in ret['results'].values()
+        if 'transfer' in result
+    )
+    ret['timing']['bytes'] = sent
+    ret['timing']['bytes_per_sec'] = int(sent / ret['timing']['seconds']) if ret['timing']['seconds'] else 0
+    if minified is not None:
+        ret['minify'] = minified
+    return ret
+
+
+class _BufferReader(object):
+    '''
+    A file-like reader with its own position over a buffer which is shared
+    with other readers, such as a memory-mapped file
+    '''
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._pos = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            offset += len(self._buffer)
+        elif whence == os.SEEK_CUR:
+            offset += self._pos
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._buffer) - self._pos
+        chunk = self._buffer[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk
+
+
+class _TokenBucket(object):
+    '''
+    Limit the rate, in bytes per second, at which blocks are sent by one or
+    more threads, allowing bursts of up to a second's worth
+    '''
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, count):
+        '''
+        Take ``count`` tokens, sleeping until the bucket has refilled enough to
+        cover them
+        '''
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            # Tokens are taken on credit, so that threads queue up behind
+            # each other rather than all waking as soon as there are some
+            self.tokens -= count
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+@_fanout
+def remove_many(paths, workers=None, printer=None):
+    '''
+    Delete several files at once. ``paths`` may be a list of paths or a glob
+    which is matched against every file on the printer. The paths must
+    include one of the following as the location:
+
+        * ``local``: Uses OctoPrint's ``uploads`` folder
+        * ``sdcard``: Uses the printer's SD card
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt octominion octo_file.remove_many 'local/parts/*.gcode'
+        salt octominion octo_file.remove_many '[local/a.gcode, local/b.gcode]'
+    '''
+    if not isinstance(paths, (list, tuple)):
+        paths = _glob_remote(paths, printer)
+    return _run_many(functools.partial(remove, printer=printer), paths, workers)
+
+
+@_fanout
+def readdir_many(paths, workers=None, printer=None):
+    '''
+    Return the contents of several directories at once. ``paths`` may be a
+    list of paths or a glob which is matched against every folder on the
+    printer. The paths must include one of the following as the location:
+
+        * ``local``: Uses OctoPrint's ``uploads`` folder
+        * ``sdcard``: Uses the printer's SD card
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt octominion octo_file.readdir_many '[local, local/vases]'
+        salt octominion octo_file.readdir_many 'local/parts/*'
+    '''
+    if not isinstance(paths, (list, tuple)):
+        paths = _glob_remote(paths, printer, folders=True)
+    return _run_many(functools.partial(readdir, printer=printer), paths, workers)
+
+
+def _glob_remote(pattern, printer, folders=False):
+    '''
+    Return the files, or the folders, on the printer which match a glob. As
+    with a shell, wildcards do not match across a ``/``.
+    '''
+    pattern = pattern.strip('/')
+    depth = pattern.count('/')
+    return sorted(
+        path for path, item in _index(printer)['paths'].items()
+        if (item.get('type') == 'folder') is folders
+        and path.count('/') == depth
+        and fnmatch.fnmatchcase(path, pattern)
+    )
+
+
+def _run_many(func, items, workers=None):
+    '''
+    Call ``func`` for each item over a bounded thread pool, returning the
+    result for each item along with the overall timing
+    '''
+    if workers is None:
+        workers = __opts__['pillar']['proxy'].get('pool_size', 4)
+    workers = max(1, min(int(workers), len(items) or 1))
+
+    def _timed(item):
+        start = time.time()
+        try:
+            result = func(item)
+        except Exception as exc:  # pylint: disable=broad-except
+            log.error('OctoPrint file operation on %s failed: %s', item, exc)
+            result = {'error': str(exc)}
+        return result, time.time() - start
+
+    ret = {'results': {}, 'seconds': {}}
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for item, (result, elapsed) in zip(items, pool.map(_timed, items)):
+            ret['results'][item] = result
+            ret['seconds'][item] = round(elapsed, 3)
+    ret['timing'] = {
+        'count': len(items),
+        'failed': len([
+            result for result in ret['results'].values()
+            if isinstance(result, dict) and 'error' in result
+        ]),
+        'workers': workers,
+        'seconds': round(time.time() - start, 3),
+    }
+    return ret
+
+
+def local_hash(path, minify=False):
+    '''
+    Return the SHA1 hash of a file on the hosting minion, in the same form as
+    the ``hash`` which OctoPrint reports for its files.
+
+    Hashes are kept in an on-disk cache, keyed by the path, inode, size and
+    modification time of the file, so an unchanged file is only read once.
+    The least recently used entries are dropped once the cache holds more
+    than ``hash_cache_size`` entries (default: 4096), which may be set in the
+    ``proxy`` pillar.
+
+    minify
+        Return the hash of the copy of a G-code file which ``octo_file.upload``
+        would send with the same ``minify`` argument. Its hash is cached by
+        the file's inode, size and modification time along with the minify
+        options, so an unchanged file is only minified once.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octominion octo_file.local_hash /path/to/local/file.gco
+        salt octominion octo_file.local_hash /path/to/local/file.gco minify=True
+    '''
+    if path.lower().endswith('.stl'):
+        minify = False
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    key = [
+        stat.st_ino,
+        stat.st_size,
+        getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1000000000)),
+    ]
+    name = path
+    if minify:
+        options = minify if isinstance(minify, dict) else {}
+        name = '{0}?minify={1}'.format(path, json.dumps(options, sort_keys=True))
+
+    with HASH_CACHE_LOCK:
+        cache = _hash_cache()
+        entry = cache.get(name)
+        if entry is not None and entry[:3] == key:
+            # The new order is only saved once the entry has drifted into the
+            # older half of the cache, the half which is dropped first, rather
+            # than rewriting the whole cache on every hit
+            older = next(index for index, cached in enumerate(cache) if cached == name) < len(cache) // 2
+            cache.move_to_end(name)
+            if older:
+                _write_hash_cache(cache)
+            return entry[3]
+
+    if minify:
+        source = _minify(path, minify)[0]
+        try:
+            digest = _hash_file(source)
+        finally:
+            os.remove(source)
+    else:
+        digest = _hash_file(path)
+    with HASH_CACHE_LOCK:
+        cache.pop(name, None)
+        cache[name] = key + [digest]
+        size = int(__opts__['pillar']['proxy'].get('hash_cache_size', 4096))
+        while len(cache) > size:
+            cache.popitem(last=False)
+        _write_hash_cache(cache)
+    return digest
+
+
+def _hash_file(path):
+    '''
+    Return the SHA1 hash of a file, reading it in blocks
+    '''
+    blocksize = 65536
+    sha1 = hashlib.sha1()
+    with salt.utils.files.fopen(path, 'rb') as fh_:
+        buffer = fh_.read(blocksize)
+        while buffer:
+            sha1.update(buffer)
+            buffer = fh_.read(blocksize)
+    return sha1.hexdigest()
+
+
+def _source_hash(source, localfile):
+    '''
+    Return the hash of the file to upload in place of ``localfile``. A
+    minified copy only lives for the one upload, so its hash is not cached,
+    where it would push out the hashes of real files.
+    '''
+    if source != localfile:
+        return _hash_file(source)
+    return local_hash(source)
+
+
+def _hash_cache_path():
+    '''
+    Return the location of the local hash cache
+    '''
+    return os.path.join(__opts__['cachedir'], 'octoprint', 'hashes.json')
+
+
+def _hash_cache():
+    '''
+    Return the local hash cache, ordered from least to most recently used
+    '''
+    if 'octo_file.hash_cache' not in __context__:
+        cache = collections.OrderedDict()
+        try:
+            with salt.utils.files.fopen(_hash_cache_path(), 'r') as fh_:
+                cache.update(json.load(fh_))
+        except (IOError, OSError, ValueError):
+            pass
+        __context__['octo_file.hash_cache'] = cache
+    return __context__['octo_file.hash_cache']
+
+
+def _write_hash_cache(cache):
+    '''
+    Save the local hash cache, preserving its LRU order
+    '''
+    path = _hash_cache_path()
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with salt.utils.atomicfile.atomic_open(path, 'w') as fh_:
+            json.dump(list(cache.items()), fh_)
+    except (IOError, OSError) as exc:
+        log.warning('Unable to save the OctoPrint hash cache: %s', exc)
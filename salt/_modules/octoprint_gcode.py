@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+'''
+Analyze and minify G-code files on the hosting minion
+
+OctoPrint analyzes every uploaded file itself, which can take minutes on a
+Raspberry Pi, and states can't make any decision about a file until it is
+done. :py:func:`analyze` computes the same kind of metadata locally, before
+the file is uploaded, reading it once in blocks so that memory use does not
+depend on the size of the file. Each block of lines is parsed with NumPy,
+which must be installed on the minion which hosts the proxy.
+
+:py:func:`minify` shrinks a file before it is uploaded, which matters most for
+files sent to the printer's SD card over its serial line.
+
+Only words separated by whitespace are recognized, as written by all common
+slicers. Arcs are measured as straight lines, and print times do not account
+for acceleration, so they tend to be shorter than the real ones.
+'''
+
+# Import python libs
+from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
+import logging
+import math
+import os
+import time
+
+# Import salt libs
+import salt.utils.files
+from salt.exceptions import CommandExecutionError
+
+# Import 3rd party libs
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'octo_gcode'
+
+# The widest number which is parsed from a word, in characters
+NUMBER_WIDTH = 12
+
+# The commands which are interpreted, by letter and number, along with tool
+# changes such as ``T1``
+MOVES = ('G0', 'G1', 'G2', 'G3')
+COMMANDS = MOVES + ('G4', 'G90', 'G91', 'G92', 'M82', 'M83', 'M104', 'M109', 'M140', 'M190')
+
+# The commands which leave the position of the head alone, other than moves
+MODAL = ('G4', 'G20', 'G21', 'G90', 'G91', 'G92')
+
+# The parameters which are read from the interpreted commands
+PARAMETERS = 'XYZEFSPT'
+
+
+def __virtual__():
+    '''
+    Only load the module if proxy configuration is present
+    '''
+    if __opts__['pillar'].get('proxy', {}).get('proxytype', '') == 'octoprint':
+        return True
+    return (False, 'The OctoPrint modules cannot be loaded: proxy is not configured.')
+
+
+def _code(command):
+    '''
+    Return the numeric code of a command such as ``G1``, as computed by
+    :py:func:`_parse`
+    '''
+    return ord(command[0]) * 1000 + int(command[1:])
+
+
+def _ffill(values, initial):
+    '''
+    Replace each NaN with the last value before it, or with ``initial``
+    '''
+    values = np.concatenate(([initial], values))
+    index = np.where(np.isnan(values), 0, np.arange(len(values)))
+    np.maximum.accumulate(index, out=index)
+    return values[index][1:]
+
+
+def _numbers(data, starts):
+    '''
+    Parse the numbers which start at each of ``starts``. ``data`` must end
+    with ``NUMBER_WIDTH`` bytes of padding.
+    '''
+    rows = np.lib.stride_tricks.as_strided(
+        data,
+        shape=(len(data) - NUMBER_WIDTH, NUMBER_WIDTH),
+        strides=(1, 1),
+        writeable=False,
+    )
+    chars = rows[starts]
+    numeric = ((chars >= 48) & (chars <= 57)) | (chars == 46) | (chars == 45) | (chars == 43)
+    numeric = np.logical_and.accumulate(numeric, axis=1)
+    chars[~numeric] = 0
+    chars[~numeric[:, 0], :3] = np.frombuffer(b'nan', dtype=np.uint8)
+    strings = chars.view('S{0}'.format(NUMBER_WIDTH)).ravel()
+    try:
+        return strings.astype(np.float64)
+    except ValueError:
+        # A malformed number, such as ``1.2.3``; parse them one at a time
+        ret = np.empty(len(strings))
+        for index, string in enumerate(strings):
+            try:
+                ret[index] = float(string)
+            except ValueError:
+                ret[index] = np.nan
+        return ret
+
+
+def _parse(block):
+    '''
+    Parse a block of whole lines of G-code. Return the code of the command
+    on each line, such as ``G1``, and the value of each of ``PARAMETERS`` on
+    each line, or NaN where it is not given. Lines without an interpreted
+    command are left out.
+    '''
+    block = block.upper().replace(b'\t', b' ').replace(b'\r', b' ')
+    data = np.frombuffer(block + b' ' * NUMBER_WIDTH, dtype=np.uint8)
+    size = len(block)
+    newlines = np.flatnonzero(data == 10)
+    semicolons = np.flatnonzero(data == 59)
+
+    # Words are a letter following whitespace, then a number
+    starts = np.concatenate(([0], np.flatnonzero((data == 32) | (data == 10)) + 1))
+    starts = starts[starts < size]
+    letters = data[starts]
+    starts = starts[(letters >= 65) & (letters <= 90)]
+
+    # Comments run from a semicolon to the end of the line
+    lines = np.searchsorted(newlines, starts)
+    line_starts = np.concatenate(([0], newlines + 1))[lines]
+    semicolons = np.concatenate((semicolons, [size]))
+    code = semicolons[np.searchsorted(semicolons, line_starts)] > starts
+    starts = starts[code]
+    lines = lines[code]
+    letters = data[starts].astype(np.int64)
+    values = _numbers(data, starts + 1)
+
+    # The first word on each line is its command
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = lines[1:] != lines[:-1]
+    codes = letters[first] * 1000 + np.nan_to_num(values[first], nan=-1).astype(np.int64)
+    interpreted = np.isin(codes, [_code(command) for command in COMMANDS]) \
+        | (letters[first] == ord('T'))
+    command = np.cumsum(first) - 1
+
+    params = {}
+    for letter in PARAMETERS:
+        column = np.full(len(codes), np.nan)
+        found = (letters == ord(letter)) & ~first
+        column[command[found]] = values[found]
+        params[letter] = column[interpreted]
+    return codes[interpreted], params
+
+
+class _Analysis(object):
+    '''
+    The running totals of an analysis, carried from block to block
+    '''
+    def __init__(self, diameter):
+        self.area = math.pi * (float(diameter) / 2) ** 2
+        self.position = dict((axis, 0.0) for axis in 'XYZE')
+        self.relative = False
+        self.relative_e = False
+        self.feedrate = 1500.0
+        self.tool = 0.0
+        self.lines = 0
+        self.seconds = 0.0
+        self.filament = {}
+        self.layers = set()
+        self.minimum = dict((axis, np.inf) for axis in 'XYZ')
+        self.maximum = dict((axis, -np.inf) for axis in 'XYZ')
+        self.temperatures = {}
+
+    def _mode(self, codes, events, initial):
+        '''
+        Return whether each line is in relative mode, given the codes which
+        switch to absolute and to relative mode
+        '''
+        flags = np.full(len(codes), np.nan)
+        for code, relative in events:
+            flags[codes == _code(code)] = relative
+        return _ffill(flags, initial) > 0
+
+    def _temperature(self, name, value):
+        if np.isfinite(value) and value > self.temperatures.get(name, 0):
+            self.temperatures[name] = float(value)
+
+    def update(self, block):
+        '''
+        Add a block of whole lines to the analysis
+        '''
+        self.lines += block.count(b'\n')
+        codes, params = _parse(block)
+        if not len(codes):
+            return
+
+        moves = np.isin(codes, [_code(command) for command in MOVES])
+        reset = codes == _code('G92')
+        relative = self._mode(codes, (('G90', 0), ('G91', 1)), self.relative)
+        relative_e = self._mode(
+            codes,
+            (('G90', 0), ('G91', 1), ('M82', 0), ('M83', 1)),
+            self.relative_e,
+        )
+        self.relative = bool(relative[-1])
+        self.relative_e = bool(relative_e[-1])
+
+        # A G92 without any axis sets them all to zero
+        bare = reset & np.all([np.isnan(params[axis]) for axis in 'XYZE'], axis=0)
+        positions = {}
+        deltas = {}
+        for axis in 'XYZE':
+            values = params[axis]
+            values[bare] = 0.0
+            given = ~np.isnan(values) & (moves | reset)
+            rel = given & ~reset & (relative_e if axis == 'E' else relative)
+            absolute = given & ~rel
+            offsets = np.cumsum(np.where(rel, values, 0.0))
+            bases = np.full(len(codes), np.nan)
+            bases[absolute] = values[absolute] - offsets[absolute]
+            position = _ffill(bases, self.position[axis]) + offsets
+            previous = np.concatenate(([self.position[axis]], position[:-1]))
+            deltas[axis] = np.where(moves, position - previous, 0.0)
+            positions[axis] = position
+            self.position[axis] = float(position[-1])
+
+        changes = codes // 1000 == ord('T')
+        tools = _ffill(np.where(changes, codes - ord('T') * 1000, np.nan), self.tool)
+        self.tool = float(tools[-1])
+        feedrates = _ffill(np.where(moves, params['F'], np.nan), self.feedrate)
+        self.feedrate = float(feedrates[-1])
+
+        # Extrusion, by the tool selected on each line
+        for tool in np.unique(tools[moves]):
+            used = float(deltas['E'][moves & (tools == tool)].sum())
+            name = 'tool{0}'.format(int(tool))
+            self.filament[name] = self.filament.get(name, 0.0) + used
+
+        # Print time, from the length and feedrate of each move
+        distance = np.sqrt(deltas['X'] ** 2 + deltas['Y'] ** 2 + deltas['Z'] ** 2)
+        distance = np.where(distance > 0, distance, np.abs(deltas['E']))
+        speed = feedrates[moves] / 60
+        self.seconds += float(np.sum(distance[moves][speed > 0] / speed[speed > 0]))
+        dwell = codes == _code('G4')
+        self.seconds += float(np.nansum(params['P'][dwell]) / 1000 + np.nansum(params['S'][dwell]))
+
+        # Size and layers of the printed part, from the extruding moves
+        printing = moves & (deltas['E'] > 0) & ((deltas['X'] != 0) | (deltas['Y'] != 0))
+        if printing.any():
+            for axis in 'XYZ':
+                self.minimum[axis] = min(self.minimum[axis], float(positions[axis][printing].min()))
+                self.maximum[axis] = max(self.maximum[axis], float(positions[axis][printing].max()))
+            self.layers.update(np.unique(np.round(positions['Z'][printing], 3)).tolist())
+
+        hotend = np.isin(codes, [_code('M104'), _code('M109')])
+        for tool, value in zip(np.where(np.isnan(params['T']), tools, params['T'])[hotend],
+                               params['S'][hotend]):
+            self._temperature('tool{0}'.format(int(tool)), value)
+        for value in params['S'][np.isin(codes, [_code('M140'), _code('M190')])]:
+            self._temperature('bed', value)
+
+    def result(self):
+        '''
+        Return the analysis, using the names of OctoPrint's own analysis
+        where there are any
+        '''
+        ret = {
+            'lines': self.lines,
+            'layers': len(self.layers),
+            'estimatedPrintTime': round(self.seconds, 1),
+            'filament': dict(
+                (tool, {
+                    'length': round(length, 2),
+                    'volume': round(length * self.area / 1000, 2),
+                })
+                for tool, length in self.filament.items()
+            ),
+            'temperatures': self.temperatures,
+        }
+        if self.layers:
+            ret['printingArea'] = {}
+            for axis in 'XYZ':
+                ret['printingArea']['min' + axis] = round(self.minimum[axis], 3)
+                ret['printingArea']['max' + axis] = round(self.maximum[axis], 3)
+            ret['dimensions'] = {
+                'width': round(self.maximum['X'] - self.minimum['X'], 3),
+                'depth': round(self.maximum['Y'] - self.minimum['Y'], 3),
+                'height': round(self.maximum['Z'] - self.minimum['Z'], 3),
+            }
+        return ret
+
+
+def analyze(path, diameter=1.75, blocksize=4194304):
+    '''
+    Analyze a G-code file on the hosting minion. Return the number of lines
+    and layers, the estimated print time in seconds, the length (in mm) and
+    volume (in cm³) of filament used by each tool, the highest temperature
+    set for each tool and the bed, and the area covered by the print.
+
+    diameter
+        The diameter of the filament, in mm
+
+    blocksize
+        How many bytes to read and parse at a time
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt octominion octo_gcode.analyze /path/to/file.gcode
+        salt octominion octo_gcode.analyze /path/to/file.gcode diameter=2.85
+    '''
+    if not HAS_NUMPY:
+        raise CommandExecutionError('Analyzing G-code requires numpy, which is not installed')
+
+    start = time.time()
+    analysis = _Analysis(diameter)
+    try:
+        with salt.utils.files.fopen(path, 'rb') as fh_:
+            rest = b''
+            while True:
+                block = fh_.read(int(blocksize))
+                if not block:
+                    break
+                block = rest + block
+                end = block.rfind(b'\n') + 1
+                if not end:
+                    rest = block
+                    continue
+                rest = block[end:]
+                analysis.update(block[:end])
+            if rest:
+                analysis.update(rest + b'\n')
+    except (IOError, OSError) as exc:
+        raise CommandExecutionError('Unable to read {0}: {1}'.format(path, exc))
+
+    ret = analysis.result()
+    ret['analysis_seconds'] = round(time.time() - start, 3)
+    return ret
+
+
+def _number(value, decimals):
+    '''
+    Format a number with at most ``decimals`` decimals and no trailing zeros
+    '''
+    if value.isdigit():
+        return value
+    point = value.find('.')
+    if 0 <= point and len(value) - point - 1 <= decimals and value[-1] not in '0.':
+        return value
+    ret = '{0:.{1}f}'.format(float(value), int(decimals))
+    if '.' in ret:
+        ret = ret.rstrip('0').rstrip('.')
+    if ret == '-0':
+        return '0'
+    return ret
+
+
+def _minify_lines(lines, comments=True, modal=True, decimals=3, e_decimals=5):
+    '''
+    Minify lines of G-code, one at a time. Lines which do nothing are left
+    out.
+    '''
+    position = {}
+    feedrate = None
+    relative = False
+    relative_e = False
+    for line in lines:
+        if comments:
+            line = line.split(';', 1)[0]
+        line = line.strip()
+        if not line:
+            if not comments:
+                yield line
+            continue
+
+        words = line.split()
+        command = words[0].upper()
+        # Line numbered commands are covered by their checksum, so they are
+        # sent unchanged, and the position they leave is not known
+        numbered = command[0] == 'N' and len(words) > 1
+        if numbered:
+            command = words[1].split('*', 1)[0].upper()
+        if command in ('G90', 'G91'):
+            relative = relative_e = command == 'G91'
+        elif command in ('M82', 'M83'):
+            relative_e = command == 'M83'
+        elif command == 'G92':
+            given = [word[0].upper() for word in words[1:]]
+            for axis in 'XYZE':
+                if axis in given or not given:
+                    position.pop(axis, None)
+        elif command[0] == 'T' or command[0] == 'G' and command not in MOVES + MODAL:
+            # Homing, leveling and tool changes move the head on their own
+            position = {}
+            feedrate = None
+
+        if numbered:
+            position = {}
+            feedrate = None
+            yield line
+            continue
+        if command not in MOVES:
+            yield ' '.join(words)
+            continue
+
+        kept = [words[0]]
+        for word in words[1:]:
+            axis = word[0].upper()
+            try:
+                if axis == 'F':
+                    value = _number(word[1:], 0)
+                elif axis == 'E':
+                    value = _number(word[1:], e_decimals)
+                elif axis in 'XYZIJKR':
+                    value = _number(word[1:], decimals)
+                else:
+                    kept.append(word)
+                    continue
+            except ValueError:
+                kept.append(word)
+                continue
+
+            if modal and command in ('G0', 'G1'):
+                if axis == 'F':
+                    if value == feedrate:
+                        continue
+                    feedrate = value
+                elif axis in 'XYZE':
+                    if (relative_e if axis == 'E' else relative):
+                        position.pop(axis, None)
+                        if value == '0':
+                            continue
+                    elif position.get(axis) == value:
+                        continue
+                    else:
+                        position[axis] = value
+            elif axis == 'F':
+                feedrate = value
+            elif axis in 'XYZE':
+                position.pop(axis, None)
+            kept.append(axis + value)
+
+        # A move to where the head already is does nothing
+        if len(kept) > 1 or not modal or command not in ('G0', 'G1'):
+            yield ' '.join(kept)
+
+
+def minify(path, dest=None, comments=True, modal=True, decimals=3, e_decimals=5):
+    '''
+    Write a smaller copy of a G-code file on the hosting minion, and return
+    the size of both files and the time taken. The file is processed one line
+    at a time.
+
+    dest
+        Where to write the minified file. Defaults to ``path`` with ``.min``
+        added before the extension.
+
+    comments
+        Remove comments and blank lines
+
+    modal
+        Leave out feedrates and coordinates of moves which are the same as
+        those of the move before, and moves which do not move at all
+
+    decimals
+        The number of decimals kept in coordinates, which is also the number
+        of decimals understood by most firmware
+
+    e_decimals
+        The number of decimals kept in extrusion lengths
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt octominion octo_gcode.minify /path/to/file.gcode
+        salt octominion octo_gcode.minify /path/to/file.gcode decimals=2
+    '''
+    if dest is None:
+        root, ext = os.path.splitext(path)
+        dest = '{0}.min{1}'.format(root, ext)
+
+    start = time.time()
+    counts = {'lines_in': 0, 'lines_out': 0}
+
+    def _counted(lines):
+        for line in lines:
+            counts['lines_in'] += 1
+            yield line
+
+    try:
+        with salt.utils.files.fopen(path, 'r', encoding='utf-8', errors='surrogateescape') as src, \
+                salt.utils.files.fopen(dest, 'w', encoding='utf-8', errors='surrogateescape') as dst:
+            for line in _minify_lines(_counted(src), comments, modal, decimals, e_decimals):
+                dst.write(line)
+                dst.write('\n')
+                counts['lines_out'] += 1
+    except (IOError, OSError) as exc:
+        raise CommandExecutionError('Unable to minify {0}: {1}'.format(path, exc))
+
+    size_in = os.path.getsize(path)
+    size_out = os.path.getsize(dest)
+    return {
+        'path': dest,
+        'bytes_in': size_in,
+        'bytes_out': size_out,
+        'saved_percent': round(100.0 * (size_in - size_out) / size_in, 1) if size_in else 0,
+        'lines_in': counts['lines_in'],
+        'lines_out': counts['lines_out'],
+        'seconds': round(time.time() - start, 3),
+    }
@@ -5,11 +5,10 @@ Module for OctoPrint Printer Profiles
 
 # Import python libs
 from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
-import json
 import logging
 
-# Import salt libs
-import salt.utils.http
+# Import OctoSalt libs
+from octosalt import fanout as _fanout, response as _response  # pylint: disable=import-error
 
 log = logging.getLogger(__name__)
 
@@ -28,9 +27,11 @@ def __virtual__():
     return (False, 'The OctoPrint modules cannot be loaded: proxy is not configured.')
 
 
-def list_():
+@_fanout
+def list_(max_age=None, printer=None):
     '''
-    List OctoPrint printer profiles
+    List OctoPrint printer profiles. The list is cached by the proxy;
+    ``max_age`` sets how old, in seconds, a cached list may be.
 
     CLI Example:
 
@@ -38,17 +39,15 @@ def list_():
 
         salt octominion octo_printer.list
     '''
-    url = '{0}/api/printerprofiles'.format(__opts__['pillar']['proxy']['url'])
-    return salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
+    return _response(__proxy__['octoprint.query'](
+        '/api/printerprofiles',
+        printer=printer,
+        max_age=max_age,
+    ))
 
 
-def add_profile(data):
+@_fanout
+def add_profile(data, printer=None):
     '''
     Add a new printer profile.
 
@@ -60,22 +59,16 @@ def add_profile(data):
             '{"profile": {"id": "myprinter", "name": "my printer" \
             "model": "my cool printer"}}'
     '''
-    url = '{0}/api/printerprofiles'.format(__opts__['pillar']['proxy']['url'])
-    return salt.utils.http.query(
-        url,
+    return __proxy__['octoprint.query'](
+        '/api/printerprofiles',
         'POST',
-        header_dict={
-            'X-Api-Key': __opts__['pillar']['proxy']['apikey'],
-            'Content-type': 'application/json',
-        },
-        data=json.dumps(data),
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
+        data=data,
+        printer=printer,
     )
 
 
-def update_profile(profile, data):
+@_fanout
+def update_profile(profile, data, printer=None):
     '''
     Update an existing printer profile.
 
@@ -86,25 +79,16 @@ def update_profile(profile, data):
         salt octominion octo_printer.update_profile myprinter \
             '{"profile": {"name": "my other printer"}}'
     '''
-    url = '{0}/api/printerprofiles/{1}'.format(
-        __opts__['pillar']['proxy']['url'],
-        profile,
-    )
-    return salt.utils.http.query(
-        url,
+    return _response(__proxy__['octoprint.query'](
+        '/api/printerprofiles/{0}'.format(profile),
         'PATCH',
-        header_dict={
-            'X-Api-Key': __opts__['pillar']['proxy']['apikey'],
-            'Content-type': 'application/json',
-        },
-        data=json.dumps(data),
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
-
-
-def delete_profile(profile):
+        data=data,
+        printer=printer,
+    ))
+
+
+@_fanout
+def delete_profile(profile, printer=None):
     '''
     Delete a printer profile.
 
@@ -114,16 +98,11 @@ def delete_profile(profile):
 
         salt octominion octo_printer.delete_profile myprinter
     '''
-    url = '{0}/api/printerprofiles/{1}'.format(
-        __opts__['pillar']['proxy']['url'],
-        profile,
-    )
-    data = salt.utils.http.query(
-        url,
+    data = __proxy__['octoprint.query'](
+        '/api/printerprofiles/{0}'.format(profile),
         'DELETE',
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        status=True,
+        decode=False,
+        printer=printer,
     )
     if int(data['status']) == 204:
         return True
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+'''
+Print queue for a farm of OctoPrint printers
+
+Jobs are added to an ordered queue, kept on disk on the minion which hosts
+the proxy, and are dispatched by :py:func:`dispatch`: each printer which is
+idle is given the first queued job it is compatible with, which is uploaded
+and started. Which printers are idle is read from the proxy's background
+snapshot of each printer, so that deciding what goes where takes no more than
+a few milliseconds; only the uploads themselves take time.
+
+A job may require a printer name, a printer profile (by id or model), a
+nozzle diameter, a number of extruders and the size of the print, which must
+fit in the build volume of the printer's profile. The size and number of
+extruders are taken from ``octo_gcode.analyze`` when a job is added with
+``analyze=True``.
+
+Once a printer has finished a job, the print is still on its bed, so no new
+job is sent to it until it is marked as cleared with :py:func:`cleared`. Set
+``queue_auto_clear: True`` in the ``proxy`` pillar for printers which clear
+their own beds.
+
+To dispatch jobs continuously, schedule :py:func:`dispatch` on the proxy:
+
+.. code-block:: yaml
+
+    schedule:
+      octo_queue:
+        function: octo_queue.dispatch
+        seconds: 10
+        return_job: False
+
+It may also be called from a reactor on the events of the ``octoprint_job``
+beacon, so that a printer is given its next job as soon as it is cleared.
+'''
+
+# Import python libs
+from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
+import concurrent.futures
+import contextlib
+import fnmatch
+import json
+import logging
+import os
+import time
+
+# Import salt libs
+import salt.utils.atomicfile
+import salt.utils.files
+from salt.exceptions import CommandExecutionError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'octo_queue'
+__func_alias__ = {
+    'list_': 'list'
+}
+
+# Seconds a dispatched job has to show up as printing before it is failed
+START_TIMEOUT = 300
+
+# Dispatch attempts before a job which can't be uploaded or started is failed
+ATTEMPTS = 3
+
+
+def __virtual__():
+    '''
+    Only load the module if proxy configuration is present
+    '''
+    if __opts__['pillar'].get('proxy', {}).get('proxytype', '') == 'octoprint':
+        return True
+    return (False, 'The OctoPrint modules cannot be loaded: proxy is not configured.')
+
+
+def _queue_path():
+    '''
+    Return the location of the queue
+    '''
+    return os.path.join(__opts__['cachedir'], 'octoprint', 'queue.json')
+
+
+@contextlib.contextmanager
+def _locked(write=True):
+    '''
+    Hold an exclusive lock on the queue, which is shared by every job and
+    thread on the hosting minion, and yield its contents. The queue is saved
+    again on the way out if ``write`` is True.
+    '''
+    path = _queue_path()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with salt.utils.files.flopen(path + '.lock', 'a'):
+        try:
+            with salt.utils.files.fopen(path, 'r') as fh_:
+                queue = json.load(fh_)
+        except (IOError, OSError, ValueError):
+            queue = {'next_id': 1, 'jobs': [], 'printers': {}}
+        yield queue
+        if write:
+            with salt.utils.atomicfile.atomic_open(path, 'w') as fh_:
+                json.dump(queue, fh_)
+
+
+def add(path,
+        remotepath=None,
+        copies=1,
+        priority=0,
+        printer=None,
+        profile=None,
+        nozzle=None,
+        volume=None,
+        tools=None,
+        analyze=False):
+    '''
+    Add a G-code file on the hosting minion to the queue, returning the new
+    jobs. The file is uploaded to ``remotepath`` when it is dispatched, which
+    defaults to the name of the file in the ``local`` location.
+
+    copies
+        The number of jobs to add, for printing the file several times
+
+    priority
+        Jobs with a higher priority are dispatched first. Jobs with the same
+        priority are dispatched in the order they were added.
+
+    printer
+        The name of the printer to print on, or a glob of names
+
+    profile
+        The id or model of the printer profile to print with, or a glob
+
+    nozzle
+        The nozzle diameter to print with, in mm
+
+    volume
+        The width, depth and height of the print in mm, as a list or as a
+        comma-separated string
+
+    tools
+        The number of extruders needed
+
+    analyze
+        Take the size of the print and the number of extruders used from
+        ``octo_gcode.analyze``, unless they are given
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt octofarm octo_queue.add /srv/parts/vase.gcode
+        salt octofarm octo_queue.add /srv/parts/vase.gcode copies=10 nozzle=0.4 analyze=True
+        salt octofarm octo_queue.add /srv/parts/bracket.gcode local/brackets/bracket.gcode profile='prusa_*'
+    '''
+    if not os.path.isfile(path):
+        raise CommandExecutionError('{0} does not exist'.format(path))
+
+    if isinstance(volume, str):
+        volume = volume.split(',')
+    if volume is not None:
+        volume = [float(size) for size in volume]
+        if len(volume) != 3:
+            raise CommandExecutionError('volume must be a width, depth and height')
+
+    if analyze:
+        analysis = __salt__['octo_gcode.analyze'](path)
+        if volume is None and 'dimensions' in analysis:
+            volume = [analysis['dimensions'][size] for size in ('width', 'depth', 'height')]
+        if tools is None:
+            tools = len([item for item in analysis['filament'].values() if item['length'] > 0]) or None
+
+    requires = {
+        'printer': printer,
+        'profile': profile,
+        'nozzle': None if nozzle is None else float(nozzle),
+        'volume': volume,
+        'tools': None if tools is None else int(tools),
+    }
+    requires = dict((key, value) for key, value in requires.items() if value is not None)
+
+    ret = []
+    with _locked() as queue:
+        for _ in range(int(copies)):
+            job = {
+                'id': queue['next_id'],
+                'path': os.path.realpath(path),
+                'remotepath': remotepath or 'local/{0}'.format(os.path.basename(path)),
+                'priority': int(priority),
+                'requires': requires,
+                'status': 'queued',
+                'added': time.time(),
+                'attempts': 0,
+            }
+            queue['next_id'] += 1
+            queue['jobs'].append(job)
+            ret.append(job)
+    return ret
+
+
+def list_(status=None):
+    '''
+    Return the jobs in the queue, in the order they will be dispatched,
+    followed by those which have been dispatched. ``status`` may be one of
+    ``queued``, ``dispatching``, ``printing``, ``done``, ``cancelled`` or
+    ``failed``, or a comma-separated list of them.
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt octofarm octo_queue.list
+        salt octofarm octo_queue.list queued
+    '''
+    with _locked(write=False) as queue:
+        jobs = queue['jobs']
+    if status is not None:
+        if not isinstance(status, (list, tuple)):
+            status = status.split(',')
+        jobs = [job for job in jobs if job['status'] in status]
+    return sorted(jobs, key=lambda job: (job['status'] != 'queued', -job['priority'], job['id']))
+
+
+def remove(job_id=None, status=None):
+    '''
+    Remove a job from the queue by id, or all jobs with the given ``status``,
+    such as ``done``. Jobs which are printing are only removed from the
+    queue; their prints are not stopped. Returns the ids removed.
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt octofarm octo_queue.remove 12
+        salt octofarm octo_queue.remove status=done,cancelled
+    '''
+    if job_id is None and status is None:
+        raise CommandExecutionError('Either a job_id or a status is required')
+    if status is not None and not isinstance(status, (list, tuple)):
+        status = status.split(',')
+
+    with _locked() as queue:
+        removed = [
+            job['id'] for job in queue['jobs']
+            if job['id'] == job_id or status is not None and job['status'] in status
+        ]
+        queue['jobs'] = [job for job in queue['jobs'] if job['id'] not in removed]
+        for state in queue['printers'].values():
+            if state.get('job') in removed:
+                state['job'] = None
+    return removed
+
+
+def cleared(printer):
+    '''
+    Mark the bed of a printer as cleared once a finished print has been taken
+    off it, so that it may be given its next job
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt octofarm octo_queue.cleared prusa01
+    '''
+    names = __proxy__['octoprint.printers'](printer)
+    with _locked() as queue:
+        for name in names:
+            queue['printers'].setdefault(name, {})['clear'] = True
+    return names
+
+
+def dispatch(printer=None, test=False):
+    '''
+    Give each idle printer the first queued job it is compatible with. The
+    files are uploaded and the prints started concurrently. Only the printers
+    selected by ``printer`` are considered.
+
+    A printer is idle when it is operational and not printing, no job from
+    the queue is running on it, and its bed has been cleared since its last
+    job. Jobs which could not be uploaded or started are queued again, until
+    they have failed three times.
+
+    With ``test=True``, the jobs which would be dispatched are returned
+    without dispatching them.
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt octofarm octo_queue.dispatch
+        salt octofarm octo_queue.dispatch 'prusa*' test=True
+    '''
+    began = time.time()
+    names = __proxy__['octoprint.printers'](printer)
+    auto_clear = __opts__['pillar']['proxy'].get('queue_auto_clear', False)
+    workers = max(1, min(len(names), __opts__['pillar']['proxy'].get('pool_size', 4)))
+
+    # The statuses are gathered before the queue is locked, so that a slow
+    # printer does not hold up every other job which uses the queue
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        statuses = dict(zip(names, pool.map(_status, names)))
+
+    with _locked(write=not test) as queue:
+        jobs = dict((job['id'], job) for job in queue['jobs'])
+        queued = sorted(
+            (job for job in queue['jobs'] if job['status'] == 'queued'),
+            key=lambda job: (-job['priority'], job['id']),
+        )
+
+        assigned = {}
+        for name in names:
+            state = queue['printers'].setdefault(name, {'clear': True})
+            status = statuses[name]
+            if status is None:
+                continue
+            if state.get('job') is not None:
+                job = jobs.get(state['job'])
+                if job is None or not _finished(job, status, name):
+                    continue
+                state['job'] = None
+                # A failed job never printed, so there is nothing to clear
+                state['clear'] = bool(auto_clear) or job is not None and job['status'] == 'failed'
+            if not state.get('clear', True) or not status['idle']:
+                continue
+            for job in queued:
+                if _compatible(job['requires'], name, status['profile']):
+                    queued.remove(job)
+                    assigned[name] = job
+                    job['status'] = 'dispatching'
+                    job['printer'] = name
+                    job['dispatched'] = time.time()
+                    state['job'] = job['id']
+                    break
+        decided = time.time() - began
+
+    ret = {
+        'dispatched': dict((name, job['id']) for name, job in assigned.items()),
+        'queued': len(queued),
+        'decision_seconds': round(decided, 4),
+    }
+    if test or not assigned:
+        ret['seconds'] = round(time.time() - began, 3)
+        return ret
+
+    workers = max(1, min(len(assigned), __opts__['pillar']['proxy'].get('pool_size', 4)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        results = dict(zip(assigned, pool.map(_start, assigned.values())))
+
+    with _locked() as queue:
+        for job in queue['jobs']:
+            name = job.get('printer')
+            if job['status'] != 'dispatching' or name not in results:
+                continue
+            error = results[name]
+            if error is None:
+                job['status'] = 'printing'
+                job['dispatched'] = time.time()
+                continue
+            log.error('Unable to start job %s on %s: %s', job['id'], name, error)
+            job['attempts'] += 1
+            job['error'] = error
+            job['status'] = 'failed' if job['attempts'] >= ATTEMPTS else 'queued'
+            job.pop('printer')
+            queue['printers'][name]['job'] = None
+
+    ret['errors'] = dict((name, error) for name, error in results.items() if error is not None)
+    ret['seconds'] = round(time.time() - began, 3)
+    return ret
+
+
+def _status(name):
+    '''
+    Return whether a printer is idle, whether it is printing, its printer
+    profile and its current job, from the proxy's snapshot. Returns None if
+    the printer can't be reached.
+    '''
+    status = __proxy__['octoprint.snapshot']('/api/printer', name)
+    if 'dict' not in status:
+        # OctoPrint answers 409 while it is not connected to the printer
+        return None
+    flags = status['dict'].get('state', {}).get('flags', {})
+    busy = any(flags.get(flag) for flag in ('printing', 'paused', 'pausing', 'cancelling', 'error'))
+
+    connection = __proxy__['octoprint.snapshot']('/api/connection', name).get('dict', {})
+    profile = connection.get('current', {}).get('printerProfile')
+    profiles = __proxy__['octoprint.query']('/api/printerprofiles', printer=name).get('dict', {})
+
+    job = __proxy__['octoprint.snapshot']('/api/job', name)
+    current = (job.get('dict') or {}).get('job') or {}
+    progress = (job.get('dict') or {}).get('progress') or {}
+    return {
+        'idle': bool(flags.get('operational') and flags.get('ready')) and not busy,
+        'printing': bool(flags.get('printing') or flags.get('paused') or flags.get('pausing')),
+        'profile': profiles.get('profiles', {}).get(profile, {}),
+        'job': {
+            'file': current.get('file') or {},
+            'completion': progress.get('completion') or 0,
+            'print_time': progress.get('printTime') or 0,
+            'time': job.get('time', 0),
+        },
+    }
+
+
+def _finished(job, status, name):
+    '''
+    Update a job which was dispatched to a printer from the printer's status,
+    returning True once the printer is done with it
+    '''
+    if job['status'] == 'dispatching':
+        # Another dispatch is still uploading the job. Its start timeout only
+        # runs from when the upload has ended.
+        return False
+    if status['printing']:
+        job['started'] = True
+        return False
+    if not job.get('started'):
+        if not _ran(job, status):
+            if time.time() - job['dispatched'] < START_TIMEOUT:
+                return False
+            job['status'] = 'failed'
+            job['error'] = 'The print did not start'
+            return True
+        # The print was over before the printer was ever seen printing it
+        job['started'] = True
+    if not status['idle']:
+        return False
+
+    job['status'] = 'done' if status['job']['completion'] >= 100 else 'cancelled'
+    job['finished'] = time.time()
+    return True
+
+
+def _ran(job, status):
+    '''
+    Return whether the job status of a printer, as received since a job was
+    started on it, shows the job's file with some progress made. A short
+    print may start and end between two polls of the printer.
+    '''
+    current = status['job']
+    if current['time'] < job['dispatched']:
+        return False
+    origin, _, path = job['remotepath'].partition('/')
+    if not path:
+        path = os.path.basename(job['path'])
+    printed = current['file']
+    if printed.get('origin') != origin:
+        return False
+    if printed.get('path') != path and not (
+            printed.get('path') is None and printed.get('name') == os.path.basename(path)):
+        return False
+    return current['completion'] > 0 or current['print_time'] > 0
+
+
+def _compatible(requires, name, profile):
+    '''
+    Return whether a printer, with the given printer profile, meets the
+    requirements of a job
+    '''
+    if 'printer' in requires and not fnmatch.fnmatchcase(name, requires['printer']):
+        return False
+    if 'profile' in requires and not any(
+            fnmatch.fnmatchcase(str(profile.get(key, '')), requires['profile'])
+            for key in ('id', 'model')):
+        return False
+
+    extruder = profile.get('extruder', {})
+    if 'nozzle' in requires:
+        if abs(float(extruder.get('nozzleDiameter', 0)) - requires['nozzle']) > 0.001:
+            return False
+    if 'tools' in requires and int(extruder.get('count', 1)) < requires['tools']:
+        return False
+
+    if 'volume' in requires:
+        volume = profile.get('volume', {})
+        for size, key in zip(requires['volume'], ('width', 'depth', 'height')):
+            if size > float(volume.get(key, 0)):
+                return False
+    return True
+
+
+def _start(job):
+    '''
+    Upload a job to its printer and start printing it, returning an error,
+    or None once it has started
+    '''
+    try:
+        ret = __salt__['octo_file.upload'](
+            job['path'],
+            job['remotepath'],
+            print=True,
+            printer=job['printer'],
+        )
+    except Exception as exc:  # pylint: disable=broad-except
+        return str(exc)
+    if 'error' in ret:
+        return ret['error']
+    return None
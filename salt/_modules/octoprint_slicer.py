@@ -5,11 +5,10 @@ Module for OctoPrint Slicers
 
 # Import python libs
 from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
-import json
 import logging
 
-# Import salt libs
-import salt.utils.http
+# Import OctoSalt libs
+from octosalt import fanout as _fanout, response as _response  # pylint: disable=import-error
 
 log = logging.getLogger(__name__)
 
@@ -28,9 +27,11 @@ def __virtual__():
     return (False, 'The OctoPrint modules cannot be loaded: proxy is not configured.')
 
 
-def list_():
+@_fanout
+def list_(max_age=None, printer=None):
     '''
-    List OctoPrint slicers and slicing profiles
+    List OctoPrint slicers and slicing profiles. The list is cached by the
+    proxy; ``max_age`` sets how old, in seconds, a cached list may be.
 
     CLI Example:
 
@@ -38,19 +39,14 @@ def list_():
 
         salt octominion slicer.list
     '''
-    url = '{0}/api/slicing'.format(__opts__['pillar']['proxy']['url'])
-    return salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']
+    return _response(__proxy__['octoprint.query']('/api/slicing', printer=printer, max_age=max_age))
 
 
-def get_profile(slicer, profile):
+@_fanout
+def get_profile(slicer, profile, max_age=None, printer=None):
     '''
-    Show a specific slicing profile
+    Show a specific slicing profile. Profiles are cached by the proxy;
+    ``max_age`` sets how old, in seconds, a cached profile may be.
 
     CLI Example:
 
@@ -58,25 +54,18 @@ def get_profile(slicer, profile):
 
         salt octominion slicer.get_profile curalegacy spiralize
     '''
-    url = '{0}/api/slicing/{1}/profiles/{2}'.format(
-        __opts__['pillar']['proxy']['url'],
-        slicer,
-        profile,
+    data = __proxy__['octoprint.query'](
+        '/api/slicing/{0}/profiles/{1}'.format(slicer, profile),
+        printer=printer,
+        max_age=max_age,
     )
-    data = salt.utils.http.query(
-        url,
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-        status=True,
-    )
-    if int(data['status']) == 404:
+    if int(data.get('status', 0)) == 404:
         return 'Either the slicer or the profile was not found'
-    return data['dict']
+    return _response(data)
 
 
-def save_profile(slicer, profile, data):
+@_fanout
+def save_profile(slicer, profile, data, printer=None):
     '''
     Save a slicing profile. If the profile already exists, it will be
     overwritten. Data is expected using OctoPrint slicing profile format.
@@ -88,26 +77,16 @@ def save_profile(slicer, profile, data):
         salt octominion slicer.save_profile curalegacy example \
             '{"displayName": "example", "data": {"layer_height": 0.2}}'
     '''
-    url = '{0}/api/slicing/{1}/profiles/{2}'.format(
-        __opts__['pillar']['proxy']['url'],
-        slicer,
-        profile,
-    )
-    return salt.utils.http.query(
-        url,
+    return __proxy__['octoprint.query'](
+        '/api/slicing/{0}/profiles/{1}'.format(slicer, profile),
         'PUT',
-        header_dict={
-            'X-Api-Key': __opts__['pillar']['proxy']['apikey'],
-            'Content-type': 'application/json',
-        },
-        data=json.dumps(data),
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
+        data=data,
+        printer=printer,
     )
 
 
-def delete_profile(slicer, profile):
+@_fanout
+def delete_profile(slicer, profile, printer=None):
     '''
     Delete a slicing profile.
 
@@ -117,17 +96,11 @@ def delete_profile(slicer, profile):
 
         salt octominion slicer.delete_profile curalegacy spiralize
     '''
-    url = '{0}/api/slicing/{1}/profiles/{2}'.format(
-        __opts__['pillar']['proxy']['url'],
-        slicer,
-        profile,
-    )
-    data = salt.utils.http.query(
-        url,
+    data = __proxy__['octoprint.query'](
+        '/api/slicing/{0}/profiles/{1}'.format(slicer, profile),
         'DELETE',
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        status=True,
+        decode=False,
+        printer=printer,
     )
     if int(data['status']) == 204:
         return True
@@ -5,11 +5,10 @@ Support for Octoprint
 
 # Import python libs
 from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
-import json
 import logging
 
-# Import salt libs
-import salt.utils.http
+# Import OctoSalt libs
+from octosalt import fanout as _fanout, response as _response  # pylint: disable=import-error
 
 log = logging.getLogger(__name__)
 
@@ -25,7 +24,8 @@ def __virtual__():
     return (False, 'The octoprint modules cannot be loaded: proxy is not configured.')
 
 
-def list_users():
+@_fanout
+def list_users(printer=None):
     '''
     Return Octoprint users
 
@@ -35,26 +35,20 @@ def list_users():
 
         salt octominion user.list_users
     '''
-    url = '{0}/api/users'.format(__opts__['pillar']['proxy']['url'])
     ret = []
-    data = salt.utils.http.query(
-        url,
-        'GET',
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']['users']
+    data = _response(__proxy__['octoprint.query']('/api/users', printer=printer))['users']
     for user in data:
         if user['user'] is True:
             ret.append(user['name'])
     return ret
 
 
+@_fanout
 def add(name,
         password='',
         active=False,
-        admin=False):
+        admin=False,
+        printer=None):
     '''
     Add a user to the printer. ``active`` and ``admin`` default to False.
 
@@ -64,30 +58,25 @@ def add(name,
 
         salt octominion user.add <name> <password> <active> <admin>
     '''
-    url = '{0}/api/users'.format(__opts__['pillar']['proxy']['url'])
-    
-    data = salt.utils.http.query(
-        url,
+    data = __proxy__['octoprint.query'](
+        '/api/users',
         'POST',
-        data=json.dumps({
+        data={
             'name': name,
             'password': password,
             'active': active,
             'admin': admin,
-        }),
-        header_dict={
-            'X-Api-Key': __opts__['pillar']['proxy']['apikey'],
-            'Content-type': 'application/json',
         },
-        status=True,
-        opts=__opts__,
+        decode=False,
+        printer=printer,
     )
     if int(data['status']) != 200:
         return False
     return True
 
 
-def delete(name):
+@_fanout
+def delete(name, printer=None):
     '''
     Remove a user from the minion
 
@@ -97,44 +86,39 @@ def delete(name):
 
         salt octominion user.delete name remove=True force=True
     '''
-    url = '{0}/api/users/{1}'.format(__opts__['pillar']['proxy']['url'], name)
-    data = salt.utils.http.query(
-        url,
+    data = __proxy__['octoprint.query'](
+        '/api/users/{0}'.format(name),
         'DELETE',
-        header_dict={
-            'X-Api-Key': __opts__['pillar']['proxy']['apikey'],
-            'Content-type': 'application/json',
-        },
-        status=True,
-        opts=__opts__,
+        decode=False,
+        printer=printer,
     )
     if int(data['status']) != 200:
         return False
     return True
 
 
-def getent(refresh=False):
+@_fanout
+def getent(refresh=False, printer=None):
     '''
-    Return the list of all info for all users
+    Return the list of all info for all users. The list is cached by the
+    proxy; pass ``refresh=True`` to fetch it from the printer.
 
     CLI Example:
 
     .. code-block:: bash
 
         salt octominion user.getent
+        salt octominion user.getent refresh=True
     '''
-    url = '{0}/api/users'.format(__opts__['pillar']['proxy']['url'])
-    return salt.utils.http.query(
-        url,
-        'GET',
-        header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-        opts=__opts__,
-        decode=True,
-        decode_type='json',
-    )['dict']['users']
-
-
-def info(name):
+    return _response(__proxy__['octoprint.query'](
+        '/api/users',
+        printer=printer,
+        max_age=0 if refresh else None,
+    ))['users']
+
+
+@_fanout
+def info(name, printer=None):
     '''
     Return user information
 
@@ -145,15 +129,7 @@ def info(name):
         salt octominion user.info root
     '''
     try:
-        url = '{0}/api/users/{1}'.format(__opts__['pillar']['proxy']['url'], name)
-        data = salt.utils.http.query(
-            url,
-            'GET',
-            header_dict={'X-Api-Key': __opts__['pillar']['proxy']['apikey']},
-            opts=__opts__,
-            decode=True,
-            decode_type='json',
-        )['dict']
+        data = __proxy__['octoprint.query']('/api/users/{0}'.format(name), printer=printer)['dict']
         if not data:
             return {}
     except KeyError:
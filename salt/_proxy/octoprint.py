@@ -2,14 +2,229 @@
 '''
 This is a simple proxy-minion designed to connect to and communicate with
 the OctoPrint 3D printing server.
+
+All traffic to the printer goes through :py:func:`query`, which holds one
+keep-alive ``requests`` session for each printer. Execution modules reach it
+as ``__proxy__['octoprint.query']``, so every call made by this proxy reuses
+the same pooled TCP connections instead of opening a new one per request.
+Identical ``GET`` requests made at the same time, such as by a beacon and a
+scheduled job, are sent once and share the response.
+
+Salt runs each job in a process forked from the proxy, unless
+``multiprocessing: False`` is set in the proxy configuration. A forked job
+starts with connections, caches, counters and a circuit breaker of its own,
+so that it never shares a socket or a lock with the proxy process, along with
+a copy of the status and telemetry which the proxy had gathered. A job does
+not start a status poller: it reads the copied status while it is no older
+than ``poll_interval``, and queries the printer itself otherwise. Only with
+``multiprocessing: False`` do jobs share the connections and caches of the
+beacons and of each other.
+
+The following optional settings may be added to the ``proxy`` pillar:
+
+.. code-block:: yaml
+
+    proxy:
+      proxytype: octoprint
+      url: http://192.168.11.38
+      apikey: 0123456789ABCDEF
+      pool_size: 4
+      push_url: ws://192.168.11.38/sockjs/websocket
+      push_queue_size: 1000
+      cache_ttl:
+        /api/version: 3600
+        /api/files: 10
+      timeout: 10
+      retries: 2
+      breaker_threshold: 3
+      breaker_reset: 30
+      poll_interval: 10
+      poll_interval_printing: 2
+      poll_interval_waiting: 2
+      poll_interval_offline: 120
+      metrics_textfile: /var/lib/node_exporter/textfile_collector/octoprint.prom
+      metrics_interval: 15
+      record: /var/cache/salt/octoprint-traffic.jsonl.gz
+
+The proxy can also hold a connection to OctoPrint's push API, which is used
+by the ``octoprint_push`` beacon. This requires the ``websocket-client``
+library. ``push_url`` defaults to the websocket endpoint of ``url``, and
+``push_queue_size`` caps how many messages are kept between beacon
+intervals; the oldest messages are dropped first.
+
+Responses to ``GET`` requests for data which rarely changes, such as the
+server version, printer profiles, slicing profiles, users and files, are
+cached by the proxy. ``cache_ttl`` sets how many seconds responses from each
+API resource are kept, and a TTL of ``0`` disables caching of a resource.
+Any other request to a resource, such as an upload or a profile change made
+through these modules, drops the cached responses for that resource. Changes
+made directly in OctoPrint show up once the TTL has expired, or at once by
+passing ``max_age=0`` to the function being called.
+
+Requests which get no answer within ``timeout`` seconds fail. Failed ``GET``
+requests are retried up to ``retries`` times, after a jittered exponential
+backoff. Once ``breaker_threshold`` requests in a row have failed, counting
+each request once however many times it was retried, the printer is
+considered down, and further requests fail at once rather than waiting for
+a timeout. After ``breaker_reset`` seconds, a single request is
+let through to check whether the printer is back. The state of each printer
+is returned by ``octoprint.breaker``.
+
+The printer, job and connection status are kept up to date by a background
+poller, so any number of beacons and function calls can read them without
+each sending its own request. The status is polled every ``poll_interval``
+seconds, or every ``poll_interval_printing`` seconds while printing. While the
+printer cannot be reached, the interval doubles up to
+``poll_interval_offline`` seconds. The poller starts when the status is first
+read, and stops once it has not been read for five minutes.
+
+Functions which wait for the printer, such as ``octoprint.wait_for_state``,
+are woken by each update of the status, however many of them are waiting.
+While any are, the status is polled every ``poll_interval_waiting`` seconds.
+If the push API connection is running, as it is for the ``octoprint_push``
+beacon, the status is also updated by its messages as they arrive, and the
+faster polling is left out.
+
+Every request sent to a printer is counted by the proxy, by HTTP method and
+API resource: the response status, the bytes sent and received, and the time
+taken, in a histogram with fixed buckets. ``octoprint.metrics`` returns these
+counters. If ``metrics_textfile`` is set, they are also written to that file
+every ``metrics_interval`` seconds, for the textfile collector of the
+Prometheus node exporter, along with the cache and breaker state of each
+printer. As with the cache, ``multiprocessing: False`` must be set for the
+counters to include requests made by jobs.
+
+Telemetry
+---------
+If ``telemetry`` is True, the proxy keeps a history of the temperature and
+target temperature of each heater, the job progress and, from the push API,
+the height of the nozzle, as returned by ``octoprint.telemetry``. The status
+of such printers is polled from the start, and for as long as the proxy runs.
+NumPy must be installed.
+
+Each sample is added to several tiers of fixed-size rings, averaged over one
+second, one minute and one hour, so memory use does not grow over time.
+``telemetry_retention`` sets how many seconds are kept at each resolution,
+by default an hour at one second, two days at one minute and 90 days at one
+hour. This takes about 500 kB for a printer with one tool and a bed.
+
+.. code-block:: yaml
+
+    proxy:
+      proxytype: octoprint
+      telemetry: True
+      telemetry_retention:
+        1: 900
+        60: 86400
+        3600: 31536000
+
+Record and Replay
+-----------------
+If ``record`` is set to the path of a file, every request sent to a printer
+is appended to it with its response and the time it took, one JSON object per
+line, compressed if the path ends with ``.gz``. Request headers, including
+the API key, are not recorded, but response bodies are kept as they are.
+
+If ``replay`` is set instead, no printer is contacted: each request is
+answered with the response recorded for the same method, path and parameters,
+in the order they were recorded, repeating the last one once they run out.
+Requests which were not recorded get a ``404``. Responses are returned at
+once, or after the recorded time multiplied by ``replay_latency``, e.g. ``1``
+to reproduce the recorded timings. A printer's ``url`` must still be set, but
+is not used, and recordings from a printer of another name are used if there
+are none for the printer itself. This allows states to be profiled with the
+payloads of a production printer, with no printer attached:
+
+.. code-block:: yaml
+
+    proxy:
+      proxytype: octoprint
+      url: http://printer.invalid
+      replay: /tmp/octoprint-traffic.jsonl.gz
+      replay_latency: 1
+
+Farm Mode
+---------
+A single proxy may manage several printers, which saves running one proxy
+minion process per printer. List the printers under ``printers`` instead of
+setting ``url``. Each printer takes the same settings as above; any setting
+given outside of ``printers`` is used as the default for every printer.
+
+.. code-block:: yaml
+
+    proxy:
+      proxytype: octoprint
+      pool_size: 2
+      fanout_workers: 16
+      printers:
+        prusa01:
+          url: http://192.168.11.38
+          apikey: 0123456789ABCDEF
+        prusa02:
+          url: http://192.168.11.39
+          apikey: FEDCBA9876543210
+
+Every OctoPrint function then accepts a ``printer`` argument, which may be
+the name of a printer, a glob or a list of names. Given the name of a single
+printer, the function returns the same data as it would on a single-printer
+proxy. Otherwise, it is run on each selected printer (all of them, if no
+printer is given) at most ``fanout_workers`` at a time, and the results are
+returned by printer name.
 '''
 from __future__ import absolute_import, print_function, unicode_literals
 
 # Import python libs
+import asyncio
+import base64
+import bisect
+import collections
+import concurrent.futures
+import fnmatch
+import functools
+import gzip
+import json
 import logging
-import salt.utils.http
+import os
+import random
+import socket
+import threading
+import time
+import zlib
+
+# Import salt libs
+from salt.exceptions import CommandExecutionError
+
+# Import 3rd party libs
+try:
+    import requests
+    import requests.adapters
+    HAS_REQUESTS = True
+except ImportError:
+    HAS_REQUESTS = False
 
-HAS_REST_EXAMPLE = True
+try:
+    import websocket
+    HAS_WEBSOCKET = True
+except ImportError:
+    HAS_WEBSOCKET = False
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+# Use the fastest JSON decoder available; the printer status payloads are
+# decoded on every beacon interval.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        _json_loads = ujson.loads
+    except ImportError:
+        _json_loads = json.loads
 
 # This must be present or the Salt loader won't load this module
 __proxyenabled__ = ['octoprint']
@@ -20,6 +235,71 @@ __proxyenabled__ = ['octoprint']
 GRAINS_CACHE = {}
 DETAILS = {}
 
+SESSION_LOCK = threading.Lock()
+
+# Settings which may be given for each printer, and their defaults
+PRINTER_DEFAULTS = {
+    'apikey': None,
+    'pool_size': 4,
+    'push_url': None,
+    'push_queue_size': 1000,
+    'cache_ttl': None,
+    'timeout': 10,
+    'retries': 2,
+    'breaker_threshold': 3,
+    'breaker_reset': 30,
+    'poll_interval': 10,
+    'poll_interval_printing': 2,
+    'poll_interval_waiting': 2,
+    'poll_interval_offline': 120,
+    'telemetry': False,
+    'telemetry_retention': None,
+}
+
+# The resources kept up to date by the snapshot poller
+SNAPSHOT_PATHS = ('/api/printer', '/api/job', '/api/connection')
+
+# The poller of a printer stops when its snapshot has not been read for this
+# many seconds, and starts again on the next read
+POLL_LINGER = 300
+
+# Responses which mean that OctoPrint is down behind a reverse proxy, as on
+# OctoPi, rather than that it rejected the request
+UNAVAILABLE = (502, 503, 504)
+
+# How long, in seconds, GET responses are cached for each API resource. Any
+# other request to a resource drops its cached responses.
+CACHE_TTLS = {
+    '/api/version': 3600,
+    '/api/printerprofiles': 300,
+    '/api/slicing': 300,
+    '/api/users': 300,
+    '/api/files': 10,
+}
+
+# The largest number of responses cached for each printer
+CACHE_SIZE = 256
+
+# The response headers which are recorded, as used by the modules
+RECORD_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+# How long, in seconds, telemetry is kept at each resolution, in seconds
+TELEMETRY_RETENTION = {
+    1: 3600,
+    60: 172800,
+    3600: 7776000,
+}
+
+# The most telemetry channels which are kept for each printer
+TELEMETRY_CHANNELS = 32
+
+# How long, in seconds, each printer has to answer for its grains. Grains
+# are loaded with the proxy, which should not wait on printers which are off.
+GRAINS_TIMEOUT = 3
+
+# Upper bounds, in seconds, of the buckets of the request latency histograms
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
 log = logging.getLogger(__file__)
 
 
@@ -27,15 +307,150 @@ def __virtual__():
     '''
     Only load the module if proxy configuration is present
     '''
+    if not HAS_REQUESTS:
+        return (False, 'The octoprint proxy cannot be loaded: requests is not installed.')
     if __opts__['pillar'].get('proxy', {}).get('proxytype', '') == 'octoprint':
         return True
     return (False, 'The octoprint modules cannot be loaded: proxy is not configured.')
 
 
 def init(opts):
+    '''
+    Read the printer configuration from the proxy pillar
+    '''
+    _configure(opts)
+    # Pollers only run in this process; see _poll_start
+    DETAILS['pid'] = os.getpid()
+    if DETAILS['metrics_textfile']:
+        _metrics_writer_start()
+    for details in DETAILS['printers'].values():
+        if details['telemetry'] is not None:
+            _poll_start(details)
     DETAILS['initialized'] = True
 
 
+def _configure(opts):
+    '''
+    Store the connection settings for each printer
+    '''
+    config = opts['pillar']['proxy']
+    if 'printers' in config:
+        printers = config['printers']
+        DETAILS['farm'] = True
+    else:
+        printers = {opts['id']: {'url': config['url']}}
+        DETAILS['farm'] = False
+
+    DETAILS['fanout_workers'] = int(config.get('fanout_workers', 16))
+    DETAILS['metrics_textfile'] = config.get('metrics_textfile')
+    DETAILS['metrics_interval'] = float(config.get('metrics_interval', 15))
+    DETAILS['recorder'] = None
+    DETAILS['replay'] = None
+    if config.get('replay'):
+        DETAILS['replay'] = {
+            'path': config['replay'],
+            'latency': float(config.get('replay_latency', 0)),
+            'lock': threading.Lock(),
+            'entries': None,
+            'cursors': {},
+        }
+    elif config.get('record'):
+        DETAILS['recorder'] = {
+            'path': config['record'],
+            'lock': threading.Lock(),
+            'file': None,
+            'pid': None,
+        }
+    DETAILS['printers'] = {}
+    for name, printer in printers.items():
+        details = {'name': name, 'url': printer['url'].rstrip('/')}
+        for key, default in PRINTER_DEFAULTS.items():
+            details[key] = printer.get(key, config.get(key, default))
+        details['pool_size'] = int(details['pool_size'])
+        details['push_queue_size'] = int(details['push_queue_size'])
+        details['timeout'] = float(details['timeout'])
+        details['retries'] = int(details['retries'])
+        details['breaker_threshold'] = int(details['breaker_threshold'])
+        details['breaker_reset'] = float(details['breaker_reset'])
+        for key in ('poll_interval', 'poll_interval_printing', 'poll_interval_waiting', 'poll_interval_offline'):
+            details[key] = float(details[key])
+        cache_ttl = dict(CACHE_TTLS)
+        cache_ttl.update(details['cache_ttl'] or {})
+        details['cache_ttl'] = cache_ttl
+        _reset(details)
+        details['telemetry'] = _telemetry_init(details)
+        DETAILS['printers'][name] = details
+
+
+def _reset(details):
+    '''
+    Set up the connections, locks, caches and counters of a printer
+    '''
+    lock = threading.Lock()
+    details['snapshot'] = {
+        'lock': lock,
+        'changed': threading.Condition(lock),
+        'waiters': 0,
+        'data': {},
+        'read': 0,
+        'thread': None,
+        'stop': threading.Event(),
+        'wake': threading.Event(),
+    }
+    details['flights'] = {
+        'lock': threading.Lock(),
+        'inflight': {},
+        'sent': 0,
+        'collapsed': 0,
+    }
+    details['breaker'] = {
+        'lock': threading.Lock(),
+        'state': 'closed',
+        'failures': 0,
+        'opened': None,
+        'error': None,
+    }
+    details['cache'] = {
+        'lock': threading.Lock(),
+        'entries': collections.OrderedDict(),
+        'stats': {},
+    }
+    details['metrics'] = {
+        'lock': threading.Lock(),
+        'endpoints': {},
+    }
+    details['session'] = None
+    details['push'] = None
+
+
+def _after_fork():
+    '''
+    Start afresh in a job forked from the proxy process, as Salt runs jobs
+    unless ``multiprocessing: False`` is set. The pooled connections would
+    otherwise be used by both processes at once, and locks held by another
+    thread at the time of the fork would never be released. The status and
+    telemetry which the proxy had gathered are kept, as copies.
+    '''
+    global SESSION_LOCK
+    SESSION_LOCK = threading.Lock()
+    DETAILS.pop('metrics_writer', None)
+    if DETAILS.get('recorder') is not None:
+        # The recording is opened again by the job; see _record
+        DETAILS['recorder'].update(lock=threading.Lock(), file=None, pid=None)
+    if DETAILS.get('replay') is not None:
+        DETAILS['replay']['lock'] = threading.Lock()
+    for details in DETAILS.get('printers', {}).values():
+        data = dict(details['snapshot']['data'])
+        _reset(details)
+        details['snapshot']['data'] = data
+        if details['telemetry'] is not None:
+            details['telemetry']['lock'] = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
 def initialized():
     '''
     Since grains are loaded in many different places and some of those
@@ -45,44 +460,1427 @@ def initialized():
     return DETAILS.get('initialized', False)
 
 
-def alive(opts):
-    return False
+def _printers():
+    '''
+    Return the details of every printer, reading the configuration first if
+    init() has not been called yet
+    '''
+    if 'printers' not in DETAILS:
+        with SESSION_LOCK:
+            if 'printers' not in DETAILS:
+                _configure(__opts__)
+    return DETAILS['printers']
+
+
+def printers(printer=None):
+    '''
+    Return the sorted names of the printers which match ``printer``: the name
+    of a printer, a glob, or a list of names. All printers match ``None``.
+    '''
+    names = sorted(_printers())
+    if printer is None:
+        return names
+    if isinstance(printer, (list, tuple)):
+        return [name for name in names if name in printer]
+    return [name for name in names if fnmatch.fnmatchcase(name, printer)]
+
+
+def _single(printer):
+    '''
+    Return whether ``printer`` selects exactly one printer by name, rather
+    than a group of printers whose results are returned by name
+    '''
+    details = _printers()
+    if printer is None:
+        return not DETAILS['farm']
+    return not isinstance(printer, (list, tuple)) and printer in details
+
+
+def _printer(printer=None):
+    '''
+    Return the details of the single printer selected by ``printer``
+    '''
+    details = _printers()
+    if printer is None and not DETAILS['farm']:
+        return next(iter(details.values()))
+    if printer in details:
+        return details[printer]
+    if printer is None:
+        raise CommandExecutionError(
+            'This proxy manages several printers; a printer must be selected'
+        )
+    raise CommandExecutionError('Unknown printer: {0}'.format(printer))
+
+
+def fanout(func, printer, *args, **kwargs):
+    '''
+    Call an execution module function for the printers selected by
+    ``printer``.
+
+    If a single printer is selected by name, or this proxy only manages one
+    printer, the function's own return value is passed back. Otherwise the
+    function is called for each selected printer over a thread pool, and the
+    results are returned in a dict keyed by printer name.
+    '''
+    if _single(printer):
+        return func(*args, printer=_printer(printer)['name'], **kwargs)
+
+    names = printers(printer)
+    if not names:
+        return {}
+
+    def _call(name):
+        try:
+            return func(*args, printer=name, **kwargs)
+        except Exception as exc:  # pylint: disable=broad-except
+            log.error('OctoPrint call to %s on %s failed: %s', func.__name__, name, exc)
+            return {'error': str(exc)}
+
+    workers = max(1, min(DETAILS['fanout_workers'], len(names)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(names, pool.map(_call, names)))
+
+
+def farm_query(paths, printer=None, timeout=5, concurrency=32):
+    '''
+    GET several API paths from each selected printer concurrently, using
+    asyncio to schedule the requests.
+
+    Up to ``concurrency`` printers are queried at once, and each printer has
+    ``timeout`` seconds to answer all of its requests. Printers which fail or
+    time out are reported with an ``error`` instead of holding up the rest.
+    Returns a dict by printer name, holding the decoded responses by path
+    and the ``latency`` of the printer in seconds.
+    '''
+    names = printers(printer)
+    if not names:
+        return {}
+    timeout = float(timeout)
+    concurrency = max(1, min(int(concurrency), len(names)))
+
+    def _get(name, path):
+        ret = query(path, printer=name, timeout=timeout)
+        if 'error' in ret:
+            raise IOError(ret['error'])
+        return ret.get('dict', {})
+
+    async def _printer_status(pool, semaphore, name):
+        loop = asyncio.get_running_loop()
+        async with semaphore:
+            start = time.time()
+            requests_ = [loop.run_in_executor(pool, _get, name, path) for path in paths]
+            try:
+                results = await asyncio.wait_for(asyncio.gather(*requests_), timeout)
+                ret = dict(zip(paths, results))
+            except asyncio.TimeoutError:
+                ret = {'error': 'Timed out after {0} seconds'.format(timeout)}
+            except Exception as exc:  # pylint: disable=broad-except
+                ret = {'error': str(exc)}
+            ret['latency'] = round(time.time() - start, 3)
+            return name, ret
+
+    async def _farm_status():
+        semaphore = asyncio.Semaphore(concurrency)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency * len(paths))
+        try:
+            tasks = [_printer_status(pool, semaphore, name) for name in names]
+            return dict(await asyncio.gather(*tasks))
+        finally:
+            # Requests which timed out are left to finish on their own
+            pool.shutdown(wait=False)
+
+    # The event loop needs a thread of its own if this one is already
+    # running one, as the minion's main thread does
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as runner:
+        return runner.submit(asyncio.run, _farm_status()).result()
+
+
+def _session(details):
+    '''
+    Return the keep-alive session for a printer, creating it on first use
+    '''
+    session = details['session']
+    if session is not None:
+        return session
+
+    with SESSION_LOCK:
+        if details['session'] is None:
+            session = requests.Session()
+            session.headers.update({
+                'Accept-Encoding': 'gzip, deflate',
+                'Connection': 'keep-alive',
+            })
+            if details['apikey']:
+                session.headers['X-Api-Key'] = details['apikey']
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=details['pool_size'],
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            details['session'] = session
+    return details['session']
+
+
+def _cache_key(path, params):
+    '''
+    Return the resource which a request belongs to, and the key to cache
+    its response under
+    '''
+    path = path.split('?')[0]
+    resource = '/'.join(path.split('/')[:3])
+    if params:
+        path = '{0}?{1}'.format(path, json.dumps(params, sort_keys=True))
+    return resource, path
+
+
+def _cache_stats(cache, resource):
+    '''
+    Return the counters of a cached resource
+    '''
+    return cache['stats'].setdefault(
+        resource,
+        {'hits': 0, 'misses': 0, 'invalidations': 0},
+    )
+
+
+def _cache_get(details, resource, key, max_age):
+    '''
+    Return the cached response for a request, if it is recent enough. The
+    response is decoded again for each caller, which may then modify it.
+    '''
+    cache = details['cache']
+    with cache['lock']:
+        entry = cache['entries'].get(key)
+        stats = _cache_stats(cache, resource)
+        if entry is None or time.time() - entry['time'] > max_age:
+            stats['misses'] += 1
+            return None
+        stats['hits'] += 1
+        cache['entries'].move_to_end(key)
+    return {
+        'status': 200,
+        'headers': entry['headers'],
+        'body': entry['body'],
+        'dict': _json_loads(entry['content']) if entry['content'] else {},
+    }
+
+
+def _cache_put(details, resource, key, response):
+    '''
+    Cache the response to a request
+    '''
+    cache = details['cache']
+    entry = {
+        'resource': resource,
+        'time': time.time(),
+        'headers': response.headers,
+        'body': response.text,
+        'content': response.content,
+    }
+    with cache['lock']:
+        cache['entries'][key] = entry
+        cache['entries'].move_to_end(key)
+        while len(cache['entries']) > CACHE_SIZE:
+            cache['entries'].popitem(last=False)
+
+
+def _cache_invalidate(details, resource=None):
+    '''
+    Drop the cached responses for a resource, or for every resource
+    '''
+    cache = details['cache']
+    with cache['lock']:
+        for key, entry in list(cache['entries'].items()):
+            if resource is None or entry['resource'] == resource:
+                del cache['entries'][key]
+                _cache_stats(cache, entry['resource'])['invalidations'] += 1
+
+
+def cache_stats(printer=None):
+    '''
+    Return the number of cached responses, and the hits, misses and
+    invalidations of each cached resource. ``single_flight`` holds the number
+    of ``GET`` requests sent, and the number of identical requests which
+    shared their response instead of being sent.
+    '''
+    details = _printer(printer)
+    cache = details['cache']
+    flights = details['flights']
+    with cache['lock']:
+        ret = {
+            'entries': len(cache['entries']),
+            'resources': dict(
+                (resource, dict(stats)) for resource, stats in cache['stats'].items()
+            ),
+        }
+    with flights['lock']:
+        ret['single_flight'] = {'sent': flights['sent'], 'collapsed': flights['collapsed']}
+    return ret
+
+
+def cache_clear(printer=None, resource=None):
+    '''
+    Drop the cached responses of a printer, for one resource such as
+    ``/api/files``, or for all of them
+    '''
+    _cache_invalidate(_printer(printer), resource)
+    return True
+
+
+def _breaker_allow(details):
+    '''
+    Return whether a request may be sent to a printer. While the breaker of
+    a printer is open, no requests are sent until ``breaker_reset`` seconds
+    have passed, when it is half-open and lets a single request through.
+    '''
+    breaker = details['breaker']
+    with breaker['lock']:
+        if breaker['state'] == 'closed':
+            return True
+        if breaker['state'] == 'open' \
+                and time.time() - breaker['opened'] >= details['breaker_reset']:
+            breaker['state'] = 'half-open'
+            return True
+        return False
+
+
+def _breaker_record(details, error=None):
+    '''
+    Record the outcome of a request to a printer, opening its breaker after
+    too many failures in a row, or when the request let through while it
+    was half-open fails
+    '''
+    breaker = details['breaker']
+    with breaker['lock']:
+        if error is None:
+            if breaker['state'] != 'closed':
+                log.info('OctoPrint printer %s is reachable again', details['name'])
+            breaker.update(state='closed', failures=0, opened=None, error=None)
+            return
+        breaker['failures'] += 1
+        breaker['error'] = error
+        if breaker['state'] == 'half-open' \
+                or breaker['failures'] >= details['breaker_threshold']:
+            if breaker['state'] != 'open':
+                log.warning(
+                    'OctoPrint printer %s is unreachable, failing requests for %s seconds: %s',
+                    details['name'], details['breaker_reset'], error,
+                )
+            breaker['state'] = 'open'
+            breaker['opened'] = time.time()
+
+
+def breaker(printer=None):
+    '''
+    Return the state of the circuit breaker of a printer: ``closed`` while
+    it is reachable, ``open`` while requests to it fail at once, and
+    ``half-open`` while checking whether it is back
+    '''
+    breaker_ = _printer(printer)['breaker']
+    with breaker_['lock']:
+        return {
+            'state': breaker_['state'],
+            'failures': breaker_['failures'],
+            'opened': breaker_['opened'],
+            'error': breaker_['error'],
+        }
+
+
+def probe(printer=None):
+    '''
+    Return whether a printer answers a cheap request right now. The breaker
+    of the printer is honoured, so a printer known to be down is not
+    contacted until it is due to be checked again.
+    '''
+    details = _printer(printer)
+    ret = query(
+        '/api/version',
+        printer=details['name'],
+        max_age=0,
+        retries=0,
+        timeout=min(details['timeout'], 5),
+    )
+    return 'error' not in ret
+
+
+def query(path,
+          method='GET',
+          data=None,
+          params=None,
+          header_dict=None,
+          decode=True,
+          printer=None,
+          max_age=None,
+          retries=None,
+          **kwargs):
+    '''
+    Send a request to the OctoPrint API over the shared session.
+
+    ``path`` is relative to the printer URL, e.g. ``/api/printer``. A ``dict``
+    or ``list`` passed as ``data`` is sent as JSON. Any other ``data`` (a
+    string or file-like object) is sent as-is, and remaining keyword
+    arguments are handed to ``requests``. On a farm proxy, ``printer`` must
+    name the printer to send the request to.
+
+    ``GET`` requests for the resources in ``cache_ttl`` may be answered from
+    the cache. ``max_age`` overrides the TTL of the resource for this
+    request; ``max_age=0`` always contacts the printer.
+
+    ``timeout`` defaults to the printer's ``timeout`` setting, and
+    ``retries`` to its ``retries`` setting. Only ``GET`` requests are retried.
+
+    The return value mirrors ``salt.utils.http.query``: ``status``, ``body``,
+    ``headers`` and, if ``decode`` is True, the decoded JSON in ``dict``. If
+    the printer could not be reached, ``error`` is set and ``status`` is 0.
+    '''
+    details = _printer(printer)
+    resource, key = _cache_key(path, params)
+    ttl = details['cache_ttl'].get(resource, 0)
+    if method.upper() != 'GET':
+        _cache_invalidate(details, resource)
+        _snapshot_invalidate(details, resource)
+    elif ttl:
+        ret = _cache_get(details, resource, key, ttl if max_age is None else float(max_age))
+        if ret is not None:
+            return ret
+
+    headers = dict(header_dict or {})
+    if isinstance(data, (dict, list)):
+        data = json.dumps(data)
+        headers['Content-Type'] = 'application/json'
+    if kwargs.get('timeout') is None:
+        kwargs['timeout'] = details['timeout']
+    if retries is None:
+        retries = details['retries']
+    if method.upper() != 'GET':
+        retries = 0
+
+    send = functools.partial(_request, details, method, path, params, data, headers, retries, kwargs)
+    if method.upper() == 'GET' and data is None:
+        # Identical requests made at the same time share a single response
+        response = _single_flight(details, (key, json.dumps(headers, sort_keys=True)), send)
+    else:
+        response = send()
+    if isinstance(response, dict):
+        return dict(response)
+
+    ret = {
+        'status': response.status_code,
+        'headers': response.headers,
+        'body': response.text,
+    }
+    if decode:
+        try:
+            ret['dict'] = _json_loads(response.content) if response.content else {}
+        except ValueError:
+            log.debug('OctoPrint returned non-JSON data for %s %s', method, path)
+            decode = False
+    if ttl and decode and method.upper() == 'GET' and response.status_code == 200:
+        _cache_put(details, resource, key, response)
+    return ret
+
+
+def _request(details, method, path, params, data, headers, retries, kwargs):
+    '''
+    Send a request to a printer, retrying failed ``GET`` requests while its
+    breaker allows. Return the response, or a dict holding the ``error``.
+    '''
+    session = _session(details)
+    if not _breaker_allow(details):
+        return {
+            'error': 'OctoPrint printer {0} is unreachable: {1}'.format(
+                details['name'], details['breaker']['error']
+            ),
+            'status': 0,
+        }
+
+    attempt = 0
+    error = 'The request to OctoPrint was interrupted'
     try:
-        salt.utils.http.query('{0}/api/version'.format(URL), opts=__opts__)['body']
-    except KeyError:
+        while True:
+            start = time.time()
+            try:
+                if DETAILS.get('replay') is not None:
+                    response = _replay(details, method, path, params, data, headers)
+                else:
+                    response = session.request(
+                        method,
+                        '{0}{1}'.format(details['url'], path),
+                        params=params,
+                        data=data,
+                        headers=headers,
+                        **kwargs
+                    )
+                error = None
+                if response.status_code in UNAVAILABLE:
+                    error = 'OctoPrint is unavailable: HTTP {0}'.format(response.status_code)
+            except requests.exceptions.RequestException as exc:
+                response = None
+                error = str(exc)
+            _metrics_record(details, method, path, time.time() - start, response, error)
+            if DETAILS.get('recorder') is not None:
+                _record(details, method, path, params, data, start, response, error)
+            # The request let through a half-open breaker is not retried, nor
+            # is one to a printer which other requests have found to be down
+            if error is None or attempt >= retries or details['breaker']['state'] != 'closed':
+                break
+            attempt += 1
+            time.sleep(min(2 ** attempt * 0.25, 5) * random.uniform(0.5, 1.5))
+    finally:
+        # A request counts once towards the breaker, however many attempts it
+        # took. Anything unexpected raised on the way still counts as a
+        # failure, or a half-open breaker would never let another request by.
+        _breaker_record(details, error)
+
+    if response is None:
+        log.error('OctoPrint request %s %s to %s failed: %s', method, path, details['name'], error)
+        return {'error': error, 'status': 0}
+    return response
+
+
+def _record(details, method, path, params, data, start, response, error):
+    '''
+    Append a request and its response to the recording
+    '''
+    entry = {
+        'time': round(start, 3),
+        'seconds': round(time.time() - start, 6),
+        'printer': details['name'],
+        'method': method.upper(),
+        'path': path,
+        'params': params or None,
+    }
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    if isinstance(data, str):
+        entry['data'] = data
+    elif data is not None and hasattr(data, '__len__'):
+        # Uploads are not kept, only their size
+        entry['data_bytes'] = len(data)
+    if response is None:
+        entry['error'] = error
+    else:
+        entry['status'] = response.status_code
+        entry['headers'] = dict(
+            (name, response.headers[name]) for name in RECORD_HEADERS if name in response.headers
+        )
+        try:
+            entry['body'] = response.content.decode('utf-8')
+        except UnicodeDecodeError:
+            entry['body64'] = base64.b64encode(response.content).decode('ascii')
+    line = (json.dumps(entry, separators=(',', ':')) + '\n').encode('utf-8')
+
+    recorder = DETAILS['recorder']
+    if recorder['path'].endswith('.gz'):
+        # A gzip file may be made of any number of members, one per record
+        line = gzip.compress(line)
+    with recorder['lock']:
+        try:
+            # Each process opens the file for itself, and appends each record
+            # in a single write, so that jobs forked from the proxy can record
+            # to the same file without mixing up their records
+            if recorder['pid'] != os.getpid():
+                recorder['file'] = open(recorder['path'], 'ab', buffering=0)
+                recorder['pid'] = os.getpid()
+            recorder['file'].write(line)
+        except (IOError, OSError) as exc:
+            log.warning('Unable to record OctoPrint traffic to %s: %s', recorder['path'], exc)
+
+
+def _replay_load(replay):
+    '''
+    Read a recording, indexing its responses by printer, method, path and
+    parameters, and by method, path and parameters alone
+    '''
+    entries = {}
+    count = 0
+    opener = gzip.open if replay['path'].endswith('.gz') else open
+    try:
+        with opener(replay['path'], 'rb') as fh_:
+            for line in fh_:
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                key = (entry['method'], entry['path'], json.dumps(entry.get('params'), sort_keys=True))
+                entries.setdefault((entry['printer'],) + key, []).append(entry)
+                entries.setdefault((None,) + key, []).append(entry)
+                count += 1
+    except (EOFError, IOError, OSError, zlib.error) as exc:
+        # A recording which was cut off or damaged is used up to that point
+        log.warning('Unable to read all of the OctoPrint recording %s: %s', replay['path'], exc)
+    log.debug('Replaying %s OctoPrint requests from %s', count, replay['path'])
+    return entries
+
+
+def _replay(details, method, path, params, data, headers):
+    '''
+    Return the recorded response to a request, as a ``requests`` response,
+    or raise the recorded error
+    '''
+    replay = DETAILS['replay']
+    key = (method.upper(), path, json.dumps(params or None, sort_keys=True))
+    # A 304 only answers a request which asked whether its copy is current
+    conditional = 'If-None-Match' in headers or 'If-Modified-Since' in headers
+    with replay['lock']:
+        if replay['entries'] is None:
+            replay['entries'] = _replay_load(replay)
+        entries = replay['entries'].get((details['name'],) + key) \
+            or replay['entries'].get((None,) + key, [])
+        entries = [entry for entry in entries if conditional or entry.get('status') != 304]
+        cursor = (details['name'], key, conditional)
+        index = replay['cursors'].get(cursor, 0)
+        replay['cursors'][cursor] = index + 1
+    entry = entries[min(index, len(entries) - 1)] if entries else None
+
+    # Read the body as it would be sent, for the sake of uploads
+    if hasattr(data, 'read'):
+        while data.read(65536):
+            pass
+    if entry is not None and replay['latency']:
+        time.sleep(entry['seconds'] * replay['latency'])
+
+    if entry is None:
+        entry = {'status': 404, 'body': json.dumps({'error': 'Not recorded'})}
+    if 'error' in entry:
+        raise requests.exceptions.ConnectionError(entry['error'])
+
+    response = requests.models.Response()
+    response.status_code = entry['status']
+    response.headers = requests.structures.CaseInsensitiveDict(entry.get('headers', {}))
+    if 'body64' in entry:
+        response._content = base64.b64decode(entry['body64'])  # pylint: disable=protected-access
+    else:
+        response._content = entry.get('body', '').encode('utf-8')  # pylint: disable=protected-access
+    response.encoding = 'utf-8'
+    response.url = '{0}{1}'.format(details['url'], path)
+    response.request = requests.Request(method, response.url, headers=headers).prepare()
+    if entry.get('data_bytes') or entry.get('data'):
+        response.request.headers['Content-Length'] = str(
+            entry.get('data_bytes') or len(entry['data'].encode('utf-8')))
+    return response
+
+
+def _metrics_record(details, method, path, seconds, response, error):
+    '''
+    Count a request sent to a printer, under its method and API resource
+    '''
+    resource = '/'.join(path.split('?')[0].split('/')[:3])
+    bucket = bisect.bisect_left(METRIC_BUCKETS, seconds)
+    status = 0 if response is None else response.status_code
+    sent = received = 0
+    if response is not None:
+        sent = int(response.request.headers.get('Content-Length') or 0)
+        received = int(response.headers.get('Content-Length') or len(response.content))
+
+    metrics = details['metrics']
+    with metrics['lock']:
+        entry = metrics['endpoints'].get((method.upper(), resource))
+        if entry is None:
+            entry = metrics['endpoints'][(method.upper(), resource)] = {
+                'count': 0,
+                'errors': 0,
+                'statuses': {},
+                'bytes_sent': 0,
+                'bytes_received': 0,
+                'seconds': 0.0,
+                'buckets': [0] * (len(METRIC_BUCKETS) + 1),
+            }
+        entry['count'] += 1
+        entry['errors'] += error is not None
+        entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+        entry['bytes_sent'] += sent
+        entry['bytes_received'] += received
+        entry['seconds'] += seconds
+        entry['buckets'][bucket] += 1
+
+
+def metrics(printer=None):
+    '''
+    Return the requests sent to a printer, by method and API resource: the
+    number sent, failed and answered with each HTTP status (``0`` if there
+    was no answer), the bytes sent and received, and the time taken. The
+    ``latency`` histogram is cumulative, by the upper bound of each bucket,
+    and ``p50``, ``p90`` and ``p99`` are estimated from it; they are None if
+    above the largest bucket.
+    '''
+    metrics_ = _printer(printer)['metrics']
+    with metrics_['lock']:
+        endpoints = dict(
+            (key, dict(entry, statuses=dict(entry['statuses']), buckets=list(entry['buckets'])))
+            for key, entry in metrics_['endpoints'].items()
+        )
+
+    ret = {}
+    for (method, resource), entry in sorted(endpoints.items()):
+        cumulative = []
+        for count in entry['buckets']:
+            cumulative.append(count + (cumulative[-1] if cumulative else 0))
+        item = {
+            'count': entry['count'],
+            'errors': entry['errors'],
+            'statuses': entry['statuses'],
+            'bytes_sent': entry['bytes_sent'],
+            'bytes_received': entry['bytes_received'],
+            'seconds': round(entry['seconds'], 6),
+            'mean': round(entry['seconds'] / entry['count'], 6),
+            'latency': dict(zip([str(bound) for bound in METRIC_BUCKETS] + ['+Inf'], cumulative)),
+        }
+        for name, quantile in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            rank = bisect.bisect_left(cumulative, quantile * entry['count'])
+            item[name] = METRIC_BUCKETS[rank] if rank < len(METRIC_BUCKETS) else None
+        ret['{0} {1}'.format(method, resource)] = item
+    return ret
+
+
+def _prometheus_labels(labels):
+    '''
+    Format Prometheus labels, escaping their values
+    '''
+    return ','.join(
+        '{0}="{1}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'),
+        )
+        for name, value in sorted(labels.items())
+    )
+
+
+def metrics_text():
+    '''
+    Return the request counters, cache counters and breaker state of every
+    printer in the Prometheus text format
+    '''
+    series = collections.OrderedDict((
+        ('octoprint_requests_total', ('counter', 'Requests sent to OctoPrint, by response status', [])),
+        ('octoprint_request_errors_total', ('counter', 'Requests which got no answer or found OctoPrint unavailable', [])),
+        ('octoprint_request_duration_seconds', ('histogram', 'Time taken by requests sent to OctoPrint', [])),
+        ('octoprint_request_bytes_total', ('counter', 'Bytes of request bodies sent to OctoPrint', [])),
+        ('octoprint_response_bytes_total', ('counter', 'Bytes of response bodies received from OctoPrint', [])),
+        ('octoprint_cache_hits_total', ('counter', 'Requests answered from the cache of the proxy', [])),
+        ('octoprint_cache_misses_total', ('counter', 'Cacheable requests which had to be sent', [])),
+        ('octoprint_breaker_open', ('gauge', 'Whether the printer is considered down by the proxy', [])),
+    ))
+
+    for name in printers():
+        metrics_ = _printer(name)['metrics']
+        with metrics_['lock']:
+            endpoints = [
+                (key, dict(entry, statuses=dict(entry['statuses']), buckets=list(entry['buckets'])))
+                for key, entry in sorted(metrics_['endpoints'].items())
+            ]
+        for (method, resource), entry in endpoints:
+            labels = {'printer': name, 'method': method, 'endpoint': resource}
+            for status, count in sorted(entry['statuses'].items()):
+                series['octoprint_requests_total'][2].append(('', dict(labels, code=status), count))
+            series['octoprint_request_errors_total'][2].append(('', labels, entry['errors']))
+            series['octoprint_request_bytes_total'][2].append(('', labels, entry['bytes_sent']))
+            series['octoprint_response_bytes_total'][2].append(('', labels, entry['bytes_received']))
+            samples = series['octoprint_request_duration_seconds'][2]
+            total = 0
+            for bound, count in zip([str(bound) for bound in METRIC_BUCKETS] + ['+Inf'], entry['buckets']):
+                total += count
+                samples.append(('_bucket', dict(labels, le=bound), total))
+            samples.append(('_sum', labels, entry['seconds']))
+            samples.append(('_count', labels, entry['count']))
+
+        for resource, counters in sorted(cache_stats(name)['resources'].items()):
+            labels = {'printer': name, 'resource': resource}
+            series['octoprint_cache_hits_total'][2].append(('', labels, counters['hits']))
+            series['octoprint_cache_misses_total'][2].append(('', labels, counters['misses']))
+        series['octoprint_breaker_open'][2].append(
+            ('', {'printer': name}, int(breaker(name)['state'] == 'open')))
+
+    lines = []
+    for metric, (kind, help_, samples) in series.items():
+        if not samples:
+            continue
+        lines.append('# HELP {0} {1}'.format(metric, help_))
+        lines.append('# TYPE {0} {1}'.format(metric, kind))
+        for suffix, labels, value in samples:
+            lines.append('{0}{1}{{{2}}} {3}'.format(metric, suffix, _prometheus_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def _metrics_write():
+    '''
+    Write the metrics to the textfile, replacing it in one step so that the
+    node exporter never reads half of it
+    '''
+    path = DETAILS['metrics_textfile']
+    try:
+        with open(path + '.tmp', 'w') as fh_:
+            fh_.write(metrics_text())
+        os.replace(path + '.tmp', path)
+    except (IOError, OSError) as exc:
+        log.warning('Unable to write the OctoPrint metrics to %s: %s', path, exc)
+
+
+def _metrics_writer_start():
+    '''
+    Start writing the metrics to the textfile in the background
+    '''
+    stop = threading.Event()
+
+    def _loop():
+        while not stop.wait(DETAILS['metrics_interval']):
+            _metrics_write()
+
+    thread = threading.Thread(target=_loop, name='octoprint-metrics')
+    thread.daemon = True
+    DETAILS['metrics_writer'] = {'thread': thread, 'stop': stop}
+    thread.start()
+
+
+def _metrics_writer_stop():
+    '''
+    Stop the metrics writer, if it is running, writing the metrics one last
+    time
+    '''
+    writer = DETAILS.pop('metrics_writer', None)
+    if writer is None:
+        return
+    writer['stop'].set()
+    writer['thread'].join(5)
+    _metrics_write()
+
+
+def _single_flight(details, key, send):
+    '''
+    Call ``send`` to make a request, unless an identical request to the same
+    printer is already in flight, in which case wait for its response
+    '''
+    flights = details['flights']
+    with flights['lock']:
+        flight = flights['inflight'].get(key)
+        leader = flight is None
+        if leader:
+            flight = {'done': threading.Event(), 'response': None}
+            flights['inflight'][key] = flight
+            flights['sent'] += 1
+        else:
+            flights['collapsed'] += 1
+
+    if not leader:
+        flight['done'].wait()
+        if flight['response'] is None:
+            # The request failed unexpectedly; try again alone
+            return send()
+        return flight['response']
+
+    try:
+        flight['response'] = send()
+    finally:
+        with flights['lock']:
+            del flights['inflight'][key]
+        flight['done'].set()
+    return flight['response']
+
+
+def snapshot(path, printer=None, max_age=None):
+    '''
+    Return the latest response of a printer to a ``GET`` of one of
+    ``/api/printer``, ``/api/job`` or ``/api/connection``, as kept by the
+    background poller. If ``max_age`` is given and the latest response is
+    older than ``max_age`` seconds, the printer is queried at once instead.
+
+    The response is returned in the same form as by :py:func:`query`, with
+    the time it was received in ``time``.
+    '''
+    details = _printer(printer)
+    snap = details['snapshot']
+    snap['read'] = time.time()
+    if not _poll_start(details) and max_age is None:
+        # Nothing keeps the copy of a forked job up to date
+        max_age = details['poll_interval']
+    with snap['lock']:
+        entry = snap['data'].get(path)
+    if entry is None or max_age is not None and time.time() - entry['time'] > float(max_age):
+        entry = _snapshot_fetch(details, path)
+    ret = dict(entry)
+    if 'body' in ret:
+        try:
+            ret['dict'] = _json_loads(ret['body']) if ret['body'] else {}
+        except ValueError:
+            pass
+    return ret
+
+
+def snapshot_wait(paths, check, printer=None, timeout=None, since=None):
+    '''
+    Wait until ``check`` returns a true value, and return that value, or
+    None after ``timeout`` seconds. ``check`` is called with the decoded
+    responses in the snapshot for each of ``paths``, by path, at first and
+    after each update of the snapshot, or None for a failed request.
+    Responses which are not in the snapshot yet, or which were received
+    before the time ``since``, e.g. before a command which the caller waits
+    on was sent, are fetched first.
+    '''
+    details = _printer(printer)
+    snap = details['snapshot']
+    deadline = None if timeout is None else time.time() + float(timeout)
+    since = since or 0
+    with snap['lock']:
+        snap['waiters'] += 1
+        if snap['waiters'] == 1:
+            # Have the poller pick up its interval for waiting
+            snap['wake'].set()
+    try:
+        while True:
+            snap['read'] = time.time()
+            polled = _poll_start(details)
+            fresh = since
+            if not polled:
+                # A forked job has no poller, and fetches for itself
+                fresh = max(since, time.time() - details['poll_interval_waiting'])
+            with snap['lock']:
+                entries = dict((path, snap['data'].get(path)) for path in paths)
+            data = {}
+            for path, entry in entries.items():
+                data[path] = None
+                if entry is None or entry['time'] < fresh:
+                    entry = entries[path] = _snapshot_fetch(details, path)
+                if entry.get('status') == 200:
+                    try:
+                        data[path] = _json_loads(entry['body'])
+                    except ValueError:
+                        pass
+            ret = check(data)
+            if ret:
+                return ret
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return None
+            with snap['changed']:
+                if all(snap['data'].get(path) is entries[path] for path in paths):
+                    # Wake up now and then to keep the poller going
+                    pause = POLL_LINGER / 2 if polled else details['poll_interval_waiting']
+                    snap['changed'].wait(pause if remaining is None else min(remaining, pause))
+    finally:
+        with snap['lock']:
+            snap['waiters'] -= 1
+
+
+def _snapshot_fetch(details, path):
+    '''
+    Query a printer for one of the snapshot resources, and store the result
+    in its snapshot. Failures are stored too, so that callers see the error
+    instead of an outdated status.
+    '''
+    entry = query(path, decode=False, printer=details['name'])
+    entry['time'] = time.time()
+    _snapshot_store(details, path, entry)
+    if details['telemetry'] is not None and entry.get('status') == 200 and path != '/api/connection':
+        try:
+            data = _json_loads(entry['body'])
+        except ValueError:
+            return entry
+        if path == '/api/printer':
+            _telemetry_record(details, entry['time'], _telemetry_values(data.get('temperature')))
+        else:
+            _telemetry_record(details, entry['time'], _telemetry_values(progress=data.get('progress')))
+    return entry
+
+
+def _snapshot_store(details, path, entry):
+    '''
+    Store a response in the snapshot of a printer, and wake anything waiting
+    on the snapshot
+    '''
+    snap = details['snapshot']
+    with snap['changed']:
+        snap['data'][path] = entry
+        snap['changed'].notify_all()
+
+
+def _snapshot_push(details, message):
+    '''
+    Update the printer and job status in the snapshot of a printer from a
+    ``current`` or ``history`` message of the push API, which carries the
+    same state, job, progress and temperatures
+    '''
+    current = message.get('current') or message.get('history')
+    if not isinstance(current, dict) or not isinstance(current.get('state'), dict):
+        return
+    snap = details['snapshot']
+    with snap['lock']:
+        entries = dict((path, snap['data'].get(path)) for path in ('/api/printer', '/api/job'))
+    data = {}
+    for path, entry in entries.items():
+        data[path] = {}
+        if entry is not None and entry.get('status') == 200:
+            try:
+                data[path] = _json_loads(entry['body'])
+            except ValueError:
+                pass
+
+    now = time.time()
+    if details['telemetry'] is not None:
+        _telemetry_push(details, current, now)
+    data['/api/job'].update(
+        job=current.get('job'),
+        progress=current.get('progress'),
+        state=current['state'].get('text'),
+    )
+    _snapshot_store(details, '/api/job', {'status': 200, 'headers': {}, 'body': json.dumps(data['/api/job']), 'time': now})
+    if current['state'].get('flags', {}).get('closedOrError'):
+        # OctoPrint answers /api/printer with an error while disconnected
+        _snapshot_invalidate(details, '/api/printer')
+        return
+    data['/api/printer']['state'] = current['state']
+    if current.get('temps'):
+        data['/api/printer']['temperature'] = dict(
+            (heater, value) for heater, value in current['temps'][-1].items() if heater != 'time'
+        )
+    _snapshot_store(details, '/api/printer', {
+        'status': 200, 'headers': {}, 'body': json.dumps(data['/api/printer']), 'time': now,
+    })
+
+
+def _telemetry_init(details):
+    '''
+    Allocate the telemetry store of a printer, if it is enabled. Each tier
+    is a ring of a fixed number of slots of ``resolution`` seconds, and the
+    tiers are laid out one after the other in the same arrays: the number of
+    each slot (its time divided by the resolution), and the sum and count of
+    the samples of each channel which fell in it.
+    '''
+    if not details['telemetry']:
+        return None
+    if not HAS_NUMPY:
+        log.error('OctoPrint telemetry requires numpy, which is not installed')
+        return None
+    retention = dict(TELEMETRY_RETENTION)
+    retention.update(details['telemetry_retention'] or {})
+    tiers = []
+    offset = 0
+    for resolution, seconds in sorted((float(key), float(value)) for key, value in retention.items()):
+        size = int(seconds // resolution)
+        if size < 1:
+            continue
+        tiers.append({'resolution': resolution, 'size': size, 'offset': offset})
+        offset += size
+    return {
+        'lock': threading.Lock(),
+        'channels': [],
+        'index': {},
+        'tiers': tiers,
+        'slots': np.zeros(offset, dtype=np.int64),
+        'sums': np.zeros((offset, 0), dtype=np.float32),
+        'counts': np.zeros((offset, 0), dtype=np.uint32),
+    }
+
+
+def _telemetry_values(temperature=None, progress=None, current_z=None):
+    '''
+    Return the telemetry channels found in a printer status: the actual and
+    target temperature of each heater, the job progress and the height of
+    the nozzle
+    '''
+    ret = {}
+    for heater, value in (temperature or {}).items():
+        if not isinstance(value, dict):
+            continue
+        for key in ('actual', 'target'):
+            if isinstance(value.get(key), (int, float)):
+                ret['{0}.{1}'.format(heater, key)] = value[key]
+    if isinstance(progress, dict) and isinstance(progress.get('completion'), (int, float)):
+        ret['progress'] = progress['completion']
+    if isinstance(current_z, (int, float)):
+        ret['z'] = current_z
+    return ret
+
+
+def _telemetry_push(details, current, now):
+    '''
+    Record the telemetry in a push API message. Its temperatures come with
+    the time they were read by the printer, which is only used to place them
+    relative to each other, as the printer's clock may be off.
+    '''
+    temps = [item for item in current.get('temps') or [] if isinstance(item, dict)]
+    latest = temps[-1].get('time') if temps else None
+    for item in temps:
+        stamp = now
+        if isinstance(item.get('time'), (int, float)) and isinstance(latest, (int, float)):
+            stamp = now - (latest - item['time'])
+        _telemetry_record(details, stamp, _telemetry_values(item))
+    _telemetry_record(
+        details,
+        now,
+        _telemetry_values(progress=current.get('progress'), current_z=current.get('currentZ')),
+    )
+
+
+def _telemetry_record(details, stamp, values):
+    '''
+    Add a sample of some channels to every tier of the telemetry of a
+    printer. Samples older than what a slot already holds are dropped, so
+    that a late sample never overwrites newer data.
+    '''
+    telemetry = details['telemetry']
+    if not values:
+        return
+    with telemetry['lock']:
+        columns = []
+        samples = []
+        for channel, value in values.items():
+            column = telemetry['index'].get(channel)
+            if column is None:
+                if len(telemetry['channels']) >= TELEMETRY_CHANNELS:
+                    continue
+                column = telemetry['index'][channel] = len(telemetry['channels'])
+                telemetry['channels'].append(channel)
+                rows = len(telemetry['slots'])
+                telemetry['sums'] = np.hstack((telemetry['sums'], np.zeros((rows, 1), dtype=np.float32)))
+                telemetry['counts'] = np.hstack((telemetry['counts'], np.zeros((rows, 1), dtype=np.uint32)))
+            columns.append(column)
+            samples.append(value)
+        # A few scalar updates per tier are quicker than fancy indexing
+        for tier in telemetry['tiers']:
+            slot = int(stamp // tier['resolution'])
+            row = tier['offset'] + slot % tier['size']
+            held = telemetry['slots'][row]
+            if held > slot:
+                continue
+            sums = telemetry['sums'][row]
+            counts = telemetry['counts'][row]
+            if held < slot:
+                telemetry['slots'][row] = slot
+                sums[:] = 0
+                counts[:] = 0
+            for column, sample in zip(columns, samples):
+                sums[column] += sample
+                counts[column] += 1
+
+
+def telemetry(printer=None, start=None, end=None, resolution=None, channels=None):
+    '''
+    Return the telemetry of a printer between the times ``start`` and
+    ``end``, by default the last hour, averaged over ``resolution`` seconds.
+    It is read from the coarsest tier which still holds ``start`` and whose
+    resolution is no coarser than ``resolution``, or else the finest tier
+    which holds ``start``. ``channels`` limits the channels returned.
+
+    The values of each channel are returned in ``series``, along with the
+    start of each interval in ``time``. Intervals without any sample are
+    left out, and channels without a sample in an interval are None.
+    '''
+    details = _printer(printer)
+    telemetry = details['telemetry']
+    if telemetry is None:
+        raise CommandExecutionError(
+            'Telemetry is not enabled for {0}, or numpy is not installed'.format(details['name'])
+        )
+    now = time.time()
+    end = now if end is None else float(end)
+    start = end - 3600 if start is None else float(start)
+    if resolution is not None and float(resolution) <= 0:
+        raise CommandExecutionError('The resolution must be a positive number of seconds')
+
+    # The tiers which still hold ``start``, or the one holding the most
+    covering = [
+        tier for tier in telemetry['tiers'] if now - tier['size'] * tier['resolution'] <= start
+    ] or telemetry['tiers'][-1:]
+    tier = covering[0]
+    for candidate in covering:
+        if resolution is not None and candidate['resolution'] <= float(resolution):
+            tier = candidate
+    step = tier['resolution']
+    resolution = max(step, float(resolution or step))
+
+    # The slots of the range which the tier still holds
+    first = max(int(start // step), int(now // step) - tier['size'] + 1)
+    last = int(min(end, now) // step)
+    ret = {'resolution': resolution, 'time': [], 'series': {}}
+    if last < first:
+        return ret
+    slots = np.arange(first, last + 1, dtype=np.int64)
+    rows = tier['offset'] + slots % tier['size']
+    with telemetry['lock']:
+        names = list(telemetry['channels'])
+        valid = telemetry['slots'][rows] == slots
+        sums = telemetry['sums'][rows].astype(np.float64)
+        counts = telemetry['counts'][rows].astype(np.float64)
+    if channels is not None:
+        wanted = [name for name in names if name in channels]
+        columns = [names.index(name) for name in wanted]
+        names, sums, counts = wanted, sums[:, columns], counts[:, columns]
+
+    # Sum up the slots of each interval of the requested resolution
+    sums[~valid] = 0
+    counts[~valid] = 0
+    buckets = (slots * step // resolution).astype(np.int64)
+    starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+    sums = np.add.reduceat(sums, starts, axis=0)
+    counts = np.add.reduceat(counts, starts, axis=0)
+    keep = counts.any(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.round(sums[keep] / counts[keep], 3)
+    ret['time'] = (buckets[starts][keep] * resolution).tolist()
+    for column, name in enumerate(names):
+        values = means[:, column]
+        ret['series'][name] = np.where(np.isnan(values), None, values).tolist()
+    return ret
+
+
+def _snapshot_invalidate(details, resource):
+    '''
+    Drop a resource from the snapshot of a printer after a change was made
+    to it, and have the poller fetch it again at once
+    '''
+    snap = details['snapshot']
+    if resource not in SNAPSHOT_PATHS:
+        return
+    with snap['lock']:
+        snap['data'].pop(resource, None)
+    snap['wake'].set()
+
+
+def _poll_start(details):
+    '''
+    Start the snapshot poller of a printer, if it is not already running.
+    Returns whether the poller runs, which it only does in the proxy process
+    itself: a job forked from it is short-lived, and a poller of its own
+    would only add requests to those of the proxy's poller.
+    '''
+    if DETAILS.get('pid') != os.getpid():
         return False
+    snap = details['snapshot']
+    with SESSION_LOCK:
+        if snap['thread'] is not None and snap['thread'].is_alive():
+            return True
+        snap['stop'].clear()
+        snap['thread'] = threading.Thread(
+            target=_poll_loop,
+            args=(details,),
+            name='octoprint-poll-{0}'.format(details['name']),
+        )
+        snap['thread'].daemon = True
+        snap['thread'].start()
     return True
 
 
-def grains():
+def _poll_loop(details):
     '''
-    Get the grains from the proxied device
+    Keep the snapshot of a printer up to date, polling more often while it
+    prints and less often while it cannot be reached
     '''
-    if not DETAILS.get('grains_cache', {}):
-        DETAILS['grains_cache'] = {
-            'host': __opts__['pillar']['proxy']['url'].split('://')[1].split('/')[0],
-            'kernel': 'OctoPrint',
-            'os': 'OctoPrint',
-            'os_family': 'OctoPrint',
-            'osfullname': 'OctoPrint',
+    snap = details['snapshot']
+    offline = details['poll_interval']
+    while not snap['stop'].is_set():
+        if details['telemetry'] is None and time.time() - snap['read'] > POLL_LINGER:
+            log.debug('Stopping the idle OctoPrint poller for %s', details['name'])
+            break
+        snap['wake'].clear()
+        entries = [_snapshot_fetch(details, path) for path in SNAPSHOT_PATHS]
+        if any('error' in entry for entry in entries):
+            interval = offline
+            offline = min(offline * 2, details['poll_interval_offline'])
+        else:
+            offline = details['poll_interval']
+            interval = details['poll_interval']
+            if _printing(entries[0]):
+                interval = details['poll_interval_printing']
+            push = details['push']
+            if snap['waiters'] and (push is None or push['socket'] is None):
+                interval = min(interval, details['poll_interval_waiting'])
+        snap['wake'].wait(interval * random.uniform(0.9, 1.1))
+    with SESSION_LOCK:
+        if snap['thread'] is threading.current_thread():
+            snap['thread'] = None
+
+
+def _printing(entry):
+    '''
+    Return whether a printer status response shows a print in progress
+    '''
+    try:
+        flags = _json_loads(entry['body'])['state']['flags']
+    except (KeyError, TypeError, ValueError):
+        return False
+    return any(flags.get(flag) for flag in ('printing', 'pausing', 'cancelling', 'finishing'))
+
+
+def _poll_stop(details):
+    '''
+    Stop the snapshot poller of a printer, if it is running
+    '''
+    snap = details['snapshot']
+    snap['stop'].set()
+    snap['wake'].set()
+    thread = snap['thread']
+    if thread is not None:
+        thread.join(5)
+
+
+def push_start(printer=None):
+    '''
+    Start the background connection to OctoPrint's push API, if it is not
+    already running. Returns False if the connection cannot be started.
+    '''
+    if not HAS_WEBSOCKET:
+        log.error('The OctoPrint push API requires the websocket-client library')
+        return False
+
+    details = _printer(printer)
+    with SESSION_LOCK:
+        push = details['push']
+        if push is not None and push['thread'].is_alive():
+            return True
+        push = {
+            'queue': collections.deque(maxlen=details['push_queue_size']),
+            'stop': threading.Event(),
+            'socket': None,
         }
+        push['thread'] = threading.Thread(
+            target=_push_loop,
+            args=(details, push),
+            name='octoprint-push-{0}'.format(details['name']),
+        )
+        push['thread'].daemon = True
+        details['push'] = push
+        push['thread'].start()
+    return True
+
+
+def push_messages(printer=None):
+    '''
+    Remove and return the messages received from the push API since the last
+    call, oldest first
+    '''
+    push = _printer(printer)['push']
+    ret = []
+    if push is None:
+        return ret
+    while True:
         try:
-            version = salt.utils.http.query(
-                '{0}/api/version'.format(__opts__['pillar']['proxy']['url']),
-                opts=__opts__,
-                decode=True,
-                decode_type='json',
-            )['dict']
-            DETAILS['grains_cache'].update({
-                'kernelrelease': version['server'],
-                'kernelversion': version['server'],
-                'osfinger': version['text'].replace(' ', '_'),
-                'osmajorrelease': version['server'].split('.')[0],
-                'osrelease': version['server'],
-                'osrelease_info': version['server'].split('.'),
-            })
-        except KeyError:
-            pass
+            ret.append(push['queue'].popleft())
+        except IndexError:
+            return ret
+
+
+def _push_loop(details, push):
+    '''
+    Receive messages from the push API until stopped, reconnecting with a
+    jittered exponential backoff whenever the connection drops
+    '''
+    url = details['push_url']
+    if not url:
+        url = '{0}/sockjs/websocket'.format(details['url'].replace('http', 'ws', 1))
+
+    backoff = 1
+    while not push['stop'].is_set():
+        try:
+            # Newer OctoPrint releases only send data to authenticated sockets
+            login = query(
+                '/api/login',
+                'POST',
+                data={'passive': True},
+                printer=details['name'],
+            ).get('dict') or {}
+            push['socket'] = websocket.create_connection(url, timeout=60)
+            if login.get('session'):
+                push['socket'].send(json.dumps({
+                    'auth': '{0}:{1}'.format(login['name'], login['session']),
+                }))
+            log.debug('Connected to the OctoPrint push API at %s', url)
+            backoff = 1
+            while not push['stop'].is_set():
+                message = push['socket'].recv()
+                if not message:
+                    break
+                message = _json_loads(message)
+                push['queue'].append(message)
+                if isinstance(message, dict):
+                    _snapshot_push(details, message)
+        except (websocket.WebSocketException, socket.error, ValueError) as exc:
+            if not push['stop'].is_set():
+                log.warning('OctoPrint push connection to %s failed: %s', url, exc)
+        finally:
+            if push['socket'] is not None:
+                push['socket'].close()
+                push['socket'] = None
+        push['stop'].wait(backoff * random.uniform(0.5, 1.5))
+        backoff = min(backoff * 2, 60)
+
+
+def _push_stop(details):
+    '''
+    Stop the push API connection of a printer, if it is running
+    '''
+    push = details['push']
+    details['push'] = None
+    if push is None:
+        return
+    push['stop'].set()
+    sock = push['socket']
+    if sock is not None:
+        sock.abort()
+    push['thread'].join(5)
+
+
+def alive(opts):
+    '''
+    Return whether the printer answers. On a farm proxy, return whether any
+    printer answers, as reconnecting the proxy will not help a single
+    printer which is down.
+    '''
+    return any(probe(name) for name in printers())
+
+
+def _printer_grains(details):
+    '''
+    Return the grains for a single printer
+    '''
+    grains = {
+        'host': details['url'].split('://')[1].split('/')[0],
+        'kernel': 'OctoPrint',
+        'os': 'OctoPrint',
+        'os_family': 'OctoPrint',
+        'osfullname': 'OctoPrint',
+    }
+    try:
+        version = query(
+            '/api/version',
+            printer=details['name'],
+            retries=0,
+            timeout=min(details['timeout'], GRAINS_TIMEOUT),
+        )['dict']
+        grains.update({
+            'kernelrelease': version['server'],
+            'kernelversion': version['server'],
+            'osfinger': version['text'].replace(' ', '_'),
+            'osmajorrelease': version['server'].split('.')[0],
+            'osrelease': version['server'],
+            'osrelease_info': version['server'].split('.'),
+        })
+    except KeyError:
+        pass
+    return grains
+
+
+def grains():
+    '''
+    Get the grains from the proxied device. On a farm proxy, the grains of
+    each printer are found under ``printers``, and are fetched from the
+    printers concurrently.
+    '''
+    if not DETAILS.get('grains_cache', {}):
+        details = _printers()
+        if not DETAILS['farm']:
+            DETAILS['grains_cache'] = _printer_grains(next(iter(details.values())))
+        else:
+            workers = max(1, min(DETAILS['fanout_workers'], len(details)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                found = dict(zip(details, pool.map(_printer_grains, details.values())))
+            DETAILS['grains_cache'] = {
+                'kernel': 'OctoPrint',
+                'os': 'OctoPrint',
+                'os_family': 'OctoPrint',
+                'osfullname': 'OctoPrint',
+                'printers': found,
+            }
     return DETAILS['grains_cache']
 
 
@@ -98,11 +1896,24 @@ def ping():
     '''
     Is the server up?
     '''
-    return True
+    return alive(__opts__)
 
 
 def shutdown(opts):
     '''
-    For this proxy shutdown is a no-op
+    Close the pooled connections to the printers
     '''
-    pass
+    _metrics_writer_stop()
+    recorder = DETAILS.get('recorder')
+    if recorder is not None and recorder['file'] is not None:
+        with recorder['lock']:
+            recorder['file'].close()
+            recorder['file'] = None
+            recorder['pid'] = None
+    for details in DETAILS.get('printers', {}).values():
+        _push_stop(details)
+        _poll_stop(details)
+        session = details['session']
+        details['session'] = None
+        if session is not None:
+            session.close()
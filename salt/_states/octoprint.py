@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+'''
+Wait for OctoPrint printers
+===========================
+
+These states hold up a state run until a printer is in a given state, or a
+heater has reached its temperature, such as before starting a print:
+
+.. code-block:: yaml
+
+    printer connected:
+      octoprint.wait_for_state:
+        - name: Operational
+        - timeout: 60
+
+    bed heated:
+      octoprint.wait_for_temperature:
+        - name: bed
+        - target: 60
+        - require:
+          - octoprint: printer connected
+'''
+# Import Python libs
+from __future__ import absolute_import, unicode_literals, print_function
+import logging
+
+# Import OctoSalt libs
+from octosalt import single_printer as _single_printer  # pylint: disable=import-error
+
+log = logging.getLogger(__name__)
+
+
+def __virtual__():
+    '''
+    Only load the module if proxy configuration is present
+    '''
+    if __opts__['pillar'].get('proxy', {}).get('proxytype', '') == 'octoprint':
+        return True
+    return (False, 'The OctoPrint modules cannot be loaded: proxy is not configured.')
+
+
+def wait_for_state(name, timeout=300, printer=None):
+    '''
+    Wait for the printer to be in a state
+
+    .. code-block:: yaml
+
+        printer paused:
+          octoprint.wait_for_state:
+            - name:
+              - Paused
+              - Operational
+            - timeout: 600
+
+    name
+        The state, such as ``Operational`` or ``Printing``, or a list of
+        states. See ``octoprint.wait_for_state``.
+
+    timeout
+        The seconds to wait before failing
+
+    printer
+        On a farm proxy, the name of the printer to wait on
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': None,
+           'comment': ''}
+
+    printer = _single_printer(ret, __salt__['octoprint.printers'](printer))
+    if printer is None:
+        return ret
+
+    if __opts__['test']:
+        # Only look at the current state
+        timeout = 0
+    wait = __salt__['octoprint.wait_for_state'](name, timeout=timeout, printer=printer)
+    if wait['result']:
+        ret['result'] = True
+        ret['comment'] = 'The printer is {0}'.format(wait['state'])
+    elif 'error' not in wait:
+        ret['result'] = False
+        ret['comment'] = 'The printer is {0}'.format(wait['state'])
+    elif __opts__['test']:
+        ret['comment'] = 'The printer is {0}, and would be waited on'.format(wait['state'])
+    else:
+        ret['result'] = False
+        ret['comment'] = '{0}; the printer is {1}'.format(wait['error'], wait['state'])
+    return ret
+
+
+def wait_for_temperature(name, target=None, tolerance=2, timeout=900, printer=None):
+    '''
+    Wait for a heater to reach a temperature
+
+    .. code-block:: yaml
+
+        tool0:
+          octoprint.wait_for_temperature:
+            - target: 215
+            - tolerance: 3
+
+    name
+        The heater, such as ``tool0`` or ``bed``
+
+    target
+        The temperature to wait for. Defaults to the target temperature set
+        on the printer.
+
+    tolerance
+        How many degrees the temperature may be off the target
+
+    timeout
+        The seconds to wait before failing
+
+    printer
+        On a farm proxy, the name of the printer to wait on
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': None,
+           'comment': ''}
+
+    printer = _single_printer(ret, __salt__['octoprint.printers'](printer))
+    if printer is None:
+        return ret
+
+    if __opts__['test']:
+        timeout = 0
+    wait = __salt__['octoprint.wait_for_temperature'](
+        name,
+        target=target,
+        tolerance=tolerance,
+        timeout=timeout,
+        printer=printer,
+    )
+    comment = '{0} is at {1}, for a target of {2}'.format(name, wait['actual'], wait['target'])
+    if wait['result']:
+        ret['result'] = True
+        ret['comment'] = comment
+    elif __opts__['test']:
+        ret['comment'] = '{0}, and would be waited on'.format(comment)
+    else:
+        ret['result'] = False
+        ret['comment'] = '{0}; {1}'.format(wait['error'], comment)
+    return ret
@@ -17,9 +17,11 @@ protocol
 '''
 # Import Python libs
 from __future__ import absolute_import, unicode_literals, print_function
-import hashlib
 import logging
 
+# Import OctoSalt libs
+from octosalt import single_printer as _single_printer  # pylint: disable=import-error
+
 log = logging.getLogger(__name__)
 __virtualname__ = 'octo_file'
 
@@ -33,7 +35,7 @@ def __virtual__():
     return (False, 'The OctoPrint modules cannot be loaded: proxy is not configured.')
 
 
-def present(name, path):
+def present(name, path, analyze=False, minify=False, printer=None):
     '''
     Ensure that a file is on the printer
 
@@ -47,21 +49,32 @@ def present(name, path):
         The name of the printer profile
 
     path
-        The path on the hosting minion to a file to upload to the printer
+        The path on the hosting minion to a file to upload to the printer. If
+        the same content is already elsewhere on the printer, it is copied
+        into place instead; see the ``dedup`` argument of ``octo_file.upload``.
+
+    analyze
+        Analyze a G-code file on the hosting minion when it is uploaded, and
+        report the results with the changes. See ``octo_gcode.analyze``.
+
+    minify
+        Upload a smaller copy of a G-code file, made by ``octo_gcode.minify``.
+        The copy is compared with the file on the printer. Set to a dict to
+        pass options to ``octo_gcode.minify``.
+
+    printer
+        On a farm proxy, the name of the printer to manage
     '''
     ret = {'name': name,
            'changes': {},
            'result': None,
            'comment': ''}
 
-    location = name.split('/')[0]
-    file_name = '/'.join(name.split('/')[1:])
-    files = __salt__['octo_file.list']()['files']
-    file_data = {}
-    for item in files:
-        if item['name'] == file_name:
-            file_data = item
-            break
+    printer = _single_printer(ret, __salt__['octoprint.printers'](printer))
+    if printer is None:
+        return ret
+
+    file_data = __salt__['octo_file.stat'](name, printer=printer)
 
     local_sha1 = None
 
@@ -71,15 +84,8 @@ def present(name, path):
             ret['comment'] = 'The specified file ({0}) does not exist'.format(name)
             return ret
 
-    blocksize = 65536
-    m = hashlib.sha1()
-    with open(path, 'rb') as f:
-        buffer = f.read(blocksize)
-        while len(buffer) > 0:
-            m.update(buffer)
-            buffer = f.read(blocksize)
-    local_sha1 = m.hexdigest()
-    if local_sha1 == file_data['hash']:
+    local_sha1 = __salt__['octo_file.local_hash'](path, minify=minify)
+    if local_sha1 == file_data.get('hash'):
         ret['result'] = True
         ret['comment'] = 'The correct file exists on the printer'
         return ret
@@ -90,10 +96,23 @@ def present(name, path):
                           'match the local hash ({})'.format(file_data['hash'], local_sha1))
         return ret
 
-    ret['comment'] = __salt__['octo_file.upload'](path, name)
+    ret['comment'] = __salt__['octo_file.upload'](
+        path,
+        name,
+        analyze=analyze,
+        minify=minify,
+        printer=printer,
+    )
     ret['result'] = True
     ret['changes'] = {
         'old sha1': file_data.get('hash'),
         'new sha1': local_sha1,
     } 
+    if 'analysis' in ret['comment']:
+        ret['changes']['analysis'] = ret['comment'].pop('analysis')
+    if 'minify' in ret['comment']:
+        ret['changes']['minify'] = ret['comment'].pop('minify')
+    if 'dedup' in ret['comment']:
+        # The content was already on the printer, and was copied into place
+        ret['changes']['copied from'] = ret['comment']['dedup']['source']
     return ret
@@ -19,6 +19,9 @@ protocol
 from __future__ import absolute_import, unicode_literals, print_function
 import logging
 
+# Import OctoSalt libs
+from octosalt import single_printer as _single_printer  # pylint: disable=import-error
+
 log = logging.getLogger(__name__)
 __virtualname__ = 'octo_printer'
 
@@ -32,7 +35,7 @@ def __virtual__():
     return (False, 'The OctoPrint modules cannot be loaded: proxy is not configured.')
 
 
-def profile(name, profile=None, absent=False):
+def profile(name, profile=None, absent=False, printer=None):
     '''
     Manage the slicer profile
 
@@ -53,6 +56,9 @@ def profile(name, profile=None, absent=False):
 
     absent
         If True, the profile will be deleted
+
+    printer
+        On a farm proxy, the name of the printer to manage
     '''
     ret = {'name': name,
            'changes': {},
@@ -64,7 +70,11 @@ def profile(name, profile=None, absent=False):
         ret['comment'] = 'Missing profile or absent parameters'
         return ret
 
-    printers = __salt__['octo_printer.list']()['profiles']
+    printer = _single_printer(ret, __salt__['octoprint.printers'](printer))
+    if printer is None:
+        return ret
+
+    printers = __salt__['octo_printer.list'](printer=printer)['profiles']
 
     if name not in printers:
         ret['result'] = False
@@ -91,9 +101,13 @@ def profile(name, profile=None, absent=False):
         return ret
 
     if not old_data:
-        __salt__['octo_printer.add_profile']({'profile': profile})
+        __salt__['octo_printer.add_profile']({'profile': profile}, printer=printer)
     else:
-        ret['comment'] = __salt__['octo_printer.update_profile'](name, {'profile': profile})
+        ret['comment'] = __salt__['octo_printer.update_profile'](
+            name,
+            {'profile': profile},
+            printer=printer,
+        )
 
     ret['result'] = True
     ret['changes'] = {
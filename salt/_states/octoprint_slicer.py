@@ -20,6 +20,9 @@ protocol
 from __future__ import absolute_import, unicode_literals, print_function
 import logging
 
+# Import OctoSalt libs
+from octosalt import single_printer as _single_printer  # pylint: disable=import-error
+
 log = logging.getLogger(__name__)
 __virtualname__ = 'octo_slicer'
 
@@ -33,7 +36,7 @@ def __virtual__():
     return (False, 'The OctoPrint modules cannot be loaded: proxy is not configured.')
 
 
-def profile(name, slicer, profile=None, absent=False):
+def profile(name, slicer, profile=None, absent=False, printer=None):
     '''
     Manage the slicer profile
 
@@ -63,6 +66,9 @@ def profile(name, slicer, profile=None, absent=False):
 
     absent
         If True, the profile will be deleted
+
+    printer
+        On a farm proxy, the name of the printer to manage
     '''
     ret = {'name': name,
            'changes': {},
@@ -74,8 +80,12 @@ def profile(name, slicer, profile=None, absent=False):
         ret['comment'] = 'Missing profile or absent parameters'
         return ret
 
-    slicers = __salt__['octo_slicer.list']().keys()
-    old_data = __salt__['octo_slicer.get_profile'](slicer, name)
+    printer = _single_printer(ret, __salt__['octoprint.printers'](printer))
+    if printer is None:
+        return ret
+
+    slicers = __salt__['octo_slicer.list'](printer=printer).keys()
+    old_data = __salt__['octo_slicer.get_profile'](slicer, name, printer=printer)
 
     if old_data == 'Either the slicer or the profile was not found':
         ret['result'] = False
@@ -100,7 +110,7 @@ def profile(name, slicer, profile=None, absent=False):
     if __opts__['test'] is True:
         return ret
 
-    __salt__['octo_slicer.save_profile'](slicer, name, profile)
+    __salt__['octo_slicer.save_profile'](slicer, name, profile, printer=printer)
 
     ret['result'] = True
     ret['changes'] = {
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+'''
+Shared helpers for the OctoSalt modules
+
+The ``fanout`` decorator is imported by the execution modules when they
+load, which Salt allows for its utils directories:
+
+.. code-block:: python
+
+    from octosalt import fanout as _fanout
+
+It must be imported under a private name, or Salt would expose it as a
+function of the module. So is ``response``, which returns the decoded body
+of a response from the proxy, or raises ``CommandExecutionError``, and
+``single_printer``, which the states use to find the one printer they manage.
+
+The status beacons, ``octoprint`` and ``octoprint_job``, only differ in the
+status they fire and in their default thresholds. The rest of their work,
+reducing a status to the fields which changed since the last event, is done
+here and called through ``__utils__``:
+
+.. code-block:: python
+
+    __utils__['octosalt.beacon_events'](
+        config, 'octoprint', DEFAULT_THRESHOLDS, __salt__['octoprint.status'],
+        __salt__['octoprint.printers'](), farm, __context__,
+    )
+'''
+
+# Import python libs
+from __future__ import absolute_import, generators, print_function, with_statement, unicode_literals
+import fnmatch
+import functools
+import inspect
+import logging
+import time
+
+# Import salt libs
+from salt.exceptions import CommandExecutionError
+
+log = logging.getLogger(__name__)
+
+
+def fanout(func):
+    '''
+    Run the decorated function on each printer selected by its ``printer``
+    argument. See the farm mode documentation of the octoprint proxy.
+
+    The proxy is looked up in the function's own module when it is called,
+    as Salt only packs ``__proxy__`` into a module after loading it.
+    '''
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        printer = bound.arguments.pop('printer', None)
+        proxy = func.__globals__['__proxy__']
+        return proxy['octoprint.fanout'](func, printer, *bound.args, **bound.kwargs)
+    return wrapped
+
+
+def single_printer(ret, printers):
+    '''
+    Return the one printer a state manages, from the names selected by its
+    ``printer`` argument. If there is not exactly one, fail the state's
+    ``ret`` and return None.
+    '''
+    if len(printers) == 1:
+        return printers[0]
+    ret['result'] = False
+    ret['comment'] = 'A single printer must be selected, found: {0}'.format(printers)
+    return None
+
+
+def response(ret, statuses=(200,)):
+    '''
+    Return the decoded body of a response from ``octoprint.query`` or
+    ``octoprint.snapshot``. Raise ``CommandExecutionError`` if the printer
+    could not be reached, or answered with a status not in ``statuses`` or
+    with a body which is not JSON, such as the plain text ``409`` OctoPrint
+    sends while it is not connected to the printer.
+    '''
+    if 'error' in ret:
+        raise CommandExecutionError(ret['error'])
+    if int(ret.get('status', 0)) not in statuses or 'dict' not in ret:
+        body = (ret.get('body') or '').strip()
+        raise CommandExecutionError('OctoPrint answered HTTP {0}{1}'.format(
+            ret.get('status'), ': {0}'.format(body[:200]) if body else '',
+        ))
+    return ret['dict']
+
+
+def beacon_config(config):
+    '''
+    Merge a list-style beacon configuration into a single dict
+    '''
+    if isinstance(config, dict):
+        return config
+    _config = {}
+    list(map(_config.update, config))
+    return _config
+
+
+def beacon_validate(config, name):
+    '''
+    Validate the configuration of a status beacon, by the beacon's name
+    '''
+    _conf = beacon_config(config)
+    thresholds = _conf.get('thresholds', {})
+    if not isinstance(thresholds, dict):
+        return False, 'Thresholds for the {0} beacon must be a dictionary'.format(name)
+    for field, threshold in thresholds.items():
+        try:
+            float(threshold)
+        except (TypeError, ValueError):
+            return False, 'The threshold for {0} must be a number'.format(field)
+    return True, 'Valid beacon configuration'
+
+
+def flatten(data, prefix=''):
+    '''
+    Flatten nested dicts into a single dict keyed by dotted field names
+    '''
+    ret = {}
+    for key, value in data.items():
+        name = '{0}{1}'.format(prefix, key)
+        if isinstance(value, dict) and value:
+            ret.update(flatten(value, name + '.'))
+        else:
+            ret[name] = value
+    return ret
+
+
+def unflatten(data):
+    '''
+    Rebuild nested dicts from dotted field names
+    '''
+    ret = {}
+    for name, value in data.items():
+        keys = name.split('.')
+        node = ret
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = value
+    return ret
+
+
+def _threshold(field, thresholds):
+    '''
+    Return the threshold which applies to a field, if any
+    '''
+    if field in thresholds:
+        return thresholds[field]
+    for pattern, threshold in thresholds.items():
+        if fnmatch.fnmatchcase(field, pattern):
+            return threshold
+    return None
+
+
+def _changes(old, new, thresholds):
+    '''
+    Return the fields which differ between two flattened samples. Fields
+    which disappeared are returned as None.
+    '''
+    ret = {}
+    for field, value in new.items():
+        if field not in old:
+            ret[field] = value
+            continue
+        previous = old[field]
+        if value == previous:
+            continue
+        threshold = _threshold(field, thresholds)
+        if threshold is not None \
+                and isinstance(value, (int, float)) \
+                and isinstance(previous, (int, float)) \
+                and not isinstance(value, bool) \
+                and abs(value - previous) < float(threshold):
+            continue
+        ret[field] = value
+    for field in old:
+        if field not in new:
+            ret[field] = None
+    return ret
+
+
+def beacon_delta(context, key, data, _conf, thresholds):
+    '''
+    Return the fields of a status which have changed since the last event
+    sent under ``key``, or None if nothing is to be sent. The last event is
+    kept in the beacon's ``context``.
+    '''
+    thresholds = _conf.get('thresholds', thresholds)
+    sample = flatten(data)
+    last = context.get(key)
+    now = time.time()
+
+    if last is None:
+        changes = sample
+    else:
+        if now - last['time'] < float(_conf.get('min_interval', 0)):
+            return None
+        changes = _changes(last['sample'], sample, thresholds)
+        if not changes:
+            return None
+        # Fields below their threshold keep their last sent value, so slow
+        # drifts are still reported once they add up
+        merged = dict(last['sample'])
+        merged.update(changes)
+        sample = dict((field, value) for field, value in merged.items() if field in sample)
+
+    context[key] = {'sample': sample, 'time': now}
+    if _conf.get('flatten', False):
+        return changes
+    return unflatten(changes)
+
+
+def beacon_events(config, name, thresholds, status, printers, farm, context):
+    '''
+    Return the events of a status beacon. ``status`` is called for each of
+    the ``printers`` with ``max_age`` and ``printer``, and only the fields
+    which changed are sent. Printers whose status can't be had are skipped.
+    On a farm proxy, each event is tagged with the name of its printer.
+    '''
+    _conf = beacon_config(config)
+
+    ret = []
+    for printer in printers:
+        try:
+            data = status(max_age=_conf.get('max_age'), printer=printer)
+        except CommandExecutionError as exc:
+            log.warning('The %s beacon could not get the status of %s: %s', name, printer, exc)
+            continue
+        if _conf.get('delta', True) is not False:
+            key = '{0}.beacon.{1}'.format(name, printer)
+            data = beacon_delta(context, key, data, _conf, thresholds)
+            if data is None:
+                continue
+        if farm:
+            data['tag'] = printer
+        ret.append(data)
+    return ret